@@ -1,3 +1,198 @@
-from django.test import TestCase
+from datetime import datetime
 
-# Create your tests here.
+from django.test import SimpleTestCase
+
+import pandas as pd
+
+from data.analyse import counting_by_category, counts_as_dict, crimes_by_street, slice_months
+from data.cube import build_cube, CRIME_CUBE_DIMENSIONS
+from data.extract import postcode_to_coords
+from mysite.datasets import get_postcode_cube
+from mysite.testing import OfflineTestCase, POSTCODES
+
+
+def make_crime_df() -> pd.core.frame.DataFrame:
+    """This function returns a small crime dataframe, sorted by date."""
+
+    return pd.DataFrame({
+        'date': pd.to_datetime(['2023-01-01', '2023-01-01', '2023-02-01', '2023-02-01', '2023-03-01', '2023-03-01'])
+        .astype('datetime64[s]'),
+        'category': pd.Categorical(['burglary', 'drugs', 'burglary', 'burglary', 'drugs', 'robbery']),
+        'street': pd.Categorical(['High Street', 'High Street', 'Mill Lane', 'High Street', 'Mill Lane', 'Mill Lane']),
+        'outcome': pd.Categorical(['Under investigation', None, 'Under investigation', None, None, None])})
+
+
+class CubeTests(SimpleTestCase):
+
+    def setUp(self):
+        self.crime_df = make_crime_df()
+        self.crime_cube = build_cube(self.crime_df, CRIME_CUBE_DIMENSIONS)
+
+    def test_build_cube_counts_each_combination(self):
+        self.assertEqual(self.crime_cube['count'].sum(), len(self.crime_df))
+        self.assertEqual(self.crime_cube['count'].dtype, 'int32')
+        self.assertTrue(self.crime_cube['date'].is_monotonic_increasing)
+        # Missing outcomes are kept as their own combination
+        self.assertEqual(self.crime_cube['outcome'].isna().sum(), 4)
+
+    def test_build_cube_of_empty_dataframe_is_typed(self):
+        cube = build_cube(pd.DataFrame(), CRIME_CUBE_DIMENSIONS)
+
+        self.assertTrue(cube.empty)
+        self.assertEqual(list(cube.columns), CRIME_CUBE_DIMENSIONS + ['count'])
+        self.assertEqual(cube['count'].dtype, 'int32')
+        self.assertEqual(cube['date'].dtype, 'datetime64[s]')
+        self.assertIsInstance(cube['category'].dtype, pd.CategoricalDtype)
+
+    def test_cube_counts_match_the_dataframe(self):
+        for categories in [['date'], ['category'], ['street', 'category']]:
+            pd.testing.assert_series_equal(
+                counting_by_category(self.crime_cube, categories)[categories[0]],
+                counting_by_category(self.crime_df, categories)[categories[0]],
+                check_names=False, check_dtype=False)
+
+        pd.testing.assert_frame_equal(crimes_by_street(self.crime_cube), crimes_by_street(self.crime_df),
+                                      check_dtype=False)
+
+    def test_crimes_by_street(self):
+        crime_street_df = crimes_by_street(self.crime_cube).set_index('street')
+
+        self.assertEqual(crime_street_df.loc['High Street', 'category'], 'burglary')
+        self.assertEqual(crime_street_df.loc['High Street', 'total_crimes'], 3)
+        self.assertEqual(crime_street_df.loc['Mill Lane', 'total_crimes'], 3)
+
+    def test_counts_as_dict(self):
+        self.assertEqual(counts_as_dict(self.crime_cube, ['date']),
+                         {'2023-01': 2, '2023-02': 2, '2023-03': 2})
+        self.assertEqual(counts_as_dict(self.crime_cube, ['street', 'category']),
+                         {'High Street': {'burglary': 2, 'drugs': 1},
+                          'Mill Lane': {'burglary': 1, 'drugs': 1, 'robbery': 1}})
+
+
+class SliceMonthsTests(SimpleTestCase):
+
+    def setUp(self):
+        self.crime_df = make_crime_df()
+        self.crime_cube = build_cube(self.crime_df, CRIME_CUBE_DIMENSIONS)
+
+    def test_slice_months_is_inclusive(self):
+        sliced = slice_months(self.crime_cube, datetime(2023, 2, 1), datetime(2023, 3, 1))
+
+        self.assertEqual(sliced['count'].sum(), 4)
+        self.assertEqual(slice_months(self.crime_df, datetime(2023, 1, 2), datetime(2023, 2, 28))['date'].nunique(), 1)
+        self.assertTrue(slice_months(self.crime_cube, datetime(2024, 1, 1), datetime(2024, 12, 1)).empty)
+
+    def test_slice_months_needs_sorted_dates(self):
+        with self.assertRaises(ValueError):
+            slice_months(self.crime_df.iloc[::-1], datetime(2023, 1, 1), datetime(2023, 3, 1))
+
+
+class CrimeAggregatesTests(OfflineTestCase):
+
+    postcode = POSTCODES[0]
+
+    def get_aggregates(self, **params):
+        return self.client.get(f'/api/crimes/{self.postcode}/aggregates', params)
+
+    def test_aggregates_of_a_date_range(self):
+        cube = get_postcode_cube('crimes', self.postcode)
+        first_month = cube['date'].iloc[0]
+
+        response = self.get_aggregates(**{'from': f"{first_month:%Y-%m-%d}", 'to': f"{first_month:%Y-%m-%d}"})
+
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual(data['total'], cube.loc[cube['date'] == first_month, 'count'].sum())
+        self.assertEqual(list(data['counts']['date']), [f"{first_month:%Y-%m}"])
+        self.assertEqual(sum(data['counts']['category'].values()), data['total'])
+
+        not_modified = self.client.get(f'/api/crimes/{self.postcode}/aggregates',
+                                       {'from': data['from'], 'to': data['to']},
+                                       headers={'If-None-Match': response['ETag']})
+        self.assertEqual(not_modified.status_code, 304)
+
+    def test_aggregates_reject_bad_dates(self):
+        self.assertEqual(self.get_aggregates(**{'from': '2023-13-01'}).status_code, 400)
+
+
+class CrimeLoadJobTests(OfflineTestCase):
+
+    postcode = POSTCODES[0]
+
+    def test_aggregates_load_in_the_background(self):
+        response = self.client.get(f'/api/crimes/{self.postcode}/aggregates')
+        self.assertEqual(response.status_code, 202)
+        self.assertIn('Retry-After', response.headers)
+        self.assertIn(response.json()['status'], ['queued', 'running', 'done'])
+
+        self.assertEqual(self.wait_for_load_job('crimes', self.postcode)['status'], 'done')
+        response = self.client.get(f'/api/crimes/{self.postcode}/aggregates')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['total'], get_postcode_cube('crimes', self.postcode)['count'].sum())
+
+    def test_page_post(self):
+        get_postcode_cube('crimes', self.postcode)
+
+        response = self.client.post(f'/crimes/{self.postcode}/', {'from-date': '2022-01-01', 'to-date': '2030-01-01'})
+        self.assertEqual(response.status_code, 200)
+
+        self.assertEqual(self.client.post(f'/crimes/{self.postcode}/', {'from-date': '2022-01-01'}).status_code, 400)
+        self.assertEqual(self.client.post(f'/crimes/{self.postcode}/',
+                                          {'from-date': 'yesterday', 'to-date': '2030-01-01'}).status_code, 400)
+
+
+class CrimesNearTests(OfflineTestCase):
+
+    postcode = POSTCODES[0]
+
+    def setUp(self):
+        super().setUp()
+        self.cube = get_postcode_cube('crimes', self.postcode)
+        self.longitude, self.latitude = postcode_to_coords(self.postcode)
+
+    def get_near(self, **params):
+        return self.client.get('/api/crimes/near', {'lng': self.longitude, 'lat': self.latitude, **params})
+
+    def test_crimes_near_a_stored_postcode(self):
+        response = self.get_near()
+
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertTrue(data['complete'])
+        self.assertEqual(data['total'], self.cube['count'].sum())
+
+    def test_date_filter(self):
+        first_month = self.cube['date'].iloc[0]
+
+        data = self.get_near(**{'from': f"{first_month:%Y-%m-%d}", 'to': f"{first_month:%Y-%m-%d}"}).json()
+
+        self.assertEqual(data['total'], self.cube.loc[self.cube['date'] == first_month, 'count'].sum())
+        self.assertEqual(list(data['counts']['date']), [f"{first_month:%Y-%m}"])
+        self.assertTrue(data['complete'])
+
+    def test_radius_is_capped(self):
+        self.assertEqual(self.get_near(radius=0).status_code, 400)
+        self.assertEqual(self.get_near(radius=5001).status_code, 400)
+        self.assertEqual(self.get_near(radius='far').status_code, 400)
+
+        # Tiles beyond the postcode's radius aren't stored
+        response = self.get_near(radius=5000)
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(response.json()['complete'])
+
+    def test_nearest_streets(self):
+        response = self.client.get('/api/crimes/nearest_streets', {'lng': self.longitude, 'lat': self.latitude,
+                                                                     'count': 3})
+
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertTrue(data['complete'])
+        self.assertEqual(len(data['streets']), 3)
+        self.assertEqual([street['distance'] for street in data['streets']],
+                         sorted(street['distance'] for street in data['streets']))
+
+        self.assertEqual(self.client.get('/api/crimes/nearest_streets', {'lng': self.longitude, 'lat': self.latitude,
+                                                                         'count': 51}).status_code, 400)
+        self.assertFalse(self.client.get('/api/crimes/nearest_streets', {'lng': self.longitude + 1,
+                                                                         'lat': self.latitude}).json()['complete'])
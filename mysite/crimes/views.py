@@ -1,19 +1,29 @@
 import matplotlib.pyplot as plt
 
 from django.http import HttpResponse
-from django.http import HttpResponseNotFound
+from django.http import HttpResponseBadRequest, JsonResponse
 from django.views.decorators.csrf import csrf_protect
 from django.middleware.csrf import get_token
 
-from django.core.cache import cache
-from django.shortcuts import render
+import logging
 
-
-from data.analyse import get_crime_data_df, counting_by_category
+from data.analyse import (counting_by_category, counts_as_dict, crimes_by_street, get_month_list,
+                          get_published_months, slice_months)
+from data.spatial import get_crime_index
 from data.visualise import plot_bar, plot_crimes_with_time_line_graph
+from mysite.api import parse_date_range, parse_location, etag_json_response
+from mysite.charts import get_chart_urls
+from mysite.datasets import STARTING_YEAR
+from mysite.instrumentation import render_page
+from mysite.jobs import load_api_cube, load_page_cube
 
 from datetime import datetime
 
+# The cube columns the postcode page uses
+PAGE_COLUMNS = ['date', 'category', 'street', 'count']
+
+logger = logging.getLogger(__name__)
+
 # Create your views here.
 
 
@@ -28,103 +38,164 @@ def postcode_page(request, postcode):
 
     if request.method == 'GET':
 
-        crime_df_dict = cache.get('cached_crime_df_dict')
-        print(f"Crime Dict Data: {crime_df_dict}")
-
-        if (crime_df_dict is None):
-
-            try:
-                crime_df = get_crime_data_df(normal_postcode, 2022)
-                crime_df_dict = {normal_postcode: crime_df}
-                cache.set('cached_crime_df_dict',
-                          crime_df_dict, timeout=60 * 10)
-            except Exception as e:
-                # Print out the error message
-                print(f"An error occurred: {e}")
-                return HttpResponseNotFound(f"{e} Error\n\nIf it's a 429 error just try refreshing again :)))))")
-
-        elif normal_postcode not in crime_df_dict.keys():
-
-            try:
-                crime_df = get_crime_data_df(normal_postcode, 2022)
-                crime_df_dict[normal_postcode] = crime_df
-                cache.set('cached_crime_df_dict',
-                          crime_df_dict, timeout=60 * 10)
-            except Exception as e:
-                # Print out the error message
-                print(f"An error occurred: {e}")
-                return HttpResponseNotFound(f"{e} Error\n\nIf it's a 429 error just try refreshing again :)))))")
-
-        print('GET METHOD')
-        print(f"postcode: {normal_postcode}")
-        print(crime_df_dict.keys())
-        print([type(value) for value in crime_df_dict.values()])
-        crime_df = crime_df_dict[normal_postcode]
-
-        # Line Graph
-        crime_date_df = counting_by_category(crime_df, ['date'])
-        plot_crimes_with_time_line_graph(
-            crime_date_df, "crimes/static/png/line_graph")
-
-        # Category Bar Chart
-        crime_category_df = counting_by_category(crime_df, ['category'])
-        plot_bar(crime_category_df, "crimes/static/png/bar_chart")
+        # Load the data in the background if it isn't ready, showing a progress page meanwhile
+        crime_cube, response = load_page_cube(request, 'crimes', normal_postcode, PAGE_COLUMNS)
+        if response is not None:
+            return response
+
+        logger.debug("Crimes page for %s", normal_postcode)
+
+        starting_date = "2022-01-01"
+        ending_date = datetime.today().strftime('%Y-%m-%d')
+
+        # Line Graph & Category Bar Chart
+        chart_urls = get_chart_urls('crimes', normal_postcode, starting_date, ending_date, {
+            'line_graph': (plot_crimes_with_time_line_graph, lambda: {'df': counting_by_category(crime_cube, ['date'])}),
+            'bar_chart': (plot_bar, lambda: {'df': counting_by_category(crime_cube, ['category'])})},
+            version=crime_cube['count'].sum())
 
         # Streets Table
-        crime_street_df = crime_df.groupby('street')['category'].agg(
-            lambda x: x.mode().iloc[0] if not x.empty else None).reset_index()
-        crime_street_df['total_crimes'] = crime_df.groupby(
-            'street').size().reset_index(name='total_crimes')['total_crimes']
+        crime_street_df = crimes_by_street(crime_cube)
 
         csrf_token = get_token(request)
 
         context = {"postcode": normal_postcode[:-3].strip().upper() + ' ' + normal_postcode[-3:].strip().upper(),
                    "crime_street_df": crime_street_df.sort_values('total_crimes', ascending=False).head(10).iterrows(),
-                   "starting_date": "2022-01-01",
-                   "ending_date": datetime.today().strftime('%Y-%m-%d'),
+                   "chart_urls": chart_urls,
+                   "starting_date": starting_date,
+                   "ending_date": ending_date,
                    'csrf_token': csrf_token}
 
-        return render(request, "crimes/crime_postcode_page.html", context)
+        return render_page(request, "crimes/crime_postcode_page.html", context)
 
     if request.method == 'POST':
 
-        from_date = datetime.strptime(
-            request.POST.get('from-date'), "%Y-%m-%d")
-        to_date = datetime.strptime(
-            request.POST.get('to-date'), "%Y-%m-%d")
-
-        crime_df_dict = cache.get('cached_crime_df_dict')
+        try:
+            from_date = datetime.strptime(
+                request.POST.get('from-date', ''), "%Y-%m-%d")
+            to_date = datetime.strptime(
+                request.POST.get('to-date', ''), "%Y-%m-%d")
+        except ValueError:
+            return HttpResponseBadRequest("The from and to dates must be given as YYYY-MM-DD.")
 
-        print('GET METHOD')
-        print(f"postcode: {normal_postcode}")
-        print(crime_df_dict.keys())
+        crime_cube, response = load_page_cube(request, 'crimes', normal_postcode, PAGE_COLUMNS)
+        if response is not None:
+            return response
 
-        crime_df = crime_df_dict[normal_postcode]
+        logger.debug("Crimes page for %s from %s to %s", normal_postcode, from_date.date(), to_date.date())
 
-        print(crime_df['date'])
-        print(from_date)
+        version = crime_cube['count'].sum()
+        crime_cube = slice_months(crime_cube, from_date, to_date)
 
-        crime_df = crime_df[(crime_df.date >= from_date)
-                            & (crime_df.date <= to_date)]
-
-        # Line Graph
-        crime_date_df = counting_by_category(crime_df, ['date'])
-        plot_crimes_with_time_line_graph(
-            crime_date_df, "crimes/static/png/line_graph")
-
-        # Category Bar Chart
-        crime_category_df = counting_by_category(crime_df, ['category'])
-        plot_bar(crime_category_df, "crimes/static/png/bar_chart")
+        # Line Graph & Category Bar Chart
+        chart_urls = get_chart_urls('crimes', normal_postcode, from_date.date(), to_date.date(), {
+            'line_graph': (plot_crimes_with_time_line_graph, lambda: {'df': counting_by_category(crime_cube, ['date'])}),
+            'bar_chart': (plot_bar, lambda: {'df': counting_by_category(crime_cube, ['category'])})},
+            version=version)
 
         # Streets Table
-        crime_street_df = crime_df.groupby('street')['category'].agg(
-            lambda x: x.mode().iloc[0] if not x.empty else None).reset_index()
-        crime_street_df['total_crimes'] = crime_df.groupby(
-            'street').size().reset_index(name='total_crimes')['total_crimes']
+        crime_street_df = crimes_by_street(crime_cube)
 
         context = {"postcode": normal_postcode[:-3].strip().upper() + ' ' + normal_postcode[-3:].strip().upper(),
                    "crime_street_df": crime_street_df.sort_values('total_crimes', ascending=False).head(10).iterrows(),
+                   "chart_urls": chart_urls,
                    "starting_date": str(from_date.date()),
                    "ending_date": str(to_date.date())}
 
-        return render(request, "crimes/crime_postcode_page.html", context)
+        return render_page(request, "crimes/crime_postcode_page.html", context)
+
+
+def aggregates(request, postcode):
+    """Returns the counts of crimes around a postcode by date, category, street
+    and outcome as JSON, for the date range given by the 'from' and 'to' parameters. If
+    the postcode's data isn't ready it's loaded in the background, with a 202 meanwhile."""
+
+    normal_postcode = postcode.replace(" ", "").lower()
+
+    try:
+        from_date, to_date = parse_date_range(request)
+    except ValueError as e:
+        return JsonResponse({"error": str(e)}, status=400)
+
+    crime_cube, response = load_api_cube('crimes', normal_postcode)
+    if response is not None:
+        return response
+
+    crime_cube = slice_months(crime_cube, from_date, to_date)
+
+    data = {"postcode": normal_postcode,
+            "from": str(from_date.date()),
+            "to": str(to_date.date()),
+            "total": int(crime_cube['count'].sum()),
+            "counts": {category: counts_as_dict(crime_cube, [category])
+                       for category in ['date', 'category', 'street', 'outcome']}}
+
+    return etag_json_response(request, data)
+
+
+def crimes_near(request):
+    """Returns the counts of stored crimes within 'radius' metres (default 1 mile, up to
+    5km) of the 'lng' and 'lat' parameters by date, category, street and outcome as JSON,
+    for the date range given by the 'from' and 'to' parameters. 'complete' says whether
+    all of the area's data has been stored, for every published month in the range."""
+
+    try:
+        coords = parse_location(request)
+        radius = float(request.GET.get('radius', 1609.344))
+        from_date, to_date = parse_date_range(request)
+    except (KeyError, ValueError) as e:
+        return JsonResponse({"error": f"Invalid parameters: {e}"}, status=400)
+
+    if not 0 < radius <= 5000:
+        return JsonResponse({"error": "The radius must be between 0 and 5000 metres."}, status=400)
+
+    try:
+        dates = [(year, month) for year, month in get_published_months()
+                 if (from_date.year, from_date.month) <= (year, month) <= (to_date.year, to_date.month)]
+    except Exception as e:
+        return JsonResponse({"error": str(e)}, status=502)
+
+    crime_index = get_crime_index()
+    rows, _ = crime_index.query_radius(coords, radius, from_date, to_date)
+    crime_df = crime_index.frame(rows)
+
+    data = {"longitude": coords[0],
+            "latitude": coords[1],
+            "radius": radius,
+            "from": str(from_date.date()),
+            "to": str(to_date.date()),
+            "complete": crime_index.covers(coords, radius, dates),
+            "total": len(crime_df),
+            "counts": {category: counts_as_dict(crime_df, [category]) if len(crime_df) else {}
+                       for category in ['date', 'category', 'street', 'outcome']}}
+
+    return etag_json_response(request, data)
+
+
+def nearest_streets(request):
+    """Returns the streets (with stored crimes) nearest to the 'lng' and 'lat' parameters,
+    up to 'count' of them (default 5, up to 50), with their distances in metres as JSON."""
+
+    try:
+        coords = parse_location(request)
+        count = int(request.GET.get('count', 5))
+    except (KeyError, ValueError) as e:
+        return JsonResponse({"error": f"Invalid parameters: {e}"}, status=400)
+
+    if not 0 < count <= 50:
+        return JsonResponse({"error": "The count must be between 1 and 50."}, status=400)
+
+    try:
+        dates = get_month_list(STARTING_YEAR)
+    except Exception as e:
+        return JsonResponse({"error": str(e)}, status=502)
+
+    crime_index = get_crime_index()
+    streets = crime_index.nearest_streets(coords, count)
+
+    data = {"longitude": coords[0],
+            "latitude": coords[1],
+            "complete": crime_index.covers(coords, streets['distance'].max() if len(streets) else 5000, dates),
+            "streets": streets.to_dict('records')}
+
+    return etag_json_response(request, data)
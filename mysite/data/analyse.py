@@ -2,89 +2,153 @@
 (crime and stop & search (ss) instances).'''
 
 from datetime import datetime
-from multiprocessing.pool import Pool
 from os import environ as ENV
 import os
+import threading
 import time
 
 from dotenv import load_dotenv
+import numpy as np
 import pandas as pd
 
-from .extract import postcode_to_coords, get_relevant_street_crimes_data, get_relevant_stop_and_search_data
+from .extract import (postcode_to_coords, get_available_dates, get_stop_and_search_data,
+                      select_relevant_stop_and_search_data)
+from .fetch import fetch_many
+from .metrics import timed
+from .schema import compact_crime_df, compact_ss_df
+from .store import load_months, save_month, MonthsNotStored
+from .tiles import get_crime_columns_around
+
+PUBLISHED_MONTHS_TIMEOUT = int(ENV.get('PUBLISHED_MONTHS_TIMEOUT', 60 * 60))
+
+_published_months = (0.0, None)
+_published_months_lock = threading.Lock()
 
 crime_categories = ['category', 'street name', 'outcome', 'date']
 ss_categories = ['age range', 'gender', 'legislation',
                  'object of search', 'street', 'type', 'time', 'hour', 'date']
 
 
-def get_crime_data_df(post_code: str, starting_year: int) -> pd.core.frame.DataFrame:
-    """Given a postcode and a starting year, this function returns a pandas
-    dataframe with data on instances of crimes from that year."""
+def get_published_months() -> list[tuple[int, int]]:
+    """This function returns the (year, month) pairs the Police API has published,
+    in chronological order. The feed is only re-read every PUBLISHED_MONTHS_TIMEOUT
+    seconds, since a new month is published about once a month."""
+
+    global _published_months
+    with _published_months_lock:
+        fetched_at, dates = _published_months
+        if dates is None or time.monotonic() - fetched_at > PUBLISHED_MONTHS_TIMEOUT:
+            dates = sorted(get_available_dates())
+            _published_months = (time.monotonic(), dates)
+
+    return dates
+
+
+def get_month_list(starting_year: int) -> list[tuple[int, int]]:
+    """Given a starting year, this function returns the (year, month) pairs
+    to request data for - every published month from that year onwards."""
+
+    return [(year, month) for year, month in get_published_months() if year >= starting_year]
+
+
+def get_stored_months_data(dataset: str, fetch_function, coords: tuple[float, float],
+                           dates: list[tuple[int, int]], progress=None,
+                           fetch: bool = True) -> list[tuple[int, int, list[dict]]]:
+    """Given a dataset, its API fetch function, a location and a list of (year, month)
+    pairs, this function returns the API's data for each month as (year, month, data).
+    Stored months are read from the store; only missing months are fetched (and then
+    stored) - or, if fetch is False, MonthsNotStored is raised. Only published months
+    should be asked for, so what's stored is final. If given, progress(months done,
+    total months) is called as months are loaded."""
 
-    coords = postcode_to_coords(post_code)
+    months_data = load_months(dataset, coords, dates)
+    missing_dates = [date for date in dates if date not in months_data]
+    if missing_dates and not fetch:
+        raise MonthsNotStored(f"{len(missing_dates)} months of {dataset} aren't stored.")
 
-    current_date = datetime.now()
-    current_year = current_date.year
-    current_month = current_date.month
+    stored_count = len(dates) - len(missing_dates)
+    if progress is not None:
+        progress(stored_count, len(dates))
 
-    dates = []
-    for year in range(starting_year, current_year+1):
-        if year == current_year:
-            dates += [(coords, year, i) for i in range(1, current_month-1)]
-        else:
-            dates += [(coords, year, i) for i in range(1, 13)]
+    fetched_data, _ = fetch_many(
+        fetch_function, [(coords, year, month) for year, month in missing_dates],
+        progress=None if progress is None else lambda done, _: progress(stored_count + done, len(dates)))
 
-    crime_data = []
-    with Pool() as pool:
-        api_limit = 15
-        for i in range(0, len(dates), api_limit):
+    for (year, month), data in zip(missing_dates, fetched_data):
+        save_month(dataset, coords, year, month, data)
+        months_data[(year, month)] = data
 
-            crime_data += pool.starmap(
-                get_relevant_street_crimes_data, dates[i:i+api_limit])
-            time.sleep(1)
+    return [(year, month, months_data[(year, month)]) for year, month in dates]
 
-    crime_data = [crime for sublist in crime_data for crime in sublist]
 
-    return pd.DataFrame(crime_data)
+def get_crime_data_df(post_code: str, starting_year: int, progress=None) -> pd.core.frame.DataFrame:
+    """Given a postcode and a starting year, this function returns a pandas
+    dataframe with data on instances of crimes from that year."""
+
+    return get_months_df('crimes', post_code, get_month_list(starting_year), progress)
+
+
+def get_crime_months_df(coords: tuple[float, float], dates: list[tuple[int, int]],
+                        progress=None, fetch: bool = True) -> pd.core.frame.DataFrame:
+    """Given a location - (longitude, latitude) - and a list of (year, month) pairs, this
+    function returns a (compact) crime dataframe of the crimes within a 1 mile radius in
+    those months, assembled from the shared tiles that cover it (see tiles.py)."""
+
+    return compact_crime_df(pd.DataFrame(get_crime_columns_around(coords, dates, progress=progress, fetch=fetch)))
 
 
-def get_ss_data_df(post_code: str, starting_year: int) -> pd.core.frame.DataFrame:
+def get_ss_data_df(post_code: str, starting_year: int, progress=None) -> pd.core.frame.DataFrame:
     """Given a postcode, year and month, this function returns a pandas
     dataframe with data on instances of stop and searches (ss)."""
 
-    coords = postcode_to_coords(post_code)
+    return get_months_df('stop_and_searches', post_code, get_month_list(starting_year), progress)
 
-    current_date = datetime.now()
-    current_year = current_date.year
-    current_month = current_date.month
 
-    dates = []
-    for year in range(starting_year, current_year+1):
-        if year == current_year:
-            dates += [(coords, year, i) for i in range(1, current_month-1)]
-        else:
-            dates += [(coords, year, i) for i in range(1, 13)]
+@timed('normalise')
+def ss_months_to_df(months_data: list[tuple[int, int, list[dict]]]) -> pd.core.frame.DataFrame:
+    """Given the API's stop and search data for some months as (year, month, data),
+    this function returns it as a (compact) stop and search dataframe."""
 
-    ss_data = []
-    with Pool() as pool:
-        api_limit = 15
+    ss_data = [ss for year, month, data in months_data
+               for ss in select_relevant_stop_and_search_data(data, year, month)]
+    if not ss_data:
+        return pd.DataFrame()
 
-        for i in range(0, len(dates), api_limit):
-            ss_data += pool.starmap(
-                get_relevant_stop_and_search_data, dates[i:i+api_limit])
-            time.sleep(1)
-
-    ss_data = [ss for sublist in ss_data for ss in sublist]
     ss_df = pd.DataFrame(ss_data)
     ss_df['time'] = ss_df['time'].apply(lambda x: x[11:-9])
     ss_df['hour'] = ss_df['time'].str[:2]
 
-    return ss_df
+    return compact_ss_df(ss_df)
+
+
+def get_ss_months_df(coords: tuple[float, float], dates: list[tuple[int, int]],
+                     progress=None, fetch: bool = True) -> pd.core.frame.DataFrame:
+    """Given a location - (longitude, latitude) - and a list of (year, month) pairs, this
+    function returns a (compact) stop and search dataframe of the stop and searches within
+    a 1 mile radius in those months (see get_stored_months_data)."""
+
+    return ss_months_to_df(get_stored_months_data(
+        'stop_and_searches', get_stop_and_search_data, coords, dates, progress, fetch))
+
 
+MONTHS_LOADERS = {'crimes': get_crime_months_df,
+                  'stop_and_searches': get_ss_months_df}
 
+
+def get_months_df(dataset: str, post_code: str, dates: list[tuple[int, int]],
+                  progress=None) -> pd.core.frame.DataFrame:
+    """Given a dataset ('crimes' or 'stop_and_searches'), a postcode and a list of
+    (year, month) pairs, this function returns a dataframe of the dataset's instances
+    in those months."""
+
+    return MONTHS_LOADERS[dataset](postcode_to_coords(post_code), dates, progress)
+
+
+@timed('aggregate')
 def counting_by_category(df: pd.core.frame.DataFrame, categories: list[str]) -> pd.core.frame.DataFrame:
     """Given a pandas dataframe, this function returns a dataframe with
     the number of rows (counts) for each type of the inputted category(ies).
+    If the dataframe is a count cube (see cube.py) its counts are summed instead.
     Note: This function is designed to deal with our specific data sources 
     (i.e. crime and stop&search data)."""
 
@@ -93,7 +157,66 @@ def counting_by_category(df: pd.core.frame.DataFrame, categories: list[str]) ->
             raise ValueError(
                 f" {category} is not a valid category that you can search this data by.")
 
-    return df.groupby(categories)[categories].count()
+    if 'count' in df.columns:
+        counts = df.groupby(categories, observed=True)['count'].sum()
+        return pd.DataFrame({category: counts for category in categories})
+
+    return df.groupby(categories, observed=True)[categories].count()
+
+
+@timed('aggregate')
+def crimes_by_street(df: pd.core.frame.DataFrame) -> pd.core.frame.DataFrame:
+    """Given a crime dataframe (or count cube), this function returns a dataframe with
+    each street's most common category of crime and total number of crimes."""
+
+    counts = counting_by_category(df, ['street', 'category'])[
+        'street'].rename('count').reset_index()
+
+    crime_street_df = counts.sort_values(['street', 'count', 'category'], ascending=[True, False, True]).drop_duplicates(
+        'street').drop(columns='count').reset_index(drop=True)
+    crime_street_df['total_crimes'] = crime_street_df['street'].map(
+        counts.groupby('street', observed=True)['count'].sum()).astype(int)
+
+    return crime_street_df
+
+
+@timed('aggregate')
+def slice_months(df: pd.core.frame.DataFrame, from_date: datetime, to_date: datetime) -> pd.core.frame.DataFrame:
+    """Given a dataframe (or count cube) sorted by date, this function returns the rows
+    dated within the inputted range (inclusive), found by binary search on the date
+    column. The result is a slice of the dataframe, not a copy, so the cost depends on
+    the number of rows returned rather than the length of the whole history."""
+
+    dates = df['date'].values
+    if len(dates) and dates[0] > dates[-1]:
+        raise ValueError("The dataframe must be sorted by date.")
+
+    start = np.searchsorted(dates, np.datetime64(from_date, 's'), side='left')
+    stop = np.searchsorted(dates, np.datetime64(to_date, 's'), side='right')
+
+    return df.iloc[start:stop]
+
+
+@timed('aggregate')
+def counts_as_dict(df: pd.core.frame.DataFrame, categories: list[str]) -> dict:
+    """Given a pandas dataframe, this function returns the number of rows (counts) for
+    each type of the inputted category(ies) as a (nested, for 2 categories) dictionary
+    that can be serialised as JSON. Dates are given as 'YYYY-MM'."""
+
+    counts = counting_by_category(df, categories)[categories[0]]
+
+    def label(value):
+        return value.strftime('%Y-%m') if isinstance(value, datetime) else str(value)
+
+    if len(categories) == 1:
+        return {label(value): int(count) for value, count in counts.items()}
+
+    nested_counts = {}
+    for (value, sub_value), count in counts.items():
+        nested_counts.setdefault(label(value), {})[
+            label(sub_value)] = int(count)
+
+    return nested_counts
 
 
 if __name__ == "__main__":
@@ -0,0 +1,83 @@
+'''This file contains the functions that time the benchmark suite's stages (see the benchmark
+management command), and save and compare their results, so that performance regressions
+between two runs can be caught.'''
+
+from datetime import datetime
+import json
+import platform
+import statistics
+import time
+
+import numpy as np
+import pandas as pd
+
+
+def time_stage(function, repeat: int = 5, setup=None, warmup: int = 1) -> dict:
+    """Given a function (a stage of the benchmark), this function calls it `warmup` times
+    untimed and then `repeat` times timed, calling setup() (if given) untimed before each.
+    It returns the timings in seconds - every run, and their min, median and mean."""
+
+    runs = []
+    for i in range(warmup + repeat):
+        if setup is not None:
+            setup()
+
+        start = time.perf_counter()
+        function()
+        seconds = time.perf_counter() - start
+
+        if i >= warmup:
+            runs.append(seconds)
+
+    return {'runs': runs, 'min': min(runs), 'median': statistics.median(runs),
+            'mean': statistics.mean(runs)}
+
+
+def make_results(stages: dict[str, dict], **meta) -> dict:
+    """Given a dictionary of stage names to their timings (see time_stage) and
+    anything else worth recording about the run, this function returns the run's
+    results, including the versions that affect them."""
+
+    return {'created_at': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(), 'numpy': np.__version__, 'pandas': pd.__version__,
+            **meta, 'stages': stages}
+
+
+def save_results(path: str, results: dict) -> None:
+    """Given a path and a run's results, this function writes the results as JSON."""
+
+    with open(path, 'w') as file:
+        json.dump(results, file, indent=2)
+
+
+def load_results(path: str) -> dict:
+    """Given the path of a run's saved results, this function returns them."""
+
+    with open(path) as file:
+        return json.load(file)
+
+
+def compare_results(baseline: dict, results: dict, threshold: float = 0.1,
+                    thresholds: dict[str, float] = None, min_seconds: float = 0.001) -> list[dict]:
+    """Given a baseline run's results, a new run's results and the relative slowdown
+    allowed (e.g. 0.1 for 10%, overridable per stage with `thresholds`), this function
+    returns the comparison of each stage in both runs by median time. A stage has
+    regressed if it's slower by more than its threshold and by more than min_seconds
+    (so that sub-millisecond stages don't fail on noise)."""
+
+    thresholds = thresholds or {}
+    comparisons = []
+    for stage, timings in results['stages'].items():
+        if stage not in baseline['stages']:
+            continue
+
+        before = baseline['stages'][stage]['median']
+        after = timings['median']
+        change = (after - before) / before if before else 0.0
+        stage_threshold = thresholds.get(stage, threshold)
+
+        comparisons.append({'stage': stage, 'baseline': before, 'current': after,
+                            'change': change, 'threshold': stage_threshold,
+                            'regressed': change > stage_threshold and after - before > min_seconds})
+
+    return comparisons
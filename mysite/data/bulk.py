@@ -0,0 +1,292 @@
+'''This file contains the importer for data.police.uk's bulk monthly CSV archives. It streams
+the street-level crime and stop & search (ss) CSVs in chunks and writes them to the store in
+the same shape as the Police API's responses, so they're read exactly like fetched data.'''
+
+from hashlib import sha1
+from pathlib import Path
+import io
+import re
+import time
+import zipfile
+
+import numpy as np
+import pandas as pd
+
+from .spatial import cell_keys, SpatialIndex
+from .store import load_months, save_month
+from .tiles import distance_metres, tiles_of, RADIUS_METRES
+
+
+CHUNK_ROWS = 50_000
+
+# Buffered rows are written to the store once there are this many, so an import's
+# memory doesn't grow with the size of the CSV.
+FLUSH_ROWS = 100_000
+
+# Stop and searches are given the name of the nearest street with a crime within this distance.
+STREET_SEARCH_RADIUS = 250
+
+CRIME_COLUMNS = ['Crime ID', 'Month', 'Reported by', 'Longitude', 'Latitude', 'Location',
+                 'Crime type', 'Last outcome category', 'Context']
+SS_COLUMNS = ['Type', 'Date', 'Latitude', 'Longitude', 'Gender', 'Age range', 'Legislation',
+              'Object of search', 'Outcome']
+
+# The archives' crime types, as the API's categories
+CRIME_TYPE_CATEGORIES = {'Anti-social behaviour': 'anti-social-behaviour',
+                         'Bicycle theft': 'bicycle-theft',
+                         'Burglary': 'burglary',
+                         'Criminal damage and arson': 'criminal-damage-arson',
+                         'Drugs': 'drugs',
+                         'Other theft': 'other-theft',
+                         'Possession of weapons': 'possession-of-weapons',
+                         'Public order': 'public-order',
+                         'Robbery': 'robbery',
+                         'Shoplifting': 'shoplifting',
+                         'Theft from the person': 'theft-from-the-person',
+                         'Vehicle crime': 'vehicle-crime',
+                         'Violence and sexual offences': 'violent-crime',
+                         'Other crime': 'other-crime'}
+
+CSV_NAME_PATTERN = re.compile(
+    r'(\d{4})-(\d{2})-(.+)-(street|stop-and-search)\.csv$')
+
+
+def archive_csv_files(path: str) -> list[tuple[str, object]]:
+    """Given the path of a bulk archive (a .zip) or a folder of its CSVs, this function
+    returns the street-level crime and stop and search CSVs in it as (name, opener) pairs,
+    where opener() opens the CSV as text. They're ordered by month, then force, with each
+    force's street-level crimes before its stop and searches."""
+
+    path = Path(path)
+    if path.is_dir():
+        files = [(str(file.relative_to(path)), lambda file=file: open(file, newline=''))
+                 for file in path.rglob('*.csv')]
+    elif zipfile.is_zipfile(path):
+        archive = zipfile.ZipFile(path)
+        files = [(name, lambda name=name: io.TextIOWrapper(archive.open(name), newline=''))
+                 for name in archive.namelist() if name.endswith('.csv')]
+    else:
+        raise ValueError(f"{path} is not a folder or a zip archive.")
+
+    files = [(name, opener) for name, opener in files if CSV_NAME_PATTERN.search(name)]
+
+    def order(file):
+        year, month, force, kind = CSV_NAME_PATTERN.search(file[0]).groups()
+        return year, month, force, kind != 'street'
+
+    return sorted(files, key=order)
+
+
+def read_chunks(opener, columns: list[str]):
+    """Given a CSV opener and the columns to read, this function yields the CSV's rows
+    CHUNK_ROWS at a time, as dataframes of strings (empty cells are empty strings)."""
+
+    with opener() as file:
+        yield from pd.read_csv(file, usecols=lambda column: column in columns, dtype=str,
+                               keep_default_na=False, chunksize=CHUNK_ROWS)
+
+
+def csv_crime_id(crime_id: str, source: str, line: int) -> int:
+    """Given a crime's 'Crime ID' (a hash, or empty for anti-social behaviour), its CSV
+    and line number, this function returns a stable integer id for the crime - negative
+    if it was made up from its position, so it can't clash with the API's ids."""
+
+    if crime_id:
+        return int(crime_id[:15], 16)
+
+    return -int(sha1(f"{source}:{line}".encode()).hexdigest()[:15], 16)
+
+
+def rows_to_crimes(chunk: pd.core.frame.DataFrame, source: str, first_line: int) -> list[dict]:
+    """Given a chunk of a street-level crime CSV, its name and the line number of its first
+    row, this function returns its located crimes in the shape of the API's responses."""
+
+    crimes = []
+    columns = {column: chunk[column].tolist() for column in chunk.columns}
+    for line, values in enumerate(zip(*columns.values()), start=first_line):
+        row = dict(zip(columns, values))
+        if not row['Longitude'] or not row['Latitude']:
+            continue
+
+        crimes.append({'category': CRIME_TYPE_CATEGORIES.get(row['Crime type'], 'other-crime'),
+                       'location_type': 'BTP' if row['Reported by'] == 'British Transport Police' else 'Force',
+                       'location': {'latitude': row['Latitude'], 'longitude': row['Longitude'],
+                                    'street': {'id': None, 'name': row['Location']}},
+                       'context': row.get('Context', ''),
+                       'outcome_status': {'category': row['Last outcome category'], 'date': row['Month']}
+                       if row['Last outcome category'] else None,
+                       'persistent_id': row['Crime ID'],
+                       'id': csv_crime_id(row['Crime ID'], source, line),
+                       'location_subtype': '',
+                       'month': row['Month']})
+
+    return crimes
+
+
+def rows_to_stops(chunk: pd.core.frame.DataFrame, streets: list[str]) -> list[dict]:
+    """Given a chunk of a stop and search CSV (with only located rows) and the street
+    of each row, this function returns its stop and searches in the shape of the
+    API's responses."""
+
+    return [{'age_range': row['Age range'] or None,
+             'outcome': row['Outcome'] or None,
+             'involved_person': row['Type'] != 'Vehicle search',
+             'gender': row['Gender'] or None,
+             'legislation': row['Legislation'] or None,
+             'datetime': row['Date'],
+             'location': {'latitude': row['Latitude'], 'longitude': row['Longitude'],
+                          'street': {'id': None, 'name': street}},
+             'type': row['Type'],
+             'object_of_search': row['Object of search'] or None}
+            for row, street in zip(chunk.to_dict('records'), streets)]
+
+
+class ArchiveImporter:
+    """Writes bulk archive CSVs to the store. Crimes go to the shared tiles (see tiles.py);
+    stop and searches go to the radius of each of the given locations. The first write of a
+    tile or location's month in an import replaces what was stored, so the archive wins;
+    later writes (e.g. from a neighbouring force's CSV) are merged into it."""
+
+    def __init__(self, ss_locations: list[tuple[float, float]] = ()):
+        self.ss_locations = list(ss_locations)
+        self.written = set()
+        self.streets = None
+        self.streets_key = None
+
+    def write(self, dataset: str, coords: tuple[float, float], year: int, month: int, data: list[dict]) -> None:
+        """Given a dataset, a tile or location, a year-month and its data, this method
+        writes (or merges) the data into the store."""
+
+        key = (dataset, coords, year, month)
+        if key in self.written:
+            data = load_months(dataset, coords, [(year, month)]).get(
+                (year, month), []) + data
+        self.written.add(key)
+
+        save_month(dataset, coords, year, month, data)
+
+    def flush(self, dataset: str, pending: dict, year: int, month: int) -> int:
+        """Given a dataset, a dictionary of tiles or locations to their buffered data and
+        a year-month, this method writes the buffered data, empties the buffer and returns
+        the number of rows written."""
+
+        written = 0
+        for coords, data in pending.items():
+            self.write(dataset, coords, year, month, data)
+            written += len(data)
+        pending.clear()
+
+        return written
+
+    def import_csv(self, name: str, opener) -> dict:
+        """Given a CSV's name and opener (see archive_csv_files), this method imports it and
+        returns the number of rows read and written and the time taken."""
+
+        year, month, force, kind = CSV_NAME_PATTERN.search(name).groups()
+        year, month = int(year), int(month)
+        start = time.perf_counter()
+
+        if kind == 'street':
+            rows, written = self.import_street_csv(name, opener, year, month)
+            self.streets_key = (year, month, force)
+        else:
+            if self.streets_key != (year, month, force):
+                self.streets = None
+            rows, written = self.import_ss_csv(opener, year, month)
+
+        return {'rows': rows, 'written': written, 'seconds': time.perf_counter() - start}
+
+    def import_street_csv(self, name: str, opener, year: int, month: int) -> tuple[int, int]:
+        """Given a street-level crime CSV, this method writes its crimes to their tiles,
+        FLUSH_ROWS or so at a time. The crimes' streets are kept to name the force's stop
+        and searches."""
+
+        tiles_data = {}
+        pending_rows = 0
+        written = 0
+        rows = 0
+        streets = {'longitude': [], 'latitude': [], 'street': []}
+        for chunk in read_chunks(opener, CRIME_COLUMNS):
+            crimes = rows_to_crimes(chunk, name, rows + 2)
+            rows += len(chunk)
+
+            longitudes = np.array([float(crime['location']['longitude']) for crime in crimes])
+            latitudes = np.array([float(crime['location']['latitude']) for crime in crimes])
+            for tile, crime in zip(tiles_of(longitudes, latitudes), crimes):
+                tiles_data.setdefault(tile, []).append(crime)
+            pending_rows += len(crimes)
+
+            if pending_rows >= FLUSH_ROWS:
+                written += self.flush('crime_tiles', tiles_data, year, month)
+                pending_rows = 0
+
+            streets['longitude'].append(longitudes)
+            streets['latitude'].append(latitudes)
+            streets['street'].append(np.array([crime['location']['street']['name'] for crime in crimes],
+                                              dtype=object))
+
+        written += self.flush('crime_tiles', tiles_data, year, month)
+
+        columns = {column: np.concatenate(values) if values else np.array([])
+                   for column, values in streets.items()}
+        columns['date'] = np.full(len(columns['street']), np.datetime64(f"{year}-{month:02d}-01", 's'))
+        self.streets = SpatialIndex(columns)
+
+        return rows, written
+
+    def street_names(self, longitudes: np.ndarray, latitudes: np.ndarray) -> list[str]:
+        """Given arrays of longitudes and latitudes, this method returns the name of the
+        nearest street (with a crime in the force's last CSV) to each point. The points are
+        looked up a grid cell at a time (see spatial.py), rather than one query each."""
+
+        names = np.full(len(longitudes), 'On or near an unknown street', dtype=object)
+        if self.streets is None or not len(names):
+            return names.tolist()
+
+        keys = cell_keys(longitudes, latitudes)
+        for key in np.unique(keys):
+            points = np.flatnonzero(keys == key)
+            centre = (longitudes[points].mean(), latitudes[points].mean())
+            spread = distance_metres(centre, longitudes[points], latitudes[points]).max()
+
+            # Every street within the radius of a point is within the radius plus the spread of the centre
+            rows, _ = self.streets.query_radius(centre, STREET_SEARCH_RADIUS + spread)
+            if not len(rows):
+                continue
+            distances = distance_metres((longitudes[points, None], latitudes[points, None]),
+                                        self.streets.longitudes[rows], self.streets.latitudes[rows])
+            nearest = np.argmin(distances, axis=1)
+            found = distances[np.arange(len(points)), nearest] <= STREET_SEARCH_RADIUS
+            names[points[found]] = self.streets.columns['street'][rows[nearest[found]]]
+
+        return names.tolist()
+
+    def import_ss_csv(self, opener, year: int, month: int) -> tuple[int, int]:
+        """Given a stop and search CSV, this method writes the stop and searches within
+        1 mile of each of the importer's locations to that location's radius, FLUSH_ROWS
+        or so at a time."""
+
+        locations_data = {}
+        pending_rows = 0
+        written = 0
+        rows = 0
+        for chunk in read_chunks(opener, SS_COLUMNS):
+            rows += len(chunk)
+            chunk = chunk[(chunk['Longitude'] != '') & (chunk['Latitude'] != '')]
+            longitudes = chunk['Longitude'].astype(float).values
+            latitudes = chunk['Latitude'].astype(float).values
+
+            for coords in self.ss_locations:
+                nearby = distance_metres(coords, longitudes, latitudes) <= RADIUS_METRES
+                if nearby.any():
+                    locations_data.setdefault(coords, []).extend(rows_to_stops(
+                        chunk[nearby], self.street_names(longitudes[nearby], latitudes[nearby])))
+                    pending_rows += int(nearby.sum())
+
+            if pending_rows >= FLUSH_ROWS:
+                written += self.flush('stop_and_searches', locations_data, year, month)
+                pending_rows = 0
+
+        written += self.flush('stop_and_searches', locations_data, year, month)
+
+        return rows, written
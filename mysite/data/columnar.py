@@ -0,0 +1,149 @@
+'''This file contains the on-disk columnar storage of postcodes' (compact) dataframes. Each
+column is a NumPy file that's memory-mapped when read, so loading a dataframe doesn't copy or
+parse it, only the columns asked for are touched, and every process shares the OS's page cache
+of the files instead of holding its own copy.'''
+
+from os import environ as ENV
+from pathlib import Path
+import json
+import os
+import shutil
+import time
+import uuid
+
+import numpy as np
+import pandas as pd
+
+from .schema import CATEGORICAL_COLUMNS
+
+
+DEFAULT_COLUMNAR_PATH = Path(__file__).resolve().parent.parent / 'columnar'
+
+# The file in each dataframe's folder that names its current version.
+CURRENT_FILE = 'current'
+
+# How long replaced versions are kept for readers that looked them up just before, and
+# how many times a reader looks the current version up again if its version disappears.
+OLD_VERSION_SECONDS = 60
+LOAD_ATTEMPTS = 3
+
+
+def get_columnar_path() -> Path:
+    """This function returns the folder that the dataframes are stored in."""
+
+    return Path(ENV.get('DATA_COLUMNAR_PATH', DEFAULT_COLUMNAR_PATH))
+
+
+def frame_path(dataset: str, key: str, kind: str) -> Path:
+    """Given a dataset, a key (e.g. a normalised postcode) and a kind of data ('df' or
+    'cube'), this function returns the folder that the dataframe's versions are stored in."""
+
+    return get_columnar_path() / dataset / kind / key
+
+
+def save_frame(dataset: str, key: str, kind: str, df: pd.core.frame.DataFrame) -> None:
+    """Given a dataset, a key, a kind of data and a (compact, date sorted) dataframe,
+    this function writes (or replaces) the dataframe on disk - a file per column, with
+    categorical columns (and the dataset's string columns, see schema.py) as their codes;
+    any other column of strings is an error. Each save writes a new version folder that's
+    never changed afterwards, and then points the 'current' file at it, so readers see
+    either the old version or the new one, whole. As the rows are sorted by date, each
+    month's rows are a contiguous range of every file (see slice_months in analyse.py)."""
+
+    frame_columns = {}
+    for column, values in df.items():
+        # Strings are object or str columns, depending on the version of pandas
+        if not isinstance(values.dtype, pd.CategoricalDtype) and pd.api.types.is_string_dtype(values.dtype):
+            if column not in CATEGORICAL_COLUMNS.get(dataset, []):
+                raise ValueError(f"The {column} column of {dataset} can't be stored as {values.dtype}.")
+            values = values.astype('category')
+        frame_columns[column] = values
+
+    path = frame_path(dataset, key, kind)
+    version = uuid.uuid4().hex
+    version_path = path / version
+    version_path.mkdir(parents=True)
+
+    columns = []
+    for i, (column, values) in enumerate(frame_columns.items()):
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            columns.append({'name': column, 'file': f"{i}.npy",
+                            'categories': [str(category) for category in values.cat.categories]})
+            np.save(version_path / f"{i}.npy", values.array.codes)
+        else:
+            columns.append({'name': column, 'file': f"{i}.npy"})
+            np.save(version_path / f"{i}.npy", values.to_numpy(), allow_pickle=False)
+
+    with open(version_path / 'meta.json', 'w') as file:
+        json.dump({'rows': len(df), 'columns': columns}, file)
+
+    pointer_path = path / f"{CURRENT_FILE}.{version}.tmp"
+    pointer_path.write_text(version)
+    os.replace(pointer_path, path / CURRENT_FILE)
+
+    remove_old_versions(path, version)
+
+
+def remove_old_versions(path: Path, version: str) -> None:
+    """Given a dataframe's folder and its current version, this function deletes the
+    other versions (and anything else left in the folder) once they're more than
+    OLD_VERSION_SECONDS old - by then, nobody is still opening their files."""
+
+    now = time.time()
+    for entry in path.iterdir():
+        if entry.name in (CURRENT_FILE, version):
+            continue
+
+        try:
+            if now - entry.stat().st_mtime < OLD_VERSION_SECONDS:
+                continue
+            if entry.is_dir():
+                shutil.rmtree(entry, ignore_errors=True)
+            else:
+                entry.unlink()
+        except FileNotFoundError:
+            # Removed by another save
+            continue
+
+
+def load_frame(dataset: str, key: str, kind: str, columns: list[str] = None) -> pd.core.frame.DataFrame:
+    """Given a dataset, a key, a kind of data and optionally the columns needed, this
+    function returns the stored dataframe (or just those columns of it) backed by
+    read-only memory maps of its files, or None if it isn't stored. The current
+    version is looked up once, and all of the files are read from it."""
+
+    path = frame_path(dataset, key, kind)
+    for _ in range(LOAD_ATTEMPTS):
+        try:
+            version_path = path / (path / CURRENT_FILE).read_text()
+        except FileNotFoundError:
+            # Not stored
+            return None
+
+        try:
+            with open(version_path / 'meta.json') as file:
+                meta = json.load(file)
+
+            data = {}
+            for column in meta['columns']:
+                if columns is not None and column['name'] not in columns:
+                    continue
+
+                values = np.load(version_path / column['file'], mmap_mode='r')
+                if 'categories' in column:
+                    values = pd.Categorical.from_codes(np.asarray(values), validate=False,
+                                                       dtype=pd.CategoricalDtype(column['categories']))
+                data[column['name']] = values
+        except FileNotFoundError:
+            # The version was removed while being read (e.g. deleted) - look it up again
+            continue
+
+        return pd.DataFrame(data, copy=False)
+
+    return None
+
+
+def delete_frame(dataset: str, key: str, kind: str) -> None:
+    """Given a dataset, a key and a kind of data, this function deletes the stored dataframe."""
+
+    shutil.rmtree(frame_path(dataset, key, kind), ignore_errors=True)
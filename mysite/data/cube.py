@@ -0,0 +1,36 @@
+'''This file contains the functions that build the pre-aggregated count 'cube' of a postcode's
+crime and stop & search (ss) data - the number of instances for every combination of the
+dimensions the pages show - so that date ranges can be answered without the raw rows.'''
+
+import pandas as pd
+
+from .metrics import timed
+from .schema import DATE_UNIT
+
+
+CRIME_CUBE_DIMENSIONS = ['date', 'category', 'street', 'outcome']
+SS_CUBE_DIMENSIONS = ['date', 'hour', 'age range', 'gender', 'legislation',
+                      'object of search', 'outcome']
+
+# The types of an empty cube's dimensions (the rest are categorical), as in a compact dataframe.
+EMPTY_DIMENSION_DTYPES = {'date': DATE_UNIT, 'hour': 'int8'}
+
+
+@timed('aggregate')
+def build_cube(df: pd.core.frame.DataFrame, dimensions: list[str]) -> pd.core.frame.DataFrame:
+    """Given a dataframe and a list of its columns (starting with 'date'), this function
+    returns a dataframe with one row per observed combination of those columns and a
+    'count' column, sorted by date. Missing values are kept as their own combination.
+    An empty dataframe gives an empty cube with the same column types as a full one."""
+
+    if df.empty:
+        cube = pd.DataFrame({dimension: pd.Series(dtype=EMPTY_DIMENSION_DTYPES.get(dimension, 'category'))
+                             for dimension in dimensions})
+        cube['count'] = pd.Series(dtype='int32')
+        return cube
+
+    cube = df.groupby(dimensions, observed=True, dropna=False,
+                      sort=False).size().reset_index(name='count')
+    cube['count'] = cube['count'].astype('int32')
+
+    return cube.sort_values('date', kind='stable', ignore_index=True)
@@ -0,0 +1,82 @@
+'''This file contains the generators that export postcodes' crime and stop & search (ss)
+records as CSV or NDJSON, a month at a time, so an export never holds more than one
+postcode-month of records in memory. Exports only read what's stored - they never
+wait on the Police API part way through a download.'''
+
+from .analyse import MONTHS_LOADERS
+from .store import load_stored_dates
+from .tiles import tiles_covering
+
+
+EXPORT_FORMATS = {'csv': 'text/csv', 'ndjson': 'application/x-ndjson'}
+
+
+def missing_export_months(dataset: str, coords: dict[str, tuple[float, float]],
+                          dates: list[tuple[int, int]]) -> dict[str, list[tuple[int, int]]]:
+    """Given a dataset, a dictionary of postcodes to their coordinates and a list of
+    (year, month) pairs, this function returns the months that aren't stored for each
+    postcode that has any - for crimes, the months missing from any of the tiles
+    covering the postcode."""
+
+    missing = {}
+    for postcode, postcode_coords in coords.items():
+        if dataset == 'crimes':
+            stored_dates = set.intersection(*[load_stored_dates('crime_tiles', tile)
+                                              for tile in tiles_covering(postcode_coords)])
+        else:
+            stored_dates = load_stored_dates(dataset, postcode_coords)
+
+        missing_dates = [date for date in dates if date not in stored_dates]
+        if missing_dates:
+            missing[postcode] = missing_dates
+
+    return missing
+
+
+def export_frames(dataset: str, coords: dict[str, tuple[float, float]], dates: list[tuple[int, int]]):
+    """Given a dataset ('crimes' or 'stop_and_searches'), a dictionary of postcodes to
+    their coordinates and a list of (year, month) pairs, this function yields a dataframe
+    of the dataset's records for each postcode-month (skipping empty ones), with the
+    postcode as the first column and dates as 'YYYY-MM'. Each month is read from the
+    store only when the previous one has been consumed; the months should all be stored
+    (see missing_export_months), as a missing one raises MonthsNotStored."""
+
+    for postcode, postcode_coords in coords.items():
+        for date in dates:
+            df = MONTHS_LOADERS[dataset](postcode_coords, [date], None, fetch=False)
+            if df.empty:
+                continue
+
+            df = df.assign(date=df['date'].dt.strftime('%Y-%m'))
+            df.insert(0, 'postcode', postcode)
+            yield df
+
+
+def frames_to_csv(frames):
+    """Given an iterable of dataframes with the same columns, this function yields
+    them as CSV text, with a header before the first."""
+
+    header = True
+    for df in frames:
+        yield df.to_csv(index=False, header=header)
+        header = False
+
+
+def frames_to_ndjson(frames):
+    """Given an iterable of dataframes, this function yields them as newline
+    delimited JSON text, a line (object) per row."""
+
+    for df in frames:
+        lines = df.to_json(orient='records', lines=True)
+        yield lines if lines.endswith('\n') else lines + '\n'
+
+
+def export_records(dataset: str, coords: dict[str, tuple[float, float]],
+                   dates: list[tuple[int, int]], file_format: str):
+    """Given a dataset, a dictionary of postcodes to their coordinates, a list of
+    (year, month) pairs and a format ('csv' or 'ndjson'), this function yields the
+    records as text in that format."""
+
+    frames = export_frames(dataset, coords, dates)
+
+    return frames_to_csv(frames) if file_format == 'csv' else frames_to_ndjson(frames)
@@ -4,27 +4,135 @@ APIs.'''
 from os import environ as ENV
 from csv import DictWriter
 from datetime import datetime
+import re
 
-import requests
 from dotenv import load_dotenv
+import numpy as np
 
+from . import session
+from .metrics import timed
+from .store import load_postcode_coords, save_postcode_coords
 
-POSTCODE_BASE_URL = "https://api.postcodes.io"
-POLICE_BASE_URL = "https://data.police.uk/api"
 
+# Either can be pointed at a stand-in (e.g. the replay_server command) for offline or load testing.
+POSTCODE_BASE_URL = ENV.get('POSTCODE_BASE_URL', "https://api.postcodes.io").rstrip('/')
+POLICE_BASE_URL = ENV.get('POLICE_BASE_URL', "https://data.police.uk/api").rstrip('/')
 
+
+class APIError(Exception):
+    """Raised when the Police or Postcode API responds with an unsuccessful status code."""
+
+    def __init__(self, status_code: int):
+        super().__init__(f'Unsuccessful request - Status Code: {status_code}')
+        self.status_code = status_code
+
+
+# Geocodes already looked up by this process, so repeats skip the store and the API.
+_postcode_coords = {}
+
+
+def normalise_postcode(postcode: str) -> str:
+    """Given a postcode, this function returns it without spaces and in lower case."""
+
+    return postcode.replace(" ", "").lower()
+
+
+def is_outcode(postcode: str) -> bool:
+    """Given a normalised postcode, this function returns whether it's only an
+    outcode (the part before the space, e.g. 'nw5')."""
+
+    return re.fullmatch(r'[a-z]{1,2}[0-9][a-z0-9]?', postcode) is not None
+
+
+@timed('geocode')
 def postcode_to_coords(postcode: str) -> tuple[float]:
-    """Given a postcode, this function returns corresponding
-     geographic coordinates - (longitude, latitude)."""
+    """Given a postcode (or outcode), this function returns corresponding
+     geographic coordinates - (longitude, latitude). An outcode's
+     coordinates are those of its centre."""
 
-    location_data = requests.get(
-        POSTCODE_BASE_URL+f"/postcodes/{postcode}").json()
+    postcode = normalise_postcode(postcode)
+
+    if postcode in _postcode_coords:
+        return _postcode_coords[postcode]
+
+    stored_coords = load_postcode_coords([postcode])
+    if postcode in stored_coords:
+        _postcode_coords[postcode] = stored_coords[postcode]
+        return stored_coords[postcode]
+
+    lookup_type = 'outcodes' if is_outcode(postcode) else 'postcodes'
+    location_data = session.get(
+        POSTCODE_BASE_URL+f"/{lookup_type}/{postcode}").json()
 
     if location_data['status'] != 200:
-        raise Exception(
-            f"Unsuccessful HTTP Request. API Access Error Code: {location_data['status']}")
+        raise APIError(location_data['status'])
+
+    coords = (location_data['result']['longitude'],
+              location_data['result']['latitude'])
+    save_postcode_coords({postcode: coords})
+    _postcode_coords[postcode] = coords
+
+    return coords
+
+
+@timed('geocode')
+def postcodes_to_coords(postcodes: list[str]) -> dict[str, tuple[float]]:
+    """Given a list of postcodes (or outcodes), this function returns a dictionary of
+    each (normalised) postcode to its geographic coordinates - (longitude, latitude),
+    or None if it isn't a valid postcode. Postcodes that haven't been geocoded before
+    are looked up in bulk, 100 per request (outcodes can only be looked up one by one)."""
+
+    postcodes = list(dict.fromkeys(normalise_postcode(postcode)
+                     for postcode in postcodes))
+
+    coords = {postcode: _postcode_coords[postcode]
+              for postcode in postcodes if postcode in _postcode_coords}
+    coords.update(load_postcode_coords(
+        [postcode for postcode in postcodes if postcode not in coords]))
+    missing_postcodes = [
+        postcode for postcode in postcodes if postcode not in coords and not is_outcode(postcode)]
+
+    for outcode in [postcode for postcode in postcodes if postcode not in coords and is_outcode(postcode)]:
+        try:
+            coords[outcode] = postcode_to_coords(outcode)
+        except APIError as e:
+            # Only an outcode that doesn't exist is left as None
+            if e.status_code != 404:
+                raise
+
+    new_coords = {}
+    bulk_limit = 100
+    for i in range(0, len(missing_postcodes), bulk_limit):
+
+        location_data = session.post(
+            POSTCODE_BASE_URL+"/postcodes", json={"postcodes": missing_postcodes[i:i+bulk_limit]}).json()
 
-    return (location_data['result']['longitude'], location_data['result']['latitude'])
+        if location_data['status'] != 200:
+            raise APIError(location_data['status'])
+
+        for lookup in location_data['result']:
+            if lookup['result'] is not None:
+                new_coords[normalise_postcode(lookup['query'])] = (
+                    lookup['result']['longitude'], lookup['result']['latitude'])
+
+    save_postcode_coords(new_coords)
+    coords.update(new_coords)
+    _postcode_coords.update(coords)
+
+    return {postcode: coords.get(postcode) for postcode in postcodes}
+
+
+@timed('fetch')
+def get_available_dates() -> list[tuple[int, int]]:
+    """This function returns the (year, month) pairs that the Police API has
+    published street-level data for, from its /crimes-street-dates feed."""
+
+    dates_data = session.get(POLICE_BASE_URL+"/crimes-street-dates")
+
+    if dates_data.status_code != 200:
+        raise APIError(dates_data.status_code)
+
+    return [tuple(int(part) for part in date['date'].split('-')) for date in dates_data.json()]
 
 
 def get_street_crimes_data(coords: tuple[float, float], year: int, month: int) -> list[dict]:
@@ -34,12 +142,11 @@ def get_street_crimes_data(coords: tuple[float, float], year: int, month: int) -
 
     longitude, latitude = coords[0], coords[1]
 
-    crime_data = requests.get(
+    crime_data = session.get(
         POLICE_BASE_URL+f"/crimes-street/all-crime?lat={latitude}&lng={longitude}&date={year}-{month}")
 
     if crime_data.status_code != 200:
-        raise Exception(
-            f'Unsuccessful request - Status Code: {crime_data.status_code}')
+        raise APIError(crime_data.status_code)
 
     return crime_data.json()
 
@@ -51,6 +158,14 @@ def get_relevant_street_crimes_data(coords: tuple[float, float], year: int, mont
 
     crime_data = get_street_crimes_data(coords, year, month)
 
+    return select_relevant_street_crimes_data(crime_data, year, month)
+
+
+@timed('normalise')
+def select_relevant_street_crimes_data(crime_data: list[dict], year: int, month: int) -> list[dict]:
+    """Given the API's street-level crime data for a specific year-month, this
+    function returns the RELEVANT data for each crime."""
+
     relevant_data = []
     for crime in crime_data:
 
@@ -61,6 +176,38 @@ def get_relevant_street_crimes_data(coords: tuple[float, float], year: int, mont
     return relevant_data
 
 
+@timed('normalise')
+def street_crimes_to_columns(crime_data: list[dict], year: int, month: int) -> dict[str, np.ndarray]:
+    """Given the API's street-level crime data for a specific year-month, this
+    function returns the RELEVANT data (plus each crime's id, coordinates and
+    location type) as a dictionary of typed column arrays, without building a
+    dictionary per crime."""
+
+    n = len(crime_data)
+    locations = [crime['location'] for crime in crime_data]
+    outcomes = [crime['outcome_status'] for crime in crime_data]
+
+    return {'id': np.fromiter((crime['id'] for crime in crime_data), dtype=np.int64, count=n),
+            'category': np.array([crime['category'] for crime in crime_data], dtype=object),
+            'street': np.array([location['street']['name'] for location in locations], dtype=object),
+            'outcome': np.array([outcome['category'] if outcome is not None else 'Unknown'
+                                 for outcome in outcomes], dtype=object),
+            'latitude': np.fromiter((location['latitude'] for location in locations), dtype=np.float64, count=n),
+            'longitude': np.fromiter((location['longitude'] for location in locations), dtype=np.float64, count=n),
+            'location type': np.array([crime['location_type'] for crime in crime_data], dtype=object),
+            'date': np.full(n, np.datetime64(f"{year}-{month:02d}-01", 'us'))}
+
+
+def concat_columns(batches: list[dict[str, np.ndarray]]) -> dict[str, np.ndarray]:
+    """Given a list of batches of column arrays (e.g. one per month), this
+    function returns a single batch with each column's arrays joined together."""
+
+    if not batches:
+        return {}
+
+    return {column: np.concatenate([batch[column] for batch in batches]) for column in batches[0]}
+
+
 def dict_to_csv(data: list[dict], file_path: str) -> None:
     """Given a list of dictionaries with identical keys, representing an
     instance of something, this function outputs the data into a csv
@@ -82,10 +229,13 @@ def get_stop_and_search_data(coords: tuple[float, float], year: int, month: int)
 
     longitude, latitude = coords[0], coords[1]
 
-    ss_data = requests.get(
-        POLICE_BASE_URL+f"/stops-street?lat={latitude}&lng={longitude}&date={year}-{month}").json()
+    ss_data = session.get(
+        POLICE_BASE_URL+f"/stops-street?lat={latitude}&lng={longitude}&date={year}-{month}")
+
+    if ss_data.status_code != 200:
+        raise APIError(ss_data.status_code)
 
-    return ss_data
+    return ss_data.json()
 
 
 def get_relevant_stop_and_search_data(coords: tuple[float, float], year: int, month: int) -> list[dict]:
@@ -95,6 +245,14 @@ def get_relevant_stop_and_search_data(coords: tuple[float, float], year: int, mo
 
     ss_data = get_stop_and_search_data(coords, year, month)
 
+    return select_relevant_stop_and_search_data(ss_data, year, month)
+
+
+@timed('normalise')
+def select_relevant_stop_and_search_data(ss_data: list[dict], year: int, month: int) -> list[dict]:
+    """Given the API's stop and search data for a specific year-month, this
+    function returns the RELEVANT data for each stop and search instance."""
+
     relevant_data = []
     for event in ss_data:
 
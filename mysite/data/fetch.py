@@ -0,0 +1,218 @@
+'''This file contains the shared engine used to make many rate-limited requests to the
+Police API concurrently.'''
+
+from concurrent.futures import ThreadPoolExecutor
+import random
+import threading
+import time
+
+import requests
+
+from .extract import APIError
+from .metrics import timed
+from .store import take_token
+
+
+# https://data.police.uk/docs/api-call-limits/ - 15 requests per second, with a burst of 30.
+POLICE_API_RATE = 15
+POLICE_API_BURST = 30
+
+MAX_WORKERS = 15
+MAX_RETRIES = 5
+BACKOFF_BASE = 0.5
+
+_totals = {'calls': 0, 'requests': 0, 'retries': 0, 'rate_limited': 0,
+           'errors': 0, 'wait_seconds': 0.0, 'seconds': 0.0}
+_totals_lock = threading.Lock()
+
+
+class TokenBucket:
+    """A thread-safe token bucket - allows bursts of up to `capacity` calls,
+    refilling at `rate` tokens per second."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self) -> float:
+        """This method blocks until a token is available, takes it, and returns
+        the number of seconds spent waiting."""
+
+        waited = 0
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens +
+                                  (now - self.updated_at) * self.rate)
+                self.updated_at = now
+
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+
+                wait = (1 - self.tokens) / self.rate
+
+            time.sleep(wait)
+            waited += wait
+
+    def try_acquire(self) -> bool:
+        """This method takes a token if one is available (without waiting), and
+        returns whether it did."""
+
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens +
+                              (now - self.updated_at) * self.rate)
+            self.updated_at = now
+
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+
+class SharedTokenBucket:
+    """A token bucket kept in the store (see take_token), so that every process using
+    it - e.g. each of the web server's workers - shares the one limit, rather than each
+    being allowed `rate` calls per second of its own."""
+
+    def __init__(self, name: str, rate: float, capacity: float):
+        self.name = name
+        self.rate = rate
+        self.capacity = capacity
+
+    def acquire(self) -> float:
+        """This method blocks until a token is available, takes it, and returns
+        the number of seconds spent waiting."""
+
+        waited = 0
+        while True:
+            wait = take_token(self.name, self.rate, self.capacity)
+            if not wait:
+                return waited
+
+            time.sleep(wait)
+            waited += wait
+
+    def try_acquire(self) -> bool:
+        """This method takes a token if one is available (without waiting), and
+        returns whether it did."""
+
+        return not take_token(self.name, self.rate, self.capacity)
+
+
+police_api_bucket = SharedTokenBucket('police_api', POLICE_API_RATE, POLICE_API_BURST)
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor() -> ThreadPoolExecutor:
+    """This function returns the process-wide thread pool used for fetching."""
+
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=MAX_WORKERS, thread_name_prefix='fetch')
+
+    return _executor
+
+
+def is_retryable(error: Exception) -> bool:
+    """Given an exception raised by a fetch, this function returns whether
+    the request is worth retrying (rate limiting, server errors and network errors)."""
+
+    if isinstance(error, APIError):
+        return error.status_code == 429 or error.status_code >= 500
+
+    return isinstance(error, (requests.ConnectionError, requests.Timeout))
+
+
+def fetch_with_retries(fetch_function, args: tuple, stats: dict, stats_lock: threading.Lock,
+                       bucket: TokenBucket | SharedTokenBucket = police_api_bucket,
+                       status_retries: dict[int, int] = None):
+    """Given a fetch function and its arguments, this function calls it once a token
+    is available, retrying rate-limited and failed requests with jittered exponential
+    backoff. If given, status_retries caps the number of retries of particular status
+    codes (e.g. {503: 1}). The inputted stats dictionary is updated along the way."""
+
+    status_retries = dict(status_retries or {})
+    for attempt in range(MAX_RETRIES + 1):
+        waited = bucket.acquire()
+
+        try:
+            result = fetch_function(*args)
+        except Exception as e:
+            retry = attempt < MAX_RETRIES and is_retryable(e)
+            status_code = getattr(e, 'status_code', None)
+            if retry and status_code in status_retries:
+                retry = status_retries[status_code] > 0
+                status_retries[status_code] -= 1
+            with stats_lock:
+                stats['requests'] += 1
+                stats['wait_seconds'] += waited
+                if isinstance(e, APIError) and e.status_code == 429:
+                    stats['rate_limited'] += 1
+                if retry:
+                    stats['retries'] += 1
+                else:
+                    stats['errors'] += 1
+            if not retry:
+                raise
+            time.sleep(random.uniform(0, BACKOFF_BASE * 2 ** attempt))
+        else:
+            with stats_lock:
+                stats['requests'] += 1
+                stats['wait_seconds'] += waited
+            return result
+
+
+@timed('fetch')
+def fetch_many(fetch_function, args_list: list[tuple], bucket: TokenBucket | SharedTokenBucket = police_api_bucket,
+               progress=None, fetcher=fetch_with_retries) -> tuple[list, dict]:
+    """Given a fetch function and a list of argument tuples, this function calls
+    the function for each of them concurrently, within the API rate limit. It returns
+    the results (in the same order as the arguments) and the stats of the fetch:
+    the number of requests, retries, 429s and errors, and the time taken. If given,
+    progress(done, total) is called as each call finishes, and fetcher - called with
+    fetch_with_retries' arguments - makes each call in its place."""
+
+    stats = {'calls': len(args_list), 'requests': 0, 'retries': 0, 'rate_limited': 0,
+             'errors': 0, 'wait_seconds': 0.0, 'seconds': 0.0}
+    stats_lock = threading.Lock()
+    start = time.perf_counter()
+
+    futures = [get_executor().submit(fetcher, fetch_function, args, stats, stats_lock, bucket)
+               for args in args_list]
+
+    if progress is not None:
+        done = [0]
+        done_lock = threading.Lock()
+
+        def on_done(_):
+            with done_lock:
+                done[0] += 1
+                progress(done[0], len(futures))
+
+        for future in futures:
+            future.add_done_callback(on_done)
+    results = [future.result() for future in futures]
+
+    stats['seconds'] = time.perf_counter() - start
+    with _totals_lock:
+        for stat, value in stats.items():
+            _totals[stat] += value
+
+    return results, stats
+
+
+def get_fetch_totals() -> dict:
+    """This function returns the stats of every fetch_many call made by this process
+    so far, added together."""
+
+    with _totals_lock:
+        return dict(_totals)
@@ -0,0 +1,108 @@
+'''This file contains the recorded Police and Postcode API responses (fixtures) used to benchmark
+and load test the app without the real APIs, and the transports (see session.py) that record
+and replay them. Responses are keyed by method, path, query and body - not the host - so they
+replay the same whichever base URLs the APIs are reached through.'''
+
+from urllib.parse import urlsplit
+import gzip
+import json
+import threading
+
+from requests.adapters import BaseAdapter, HTTPAdapter
+from requests.models import Response
+from requests.structures import CaseInsensitiveDict
+
+
+def fixture_key(method: str, url: str, body=None) -> str:
+    """Given a request's method, url and body, this function returns the key its
+    response is recorded under - e.g. 'GET /api/crimes-street-dates'."""
+
+    parts = urlsplit(url)
+    key = f"{method} {parts.path}" + (f"?{parts.query}" if parts.query else '')
+    if body:
+        key += ' ' + (body.decode() if isinstance(body, bytes) else body)
+
+    return key
+
+
+def load_fixtures(path: str) -> dict:
+    """Given the path of a (gzipped JSON) fixtures file, this function returns its
+    contents - 'responses', a dictionary of keys to {'status', 'body'} dictionaries,
+    and 'meta', a dictionary describing what was recorded."""
+
+    with gzip.open(path, 'rt') as file:
+        return json.load(file)
+
+
+def save_fixtures(path: str, responses: dict[str, dict], meta: dict = None) -> None:
+    """Given the path of a fixtures file, a dictionary of recorded responses and
+    optionally a description of them, this function writes them to the file."""
+
+    with gzip.open(path, 'wt') as file:
+        json.dump({'meta': meta or {}, 'responses': responses}, file, separators=(',', ':'))
+
+
+def make_response(request, status: int, body: str) -> Response:
+    """Given a request, a status code and a (JSON) body, this function returns
+    the response to the request."""
+
+    response = Response()
+    response.status_code = status
+    response._content = body.encode()
+    response.headers = CaseInsensitiveDict({'Content-Type': 'application/json'})
+    response.encoding = 'utf-8'
+    response.url = request.url
+    response.request = request
+
+    return response
+
+
+class ReplayAdapter(BaseAdapter):
+    """A transport that answers requests with recorded responses. Requests that
+    weren't recorded get a 404, like an unknown URL would."""
+
+    def __init__(self, responses: dict[str, dict]):
+        super().__init__()
+        self.responses = responses
+
+    def send(self, request, **kwargs) -> Response:
+        recorded = self.responses.get(fixture_key(request.method, request.url, request.body))
+        if recorded is None:
+            return make_response(request, 404, json.dumps({'status': 404, 'error': 'Not recorded'}))
+
+        return make_response(request, recorded['status'], recorded['body'])
+
+    def close(self) -> None:
+        pass
+
+
+class RecordingAdapter(BaseAdapter):
+    """A transport that makes requests for real (through `transport`, by default a
+    normal HTTP connection pool) and records their responses. Requests already
+    recorded are answered from the recording instead, so each is only made once and
+    recorded responses can be edited before they're replayed (e.g. trimmed)."""
+
+    def __init__(self, transport: BaseAdapter = None, responses: dict[str, dict] = None):
+        super().__init__()
+        self.transport = transport or HTTPAdapter()
+        self.responses = responses if responses is not None else {}
+        self.lock = threading.Lock()
+
+    def send(self, request, **kwargs) -> Response:
+        key = fixture_key(request.method, request.url, request.body)
+        with self.lock:
+            recorded = self.responses.get(key)
+        if recorded is not None:
+            return make_response(request, recorded['status'], recorded['body'])
+
+        response = self.transport.send(request, **kwargs)
+        # Rate limited requests and server errors are retried, so only the final answer is
+        # kept - apart from 503s, which is how the Police API turns down too large an area.
+        if response.status_code != 429 and (response.status_code < 500 or response.status_code == 503):
+            with self.lock:
+                self.responses[key] = {'status': response.status_code, 'body': response.text}
+
+        return response
+
+    def close(self) -> None:
+        self.transport.close()
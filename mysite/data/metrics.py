@@ -0,0 +1,182 @@
+'''This file contains the process's metrics - counters, and histograms of how long things take -
+and the timing of the stages of the current request (geocode, fetch, normalise, aggregate, render,
+template), which the web layer sends back as Server-Timing headers and serves at /metrics.'''
+
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+import bisect
+import threading
+import time
+
+
+# The upper bounds (in seconds) of the histograms' buckets.
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+_counters = {}
+_histograms = {}
+_lock = threading.Lock()
+
+# The current request's total seconds per stage and notes about it (None outside of a
+# request), and the stages being timed, so that a stage nested in itself isn't counted twice.
+_timings = ContextVar('timings', default=None)
+_notes = ContextVar('notes', default=None)
+_active_stages = ContextVar('active_stages', default=())
+
+
+def labels_key(labels: dict = None) -> tuple:
+    """Given a metric's labels, this function returns them as a hashable key."""
+
+    return tuple(sorted((labels or {}).items()))
+
+
+def increment(name: str, labels: dict = None, value: float = 1) -> None:
+    """Given a counter's name (and labels), this function adds the value to it."""
+
+    key = (name, labels_key(labels))
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def observe(name: str, seconds: float, labels: dict = None) -> None:
+    """Given a histogram's name (and labels) and a duration in seconds, this function
+    records the duration in the histogram."""
+
+    key = (name, labels_key(labels))
+    with _lock:
+        histogram = _histograms.setdefault(key, {'buckets': [0] * len(BUCKETS), 'count': 0, 'sum': 0.0})
+        index = bisect.bisect_left(BUCKETS, seconds)
+        if index < len(BUCKETS):
+            histogram['buckets'][index] += 1
+        histogram['count'] += 1
+        histogram['sum'] += seconds
+
+
+def get_counter(name: str, labels: dict = None) -> float:
+    """Given a counter's name (and labels), this function returns its value."""
+
+    with _lock:
+        return _counters.get((name, labels_key(labels)), 0)
+
+
+def start_timings():
+    """This function starts timing the current request's stages, returning the token
+    to pass to stop_timings."""
+
+    return _timings.set({}), _notes.set({})
+
+
+def stop_timings(token) -> dict[str, float]:
+    """Given the token from start_timings, this function stops timing the current
+    request's stages and returns the total seconds spent in each."""
+
+    timings = _timings.get()
+    _timings.reset(token[0])
+    _notes.reset(token[1])
+
+    return timings or {}
+
+
+def get_timings() -> dict[str, float]:
+    """This function returns the total seconds spent in each of the current
+    request's stages so far."""
+
+    return dict(_timings.get() or {})
+
+
+def note(name: str, value) -> None:
+    """Given a name and a value, this function notes something about the current
+    request (e.g. how many rows it used) - for the profiler's captures. Outside of
+    a request, it does nothing."""
+
+    notes = _notes.get()
+    if notes is not None:
+        notes[name] = value
+
+
+def get_notes() -> dict:
+    """This function returns what's been noted about the current request so far."""
+
+    return dict(_notes.get() or {})
+
+
+@contextmanager
+def stage(name: str):
+    """Given a stage's name, this context manager times what it wraps as that stage -
+    adding to the current request's timings and to the stage_seconds histogram."""
+
+    if name in _active_stages.get():
+        yield
+        return
+
+    token = _active_stages.set(_active_stages.get() + (name,))
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        _active_stages.reset(token)
+
+        observe('stage_seconds', seconds, {'stage': name})
+        timings = _timings.get()
+        if timings is not None:
+            timings[name] = timings.get(name, 0.0) + seconds
+
+
+def timed(name: str):
+    """Given a stage's name, this function returns a decorator that times every call
+    of the function it decorates as that stage (see stage)."""
+
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return function(*args, **kwargs)
+        return wrapper
+
+    return decorator
+
+
+def format_labels(labels: tuple, **extra) -> str:
+    """Given a metric's labels key (and any extra labels), this function returns them
+    in the Prometheus text format - e.g. '{stage="fetch"}'."""
+
+    pairs = list(labels) + list(extra.items())
+    if not pairs:
+        return ''
+
+    return '{' + ','.join(f'{label}="{str(value)}"' for label, value in pairs) + '}'
+
+
+def render_metrics(extra_counters: dict[str, float] = None) -> str:
+    """Given any counters kept elsewhere (by name), this function returns every metric
+    in the Prometheus text exposition format."""
+
+    with _lock:
+        counters = dict(_counters)
+        histograms = {key: {'buckets': list(histogram['buckets']), 'count': histogram['count'],
+                            'sum': histogram['sum']} for key, histogram in _histograms.items()}
+    for name, value in (extra_counters or {}).items():
+        counters[(name, ())] = value
+
+    lines = []
+    for name in sorted({name for name, _ in counters}):
+        lines.append(f"# TYPE {name} counter")
+        for (counter_name, labels), value in sorted(counters.items()):
+            if counter_name == name:
+                lines.append(f"{name}{format_labels(labels)} {value}")
+
+    for name in sorted({name for name, _ in histograms}):
+        lines.append(f"# TYPE {name} histogram")
+        for (histogram_name, labels), histogram in sorted(histograms.items()):
+            if histogram_name != name:
+                continue
+            cumulative = 0
+            for bound, count in zip(BUCKETS, histogram['buckets']):
+                cumulative += count
+                lines.append(f"{name}_bucket{format_labels(labels, le=bound)} {cumulative}")
+            lines.append(f"{name}_bucket{format_labels(labels, le='+Inf')} {histogram['count']}")
+            lines.append(f"{name}_sum{format_labels(labels)} {histogram['sum']}")
+            lines.append(f"{name}_count{format_labels(labels)} {histogram['count']}")
+
+    return '\n'.join(lines) + '\n'
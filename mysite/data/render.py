@@ -0,0 +1,91 @@
+'''This file contains the long-lived pool of processes that render charts, so that
+independent charts render in parallel and away from the web server's threads.'''
+
+from concurrent.futures import ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from io import BytesIO
+from multiprocessing import get_context
+from os import environ as ENV
+import os
+import threading
+
+from .metrics import timed
+from .visualise import render_png
+
+
+# Each web worker process has its own pool, so by default the CPUs are split between the
+# WEB_CONCURRENCY workers (gunicorn's setting for how many there are).
+RENDER_WORKERS = int(ENV.get('RENDER_WORKERS', max(
+    1, min(4, os.cpu_count() or 1) // int(ENV.get('WEB_CONCURRENCY', 1)))))
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+
+def warm_up() -> None:
+    """This function runs once in each render process, paying matplotlib and
+    seaborn's import and font cache costs before the first real chart."""
+
+    import matplotlib.pyplot as plt
+    from matplotlib import use
+
+    use('agg')
+    fig = plt.figure()
+    fig.text(0.5, 0.5, 'warm up', family='monospace', weight='bold')
+    fig.savefig(BytesIO())
+    plt.close(fig)
+
+
+def is_warm() -> bool:
+    """This function does nothing - it's submitted to start the render processes."""
+
+    return True
+
+
+def get_render_pool() -> ProcessPoolExecutor:
+    """This function returns the process-wide render pool, starting it on first use
+    (and again after a fork, as a forked process can't use its parent's pool).
+    Workers are spawned (not forked) so they don't inherit the web server's threads."""
+
+    global _pool, _pool_pid
+    with _pool_lock:
+        if _pool is None or _pool_pid != os.getpid():
+            _pool = ProcessPoolExecutor(max_workers=RENDER_WORKERS, mp_context=get_context('spawn'),
+                                        initializer=warm_up)
+            _pool_pid = os.getpid()
+
+    return _pool
+
+
+def warm_render_pool() -> None:
+    """This function starts all of the render processes in the background, so
+    the first page view doesn't wait for them."""
+
+    pool = get_render_pool()
+    for _ in range(RENDER_WORKERS):
+        pool.submit(is_warm)
+
+
+@timed('render')
+def render_charts(charts: dict) -> dict[str, bytes]:
+    """Given a dictionary of chart names to (plot function, keyword arguments) pairs,
+    this function renders all of the charts in parallel and returns a dictionary of
+    chart names to PNG image bytes. If the pool has broken (e.g. a render process was
+    killed) it is restarted, and the charts are rendered in this process instead."""
+
+    global _pool
+    if not charts:
+        return {}
+
+    try:
+        pool = get_render_pool()
+        futures = {chart: pool.submit(render_png, plot_function, **kwargs)
+                   for chart, (plot_function, kwargs) in charts.items()}
+        wait(futures.values())
+        return {chart: future.result() for chart, future in futures.items()}
+    except BrokenProcessPool:
+        with _pool_lock:
+            _pool = None
+        return {chart: render_png(plot_function, **kwargs)
+                for chart, (plot_function, kwargs) in charts.items()}
@@ -0,0 +1,305 @@
+'''This file contains a local stand-in for the Police and Postcode APIs, for load testing the app
+offline. It answers with recorded responses (see fixtures.py) or synthetic ones shaped like the
+real APIs', after a configurable latency, and can rate limit (429) and inject errors like the real
+APIs do. Point POLICE_BASE_URL and POSTCODE_BASE_URL at it (see the replay_server command).'''
+
+from datetime import date
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+import json
+import random
+import re
+import threading
+import time
+import zlib
+
+from requests.adapters import BaseAdapter
+from requests.models import Response
+
+from .fetch import TokenBucket
+from .fixtures import fixture_key, make_response
+from .tiles import TILE_LATITUDE, TILE_LONGITUDE
+
+
+# Synthetic crimes per tile-sized area (a busy part of London) and stop and searches per
+# 1 mile radius, each month.
+SYNTHETIC_CRIMES_PER_TILE = 400
+SYNTHETIC_STOPS = 40
+SYNTHETIC_MONTHS = 36
+
+# The API refuses areas with over 10,000 crimes (with a 503).
+MAX_CRIMES = 10000
+
+# Synthetic postcodes are placed (by a hash of the postcode) within Greater London.
+SYNTHETIC_AREA = (-0.35, 51.35, 0.15, 51.65)
+
+CRIME_CATEGORIES = ['anti-social-behaviour', 'bicycle-theft', 'burglary', 'criminal-damage-arson',
+                    'drugs', 'other-theft', 'possession-of-weapons', 'public-order', 'robbery',
+                    'shoplifting', 'theft-from-the-person', 'vehicle-crime', 'violent-crime', 'other-crime']
+CRIME_OUTCOMES = [None, 'Under investigation', 'Investigation complete; no suspect identified',
+                  'Unable to prosecute suspect', 'Awaiting court outcome']
+SS_OBJECTS = ['Controlled drugs', 'Offensive weapons', 'Stolen goods', 'Articles for use in criminal damage']
+SS_LEGISLATION = ['Misuse of Drugs Act 1971 (section 23)', 'Police and Criminal Evidence Act 1984 (section 1)',
+                  'Criminal Justice and Public Order Act 1994 (section 60)']
+SS_OUTCOMES = ['A no further action disposal', 'Arrest', 'Community resolution', 'Penalty Notice for Disorder']
+SS_AGE_RANGES = ['10-17', '18-24', '25-34', 'over 34', None]
+STREETS = [f"On or near {name} {kind}" for name in ['High', 'Church', 'Station', 'Park', 'Mill', 'Queen',
+                                                     'King', 'Victoria', 'Grove', 'Manor']
+           for kind in ['Street', 'Road', 'Lane', 'Close']]
+
+POSTCODE_PATTERN = re.compile(r'[a-z]{1,2}[0-9][a-z0-9]?([0-9][a-z]{2})?')
+
+
+def synthetic_dates(count: int = SYNTHETIC_MONTHS) -> list[tuple[int, int]]:
+    """Given a number of months, this function returns that many (year, month) pairs,
+    latest first, ending two months ago (about when the real API publishes a month)."""
+
+    today = date.today()
+    latest = today.year * 12 + today.month - 1 - 2
+
+    return [((latest - i) // 12, (latest - i) % 12 + 1) for i in range(count)]
+
+
+def synthetic_postcode_coords(postcode: str) -> tuple[float, float]:
+    """Given a postcode (or outcode), this function returns its synthetic coordinates -
+    (longitude, latitude) - or None if it doesn't look like a postcode."""
+
+    postcode = postcode.replace(" ", "").lower()
+    if POSTCODE_PATTERN.fullmatch(postcode) is None:
+        return None
+
+    west, south, east, north = SYNTHETIC_AREA
+    position = random.Random(zlib.crc32(postcode.encode()))
+
+    return (round(position.uniform(west, east), 6), round(position.uniform(south, north), 6))
+
+
+def synthetic_crimes(seed: str, year: int, month: int, latitudes: tuple[float, float],
+                     longitudes: tuple[float, float], count: int) -> list[dict]:
+    """Given a seed, a year-month, the (min, max) latitudes and longitudes of an area and
+    a number of crimes, this function returns that many crimes in the area, in the Police
+    API's format. The same arguments always give the same crimes."""
+
+    rng = random.Random(f"{seed}|{year}-{month}")
+    month_text = f"{year}-{month:02d}"
+    crimes = []
+    for _ in range(count):
+        outcome = rng.choice(CRIME_OUTCOMES)
+        crimes.append({'category': rng.choice(CRIME_CATEGORIES), 'location_type': 'Force',
+                       'location': {'latitude': f"{rng.uniform(*latitudes):.6f}",
+                                    'street': {'id': rng.randrange(10**6), 'name': rng.choice(STREETS)},
+                                    'longitude': f"{rng.uniform(*longitudes):.6f}"},
+                       'context': '', 'persistent_id': '', 'id': rng.getrandbits(40),
+                       'location_subtype': '', 'month': month_text,
+                       'outcome_status': None if outcome is None else {'category': outcome, 'date': month_text}})
+
+    return crimes
+
+
+def synthetic_stops(seed: str, year: int, month: int, coords: tuple[float, float]) -> list[dict]:
+    """Given a seed, a year-month and a location - (longitude, latitude) - this function
+    returns the stop and searches around it, in the Police API's format."""
+
+    rng = random.Random(f"{seed}|{year}-{month}")
+    stops = []
+    for _ in range(SYNTHETIC_STOPS):
+        stops.append({'age_range': rng.choice(SS_AGE_RANGES), 'outcome': rng.choice(SS_OUTCOMES),
+                      'involved_person': True, 'gender': rng.choice(['Male', 'Female']),
+                      'legislation': rng.choice(SS_LEGISLATION), 'type': 'Person search',
+                      'datetime': (f"{year}-{month:02d}-{rng.randint(1, 28):02d}T"
+                                   f"{rng.randint(0, 23):02d}:{rng.randint(0, 59):02d}:00+00:00"),
+                      'location': {'latitude': f"{coords[1] + rng.uniform(-0.01, 0.01):.6f}",
+                                   'street': {'id': rng.randrange(10**6), 'name': rng.choice(STREETS)},
+                                   'longitude': f"{coords[0] + rng.uniform(-0.015, 0.015):.6f}"},
+                      'object_of_search': rng.choice(SS_OBJECTS), 'self_defined_ethnicity': None,
+                      'officer_defined_ethnicity': None, 'operation': False, 'operation_name': None,
+                      'outcome_linked_to_object_of_search': None,
+                      'removal_of_more_than_outer_clothing': None})
+
+    return stops
+
+
+def endpoint_of(path: str) -> str:
+    """Given a request's path, this function returns the name of the API endpoint
+    it's for (e.g. 'crimes-street'), for the stats."""
+
+    for endpoint in ['crimes-street-dates', 'crimes-street', 'stops-street', 'postcodes', 'outcodes']:
+        if f"/{endpoint}" in path:
+            return endpoint
+
+    return 'other'
+
+
+class StandInAPI:
+    """Answers requests for the Police and Postcode APIs - with the recorded responses,
+    or else (if `synthetic`) synthetic ones - and keeps count of what it answered.
+    Each request waits `latency` seconds (give or take up to `jitter`), is refused with
+    a 429 beyond `rate` requests per second (with bursts of `burst`), and fails with
+    `error_status` at random `error_rate` of the time."""
+
+    def __init__(self, responses: dict[str, dict] = None, synthetic: bool = True,
+                 latency: float = 0.0, jitter: float = 0.0, rate: float = None, burst: float = None,
+                 error_rate: float = 0.0, error_status: int = 500):
+        self.responses = responses or {}
+        self.synthetic = synthetic
+        self.latency = latency
+        self.jitter = jitter
+        self.bucket = TokenBucket(rate, burst or rate) if rate else None
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.stats = {'requests': {}, 'statuses': {}, 'rate_limited': 0, 'errors_injected': 0,
+                      'recorded': 0, 'synthetic': 0}
+        self.lock = threading.Lock()
+
+    def count(self, stat: str, key=None) -> None:
+        """Given a stat (and the key within it, for the stats that are counted by
+        key), this method adds one to it."""
+
+        with self.lock:
+            if key is None:
+                self.stats[stat] += 1
+            else:
+                self.stats[stat][key] = self.stats[stat].get(key, 0) + 1
+
+    def get_stats(self) -> dict:
+        """This method returns a copy of the counts of what's been answered."""
+
+        with self.lock:
+            return json.loads(json.dumps(self.stats))
+
+    def answer(self, method: str, url: str, body: bytes = None) -> tuple[int, str]:
+        """Given a request's method, url (path and query) and body, this method returns
+        the status code and (JSON) body to answer it with."""
+
+        self.count('requests', endpoint_of(urlsplit(url).path))
+        if self.latency or self.jitter:
+            time.sleep(max(0.0, self.latency + random.uniform(-self.jitter, self.jitter)))
+
+        if self.bucket is not None and not self.bucket.try_acquire():
+            self.count('rate_limited')
+            status, text = 429, json.dumps({'status': 429, 'error': 'Too Many Requests'})
+        elif self.error_rate and random.random() < self.error_rate:
+            self.count('errors_injected')
+            status, text = self.error_status, json.dumps({'status': self.error_status, 'error': 'Injected error'})
+        elif fixture_key(method, url, body) in self.responses:
+            self.count('recorded')
+            recorded = self.responses[fixture_key(method, url, body)]
+            status, text = recorded['status'], recorded['body']
+        elif self.synthetic:
+            self.count('synthetic')
+            status, text = self.answer_synthetic(method, url, body)
+        else:
+            status, text = 404, json.dumps({'status': 404, 'error': 'Not recorded'})
+
+        self.count('statuses', str(status))
+        return status, text
+
+    def answer_synthetic(self, method: str, url: str, body: bytes = None) -> tuple[int, str]:
+        """Given a request's method, url and body, this method returns the status code and
+        body of the synthetic answer to it."""
+
+        parts = urlsplit(url)
+        params = {key: values[0] for key, values in parse_qs(parts.query).items()}
+        endpoint = endpoint_of(parts.path)
+
+        if endpoint == 'crimes-street-dates':
+            return 200, json.dumps([{'date': f"{year}-{month:02d}", 'stop-and-search': []}
+                                    for year, month in synthetic_dates()])
+
+        if endpoint in ('crimes-street', 'stops-street'):
+            try:
+                year, month = (int(part) for part in params['date'].split('-'))
+                if 'poly' in params:
+                    corners = [tuple(float(value) for value in corner.split(','))
+                               for corner in params['poly'].split(':')]
+                    latitudes = (min(corner[0] for corner in corners), max(corner[0] for corner in corners))
+                    longitudes = (min(corner[1] for corner in corners), max(corner[1] for corner in corners))
+                else:
+                    latitude, longitude = float(params['lat']), float(params['lng'])
+                    latitudes = (latitude - 0.0145, latitude + 0.0145)
+                    longitudes = (longitude - 0.023, longitude + 0.023)
+            except (KeyError, ValueError):
+                return 400, json.dumps({'status': 400, 'error': 'Bad request'})
+
+            if endpoint == 'stops-street':
+                return 200, json.dumps(synthetic_stops(parts.query, year, month,
+                                                       (sum(longitudes) / 2, sum(latitudes) / 2)))
+
+            count = round(SYNTHETIC_CRIMES_PER_TILE * (latitudes[1] - latitudes[0]) * (longitudes[1] - longitudes[0])
+                          / (TILE_LATITUDE * TILE_LONGITUDE))
+            if count > MAX_CRIMES:
+                return 503, ''
+            return 200, json.dumps(synthetic_crimes(params.get('poly', parts.query), year, month,
+                                                    latitudes, longitudes, count))
+
+        if endpoint in ('postcodes', 'outcodes') and method == 'POST':
+            postcodes = json.loads(body or b'{}').get('postcodes', [])
+            results = []
+            for postcode in postcodes:
+                coords = synthetic_postcode_coords(postcode)
+                results.append({'query': postcode, 'result': None if coords is None else
+                                {'postcode': postcode.upper(), 'longitude': coords[0], 'latitude': coords[1]}})
+            return 200, json.dumps({'status': 200, 'result': results})
+
+        if endpoint in ('postcodes', 'outcodes'):
+            coords = synthetic_postcode_coords(parts.path.rstrip('/').rsplit('/', 1)[-1])
+            if coords is None:
+                return 404, json.dumps({'status': 404, 'error': 'Invalid postcode'})
+            return 200, json.dumps({'status': 200, 'result': {'longitude': coords[0], 'latitude': coords[1]}})
+
+        return 404, json.dumps({'status': 404, 'error': 'Resource not found'})
+
+
+class StandInAdapter(BaseAdapter):
+    """A transport (see session.py) that answers requests with a stand-in API in this
+    process, without a server in between - e.g. to record fixtures for tests."""
+
+    def __init__(self, api: StandInAPI):
+        super().__init__()
+        self.api = api
+
+    def send(self, request, **kwargs) -> Response:
+        parts = urlsplit(request.url)
+        body = request.body.encode() if isinstance(request.body, str) else request.body
+        status, text = self.api.answer(request.method, parts.path + (f"?{parts.query}" if parts.query else ''), body)
+
+        return make_response(request, status, text)
+
+    def close(self) -> None:
+        pass
+
+
+def make_server(api: StandInAPI, host: str, port: int, log=None) -> ThreadingHTTPServer:
+    """Given a stand-in API, a host and a port, this function returns an HTTP server
+    (not yet serving) that answers requests with it. GET /__stats answers with the API's
+    stats. If given, log(message) is called for each request."""
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def respond(self, status: int, text: str) -> None:
+            body = text.encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == '/__stats':
+                self.respond(200, json.dumps(api.get_stats()))
+            else:
+                self.respond(*api.answer('GET', self.path))
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            self.respond(*api.answer('POST', self.path, body))
+
+        def log_message(self, format, *args):
+            if log is not None:
+                log(format % args)
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+
+    return server
@@ -0,0 +1,89 @@
+'''This file contains the functions that convert the crime and stop & search (ss) dataframes
+to a compact representation - repeated strings become categoricals (each frame with its own
+categories, so a frame's size only depends on what's in it), and numbers and dates are stored
+in the smallest types that hold them.'''
+
+import pandas as pd
+
+from .metrics import timed
+
+
+CRIME_CATEGORICAL_COLUMNS = ['category', 'street', 'outcome', 'location type']
+SS_CATEGORICAL_COLUMNS = ['age range', 'outcome', 'gender', 'legislation', 'time',
+                          'street', 'type', 'object of search']
+
+# pandas can't store datetime64[M], so dates are month starts at the coarsest unit it can.
+DATE_UNIT = 'datetime64[s]'
+
+
+def to_categorical(series: pd.Series) -> pd.Series:
+    """Given a series of strings, this function returns it as a categorical series whose
+    categories are its own (sorted) distinct values."""
+
+    return series.astype('category')
+
+
+@timed('normalise')
+def compact_crime_df(crime_df: pd.core.frame.DataFrame) -> pd.core.frame.DataFrame:
+    """Given a crime dataframe, this function returns it in the compact representation."""
+
+    if crime_df.empty:
+        return crime_df
+
+    crime_df = crime_df.copy()
+    for column in CRIME_CATEGORICAL_COLUMNS:
+        if column in crime_df.columns:
+            crime_df[column] = to_categorical(crime_df[column])
+
+    crime_df['date'] = crime_df['date'].astype(DATE_UNIT)
+
+    return crime_df
+
+
+@timed('normalise')
+def compact_ss_df(ss_df: pd.core.frame.DataFrame) -> pd.core.frame.DataFrame:
+    """Given a stop and search dataframe, this function returns it in the compact
+    representation, with the hour of each stop and search as an int8."""
+
+    if ss_df.empty:
+        return ss_df
+
+    ss_df = ss_df.copy()
+    for column in SS_CATEGORICAL_COLUMNS:
+        if column in ss_df.columns:
+            ss_df[column] = to_categorical(ss_df[column])
+
+    ss_df['hour'] = pd.to_numeric(ss_df['hour']).astype('int8')
+    ss_df['involved person'] = ss_df['involved person'].astype(bool)
+    ss_df['date'] = ss_df['date'].astype(DATE_UNIT)
+
+    return ss_df
+
+
+CATEGORICAL_COLUMNS = {'crimes': CRIME_CATEGORICAL_COLUMNS,
+                       'stop_and_searches': SS_CATEGORICAL_COLUMNS}
+
+
+def concat_compact(frames: list[pd.core.frame.DataFrame], dataset: str) -> pd.core.frame.DataFrame:
+    """Given a list of compact dataframes (or count cubes) of a dataset, this function
+    returns them as one compact dataframe. Each frame has its own categories, so columns
+    whose categories differ are re-categorised after concatenating."""
+
+    non_empty_frames = [frame for frame in frames if not frame.empty]
+    if not non_empty_frames:
+        # Keeps the columns (and their types) of an empty cube
+        return frames[0] if frames else pd.DataFrame()
+
+    df = pd.concat(non_empty_frames, ignore_index=True)
+    for column in CATEGORICAL_COLUMNS[dataset]:
+        if column in df.columns and not isinstance(df[column].dtype, pd.CategoricalDtype):
+            df[column] = to_categorical(df[column])
+
+    return df
+
+
+def frame_nbytes(df: pd.core.frame.DataFrame) -> int:
+    """Given a dataframe, this function returns how many bytes of memory it takes
+    up (including the strings its object columns point to)."""
+
+    return int(df.memory_usage(deep=True).sum())
@@ -0,0 +1,88 @@
+'''This file contains the managed HTTP session used for all requests to the Police and
+Postcode APIs, so that keep-alive connections are reused between requests.'''
+
+from os import environ as ENV
+from urllib.parse import urlsplit
+import os
+import threading
+
+import requests
+from requests.adapters import BaseAdapter, HTTPAdapter
+
+from .metrics import increment
+
+
+POOL_SIZE = int(ENV.get('HTTP_POOL_SIZE', 20))
+CONNECT_TIMEOUT = float(ENV.get('HTTP_CONNECT_TIMEOUT', 5))
+READ_TIMEOUT = float(ENV.get('HTTP_READ_TIMEOUT', 30))
+
+_session = None
+_session_pid = None
+_session_lock = threading.Lock()
+_transport = None
+
+
+def make_session() -> requests.Session:
+    """This function returns a new session, with a connection pool large enough
+    for the fetch engine's threads (or the injected transport, if there is one)."""
+
+    session = requests.Session()
+    adapter = _transport or HTTPAdapter(
+        pool_connections=4, pool_maxsize=POOL_SIZE)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+
+    return session
+
+
+def get_session() -> requests.Session:
+    """This function returns the session for the current process, creating it on
+    first use (and again after a fork, as connections can't be shared between processes)."""
+
+    global _session, _session_pid
+    with _session_lock:
+        if _session is None or _session_pid != os.getpid():
+            _session = make_session()
+            _session_pid = os.getpid()
+
+    return _session
+
+
+def set_transport(transport: BaseAdapter = None) -> None:
+    """Given a requests transport adapter, this function makes every request go
+    through it (e.g. to a local stand-in server in tests). Passing None restores the
+    default pooled HTTP transport."""
+
+    global _transport, _session
+    with _session_lock:
+        _transport = transport
+        if _session is not None:
+            _session.close()
+        _session = None
+
+
+def request(method: str, url: str, **kwargs) -> requests.Response:
+    """Given a method and a url, this function makes the request through the managed
+    session, counting it (by host and status) in the upstream_requests_total metric."""
+
+    kwargs.setdefault('timeout', (CONNECT_TIMEOUT, READ_TIMEOUT))
+
+    status = 'error'
+    try:
+        response = get_session().request(method, url, **kwargs)
+        status = str(response.status_code)
+        return response
+    finally:
+        increment('upstream_requests_total', {'host': urlsplit(url).netloc, 'status': status})
+
+
+def get(url: str, **kwargs) -> requests.Response:
+    """Given a url, this function makes a GET request through the managed session."""
+
+    return request('GET', url, **kwargs)
+
+
+def post(url: str, **kwargs) -> requests.Response:
+    """Given a url, this function makes a POST request through the managed session."""
+
+    return request('POST', url, **kwargs)
@@ -0,0 +1,179 @@
+'''This file contains the in-memory spatial index over the stored street-level crimes, which
+answers radius and nearest-street queries locally instead of asking the Police API.'''
+
+import math
+import threading
+
+import numpy as np
+import pandas as pd
+
+from .extract import street_crimes_to_columns, concat_columns
+from .store import get_dataset_version, load_month_versions, load_months
+from .tiles import distance_metres, tiles_covering, EARTH_RADIUS_METRES
+
+
+# Grid cells are about 550m square at the UK's latitudes.
+CELL_LATITUDE = 0.005
+CELL_LONGITUDE = 0.0075
+
+# Cell keys are row * KEY_ROW + column, with columns offset so that they're never negative.
+KEY_ROW = 1_000_000
+KEY_COLUMN_OFFSET = KEY_ROW // 2
+
+NEAREST_STREETS_START_RADIUS = 100
+NEAREST_STREETS_MAX_RADIUS = 5000
+
+# The index (with the store's version of the tiles it was built from), and each stored
+# tile-month's crimes as column arrays (with when it was fetched), so that the index can be
+# rebuilt after a write without parsing every stored tile-month again.
+_crime_index = None
+_crime_batches = {}
+_crime_index_lock = threading.Lock()
+
+
+def cell_keys(longitudes: np.ndarray, latitudes: np.ndarray) -> np.ndarray:
+    """Given arrays of longitudes and latitudes, this function returns the key of
+    the grid cell each point is in."""
+
+    rows = np.floor(np.asarray(latitudes) / CELL_LATITUDE).astype(np.int64)
+    columns = np.floor(np.asarray(longitudes) /
+                       CELL_LONGITUDE).astype(np.int64)
+
+    return rows * KEY_ROW + columns + KEY_COLUMN_OFFSET
+
+
+class SpatialIndex:
+    """A uniform grid over some points' coordinates. The points' rows are sorted by grid
+    cell, so the points in a row of cells are one contiguous slice found by binary search.
+    `tile_months` are the (tile, year, month)s the points came from (see tiles.py)."""
+
+    def __init__(self, columns: dict[str, np.ndarray], tile_months: set = frozenset()):
+        self.columns = columns
+        self.tile_months = set(tile_months)
+        self.longitudes = columns['longitude']
+        self.latitudes = columns['latitude']
+        self.dates = columns['date'].astype('datetime64[s]')
+
+        keys = cell_keys(self.longitudes, self.latitudes)
+        self.order = np.argsort(keys, kind='stable')
+        self.keys = keys[self.order]
+
+    def __len__(self) -> int:
+        return len(self.order)
+
+    def query_radius(self, coords: tuple[float, float], radius: float,
+                     from_date=None, to_date=None) -> tuple[np.ndarray, np.ndarray]:
+        """Given a location - (longitude, latitude) - a radius in metres and optionally a
+        date range (inclusive), this method returns the rows of the points within the radius
+        (and range), and their distances from the location."""
+
+        longitude, latitude = coords
+        latitude_radius = math.degrees(radius / EARTH_RADIUS_METRES)
+        longitude_radius = latitude_radius / math.cos(math.radians(latitude))
+
+        first_key, last_key = cell_keys([longitude - longitude_radius, longitude + longitude_radius],
+                                        [latitude - latitude_radius, latitude + latitude_radius])
+        first_row, first_column = divmod(first_key, KEY_ROW)
+        last_column = last_key % KEY_ROW
+
+        slices = []
+        for row in range(first_row, last_key // KEY_ROW + 1):
+            start = np.searchsorted(
+                self.keys, row * KEY_ROW + first_column, side='left')
+            stop = np.searchsorted(
+                self.keys, row * KEY_ROW + last_column, side='right')
+            slices.append(self.order[start:stop])
+
+        rows = np.sort(np.concatenate(slices)) if slices else np.array(
+            [], dtype=np.int64)
+
+        if from_date is not None:
+            rows = rows[self.dates[rows] >= np.datetime64(from_date, 's')]
+        if to_date is not None:
+            rows = rows[self.dates[rows] <= np.datetime64(to_date, 's')]
+
+        distances = distance_metres(
+            coords, self.longitudes[rows], self.latitudes[rows])
+        within = distances <= radius
+
+        return rows[within], distances[within]
+
+    def frame(self, rows: np.ndarray) -> pd.core.frame.DataFrame:
+        """Given some rows of the index, this method returns their points' columns as a dataframe."""
+
+        return pd.DataFrame({column: values[rows] for column, values in self.columns.items()})
+
+    def covers(self, coords: tuple[float, float], radius: float, dates: list[tuple[int, int]]) -> bool:
+        """Given a location - (longitude, latitude) - a radius in metres and a list of
+        (year, month) pairs, this method returns whether every tile overlapping the circle
+        is in the index for every one of those months."""
+
+        return all((tile, year, month) in self.tile_months
+                   for tile in tiles_covering(coords, radius) for year, month in dates)
+
+    def nearest_streets(self, coords: tuple[float, float], count: int = 5,
+                        from_date=None, to_date=None) -> pd.core.frame.DataFrame:
+        """Given a location - (longitude, latitude) - this method returns the nearest streets
+        (by their nearest point) to it, up to `count` of them within NEAREST_STREETS_MAX_RADIUS,
+        as a dataframe of street names and distances in metres."""
+
+        radius = NEAREST_STREETS_START_RADIUS
+        while True:
+            rows, distances = self.query_radius(
+                coords, radius, from_date, to_date)
+            streets = pd.DataFrame({'street': self.columns['street'][rows], 'distance': distances}).groupby(
+                'street')['distance'].min().sort_values().head(count)
+
+            # Streets outside the radius could be nearer than the last found, unless it's full.
+            if len(streets) == count or radius >= NEAREST_STREETS_MAX_RADIUS:
+                return streets.round(1).reset_index()
+            radius = min(radius * 2, NEAREST_STREETS_MAX_RADIUS)
+
+
+def update_crime_batches() -> None:
+    """This function brings the stored tile-months' crimes (see _crime_batches) up to
+    date with the store, parsing only the tile-months stored (or replaced) since the
+    last update, and forgetting those that have been deleted."""
+
+    versions = load_month_versions('crime_tiles')
+    for tile_month in set(_crime_batches) - set(versions):
+        del _crime_batches[tile_month]
+
+    changed = {}
+    for (tile, year, month), fetched_at in versions.items():
+        if _crime_batches.get((tile, year, month), (None,))[0] != fetched_at:
+            changed.setdefault(tile, []).append((year, month))
+
+    for tile, dates in changed.items():
+        for (year, month), crime_data in load_months('crime_tiles', tile, dates).items():
+            _crime_batches[(tile, year, month)] = (versions[(tile, year, month)],
+                                                   street_crimes_to_columns(crime_data, year, month))
+
+
+def build_crime_index(batches: dict) -> SpatialIndex:
+    """Given the stored tile-months' crimes (see _crime_batches), this function returns a
+    spatial index over all of them, with each crime (by id and month) only once."""
+
+    columns = (concat_columns([batch for _, batch in batches.values()])
+               or street_crimes_to_columns([], 2000, 1))
+
+    # The same crime can be on the edge of two tiles
+    first_rows = np.flatnonzero(~pd.DataFrame({'id': columns['id'], 'date': columns['date']}).duplicated().values)
+
+    return SpatialIndex({column: values[first_rows] for column, values in columns.items()}, set(batches))
+
+
+def get_crime_index() -> SpatialIndex:
+    """This function returns the process-wide spatial index over the stored crimes,
+    rebuilding it first if anything has been stored since it was built. Only the
+    tile-months that have changed are read from the store (see update_crime_batches)."""
+
+    global _crime_index
+    version = get_dataset_version('crime_tiles')
+
+    with _crime_index_lock:
+        if _crime_index is None or _crime_index[0] != version:
+            update_crime_batches()
+            _crime_index = (version, build_crime_index(_crime_batches))
+
+        return _crime_index[1]
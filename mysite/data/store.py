@@ -0,0 +1,359 @@
+'''This file contains all of the functions related to the persistent storage of the data
+extracted from the Police API, kept in the project's SQLite database.'''
+
+from datetime import datetime
+from os import environ as ENV
+from pathlib import Path
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+
+
+DEFAULT_STORE_PATH = Path(__file__).resolve().parent.parent / 'db.sqlite3'
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS api_months (
+    dataset TEXT NOT NULL,
+    latitude REAL NOT NULL,
+    longitude REAL NOT NULL,
+    year INTEGER NOT NULL,
+    month INTEGER NOT NULL,
+    payload BLOB NOT NULL,
+    fetched_at TEXT NOT NULL,
+    PRIMARY KEY (dataset, latitude, longitude, year, month)
+);
+CREATE TABLE IF NOT EXISTS postcode_coords (
+    postcode TEXT PRIMARY KEY,
+    longitude REAL NOT NULL,
+    latitude REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS tracked_postcodes (
+    dataset TEXT NOT NULL,
+    postcode TEXT NOT NULL,
+    latest_year INTEGER NOT NULL,
+    latest_month INTEGER NOT NULL,
+    PRIMARY KEY (dataset, postcode)
+);
+CREATE TABLE IF NOT EXISTS jobs (
+    name TEXT PRIMARY KEY,
+    status TEXT NOT NULL,
+    done INTEGER NOT NULL,
+    total INTEGER NOT NULL,
+    error TEXT,
+    updated_at REAL NOT NULL,
+    pid INTEGER,
+    heartbeat_at REAL
+);
+CREATE TABLE IF NOT EXISTS locks (
+    name TEXT PRIMARY KEY,
+    owner TEXT NOT NULL,
+    expires_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS rate_limits (
+    name TEXT PRIMARY KEY,
+    tokens REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+'''
+
+_local = threading.local()
+
+
+class MonthsNotStored(LookupError):
+    """Raised when months that should only be read from the store aren't stored."""
+
+
+def get_connection() -> sqlite3.Connection:
+    """This function returns a connection to the store database, reused by
+    the current thread (and reopened after a fork, or if DATA_STORE_PATH changes)."""
+
+    path = str(ENV.get('DATA_STORE_PATH', DEFAULT_STORE_PATH))
+    connection = getattr(_local, 'connection', None)
+    if connection is not None and _local.pid == os.getpid():
+        if _local.path == path:
+            return connection
+        connection.close()
+
+    connection = sqlite3.connect(path, timeout=30, isolation_level=None)
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.executescript(SCHEMA)
+    # Stores made before jobs had owners and heartbeats
+    job_columns = {row[1] for row in connection.execute('PRAGMA table_info(jobs)')}
+    for column, column_type in [('pid', 'INTEGER'), ('heartbeat_at', 'REAL')]:
+        if column not in job_columns:
+            connection.execute(f'ALTER TABLE jobs ADD COLUMN {column} {column_type}')
+
+    _local.connection = connection
+    _local.pid = os.getpid()
+    _local.path = path
+    return connection
+
+
+def coords_key(coords: tuple[float, float]) -> tuple[float, float]:
+    """Given a location - (longitude, latitude) - this function returns the
+    (latitude, longitude) pair used to key the store, rounded to postcodes.io's precision."""
+
+    return (round(coords[1], 6), round(coords[0], 6))
+
+
+def load_months(dataset: str, coords: tuple[float, float], dates: list[tuple[int, int]]) -> dict[tuple[int, int], list[dict]]:
+    """Given a dataset, location and list of (year, month) pairs, this function
+    returns the stored API responses for those months, keyed by (year, month).
+    Months that haven't been stored are left out."""
+
+    latitude, longitude = coords_key(coords)
+    dates = set(dates)
+    if not dates:
+        return {}
+
+    rows = get_connection().execute(
+        'SELECT year, month, payload FROM api_months WHERE dataset = ? AND latitude = ? AND longitude = ?',
+        (dataset, latitude, longitude))
+
+    return {(year, month): json.loads(zlib.decompress(payload))
+            for year, month, payload in rows if (year, month) in dates}
+
+
+def save_month(dataset: str, coords: tuple[float, float], year: int, month: int, data: list[dict]) -> None:
+    """Given a dataset, location, year-month and the API's response for it,
+    this function writes (or overwrites) the response in the store."""
+
+    latitude, longitude = coords_key(coords)
+
+    get_connection().execute(
+        'INSERT OR REPLACE INTO api_months VALUES (?, ?, ?, ?, ?, ?, ?)',
+        (dataset, latitude, longitude, year, month,
+         zlib.compress(json.dumps(data).encode()), datetime.now().isoformat()))
+
+
+def load_month_versions(dataset: str) -> dict[tuple[tuple[float, float], int, int], str]:
+    """Given a dataset, this function returns when each of its stored months was fetched,
+    keyed by (location, year, month), where the location is (longitude, latitude)."""
+
+    rows = get_connection().execute(
+        'SELECT latitude, longitude, year, month, fetched_at FROM api_months WHERE dataset = ?', (dataset,))
+
+    return {((longitude, latitude), year, month): fetched_at
+            for latitude, longitude, year, month, fetched_at in rows}
+
+
+def load_stored_dates(dataset: str, coords: tuple[float, float]) -> set[tuple[int, int]]:
+    """Given a dataset and a location, this function returns the (year, month) pairs
+    stored for the location, without reading their data."""
+
+    latitude, longitude = coords_key(coords)
+    rows = get_connection().execute(
+        'SELECT year, month FROM api_months WHERE dataset = ? AND latitude = ? AND longitude = ?',
+        (dataset, latitude, longitude))
+
+    return set(rows)
+
+
+def delete_months(dataset: str) -> None:
+    """Given a dataset, this function deletes every stored API response of it."""
+
+    get_connection().execute('DELETE FROM api_months WHERE dataset = ?', (dataset,))
+
+
+def get_dataset_version(dataset: str) -> tuple[int, str]:
+    """Given a dataset, this function returns the number of stored months of it and
+    when the last was fetched - which change whenever anything is stored."""
+
+    return tuple(get_connection().execute(
+        'SELECT COUNT(*), MAX(fetched_at) FROM api_months WHERE dataset = ?', (dataset,)).fetchone())
+
+
+def load_postcode_coords(postcodes: list[str]) -> dict[str, tuple[float, float]]:
+    """Given a list of normalised postcodes, this function returns the stored
+    coordinates - (longitude, latitude) - of those that have been geocoded before."""
+
+    postcodes = list(postcodes)
+    coords = {}
+    for i in range(0, len(postcodes), 500):
+        chunk = postcodes[i:i+500]
+        rows = get_connection().execute(
+            f'SELECT postcode, longitude, latitude FROM postcode_coords WHERE postcode IN ({", ".join("?" * len(chunk))})',
+            chunk)
+        coords.update({postcode: (longitude, latitude)
+                      for postcode, longitude, latitude in rows})
+
+    return coords
+
+
+def save_postcode_coords(coords: dict[str, tuple[float, float]]) -> None:
+    """Given a dictionary of normalised postcodes to coordinates - (longitude, latitude),
+    this function writes them to the store."""
+
+    get_connection().executemany(
+        'INSERT OR REPLACE INTO postcode_coords VALUES (?, ?, ?)',
+        [(postcode, longitude, latitude) for postcode, (longitude, latitude) in coords.items()])
+
+
+def acquire_lock(name: str, owner: str, timeout: float) -> bool:
+    """Given a lock name, an owner id and a timeout (in seconds), this function
+    takes the named lock for the owner if nobody else holds it (or their hold has
+    expired) and returns whether it was taken. The lock works across processes."""
+
+    connection = get_connection()
+    now = time.time()
+
+    connection.execute('BEGIN IMMEDIATE')
+    try:
+        connection.execute(
+            'DELETE FROM locks WHERE name = ? AND expires_at < ?', (name, now))
+        acquired = connection.execute(
+            'INSERT OR IGNORE INTO locks VALUES (?, ?, ?)', (name, owner, now + timeout)).rowcount == 1
+        connection.execute('COMMIT')
+    except Exception:
+        connection.execute('ROLLBACK')
+        raise
+
+    return acquired
+
+
+def is_locked(name: str) -> bool:
+    """Given a lock name, this function returns whether anybody currently holds it."""
+
+    return get_connection().execute(
+        'SELECT 1 FROM locks WHERE name = ? AND expires_at >= ?', (name, time.time())).fetchone() is not None
+
+
+def release_lock(name: str, owner: str) -> None:
+    """Given a lock name and an owner id, this function releases the owner's hold on the lock."""
+
+    get_connection().execute(
+        'DELETE FROM locks WHERE name = ? AND owner = ?', (name, owner))
+
+
+def take_token(name: str, rate: float, capacity: float) -> float:
+    """Given a rate limit's name, its rate (tokens per second) and capacity, this function
+    takes a token from the named token bucket if one is available and returns 0, or else
+    returns how many seconds until one will be. The bucket works across processes."""
+
+    connection = get_connection()
+    now = time.time()
+
+    connection.execute('BEGIN IMMEDIATE')
+    try:
+        row = connection.execute(
+            'SELECT tokens, updated_at FROM rate_limits WHERE name = ?', (name,)).fetchone()
+        tokens = capacity if row is None else min(capacity, row[0] + max(0.0, now - row[1]) * rate)
+
+        wait = 0.0 if tokens >= 1 else (1 - tokens) / rate
+        if not wait:
+            tokens -= 1
+
+        connection.execute(
+            'INSERT OR REPLACE INTO rate_limits VALUES (?, ?, ?)', (name, tokens, now))
+        connection.execute('COMMIT')
+    except Exception:
+        connection.execute('ROLLBACK')
+        raise
+
+    return wait
+
+
+def track_postcode(dataset: str, postcode: str, latest_date: tuple[int, int]) -> None:
+    """Given a dataset, a normalised postcode and the latest (year, month) its data
+    has been loaded up to, this function records it, so that the postcode is kept up
+    to date as new months are published."""
+
+    get_connection().execute(
+        'INSERT OR REPLACE INTO tracked_postcodes VALUES (?, ?, ?, ?)', (dataset, postcode, *latest_date))
+
+
+def get_tracked_postcodes() -> list[tuple[str, str, tuple[int, int]]]:
+    """This function returns every tracked postcode as (dataset, postcode, (year, month)),
+    where (year, month) is the latest month its data has been loaded up to."""
+
+    rows = get_connection().execute(
+        'SELECT dataset, postcode, latest_year, latest_month FROM tracked_postcodes ORDER BY dataset, postcode')
+
+    return [(dataset, postcode, (year, month)) for dataset, postcode, year, month in rows]
+
+
+def is_process_alive(pid: int) -> bool:
+    """Given a process id (on this machine, like the store), this function returns
+    whether the process is still running."""
+
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+
+    return True
+
+
+def create_job(name: str, stale_after: float, heartbeat_timeout: float) -> bool:
+    """Given a job name, how many seconds without an update make a job stale and how many
+    without a heartbeat (see beat_jobs) make it dead, this function queues the named job
+    for this process - unless it's already queued or running (and not stale, dead or owned
+    by a process that's gone) - and returns whether it was queued. The queue works across
+    processes."""
+
+    connection = get_connection()
+    now = time.time()
+
+    connection.execute('BEGIN IMMEDIATE')
+    try:
+        job = connection.execute(
+            'SELECT status, updated_at, pid, heartbeat_at FROM jobs WHERE name = ?', (name,)).fetchone()
+        if job is not None:
+            status, updated_at, pid, heartbeat_at = job
+            if (status not in ('queued', 'running') or updated_at < now - stale_after
+                    or (heartbeat_at or updated_at) < now - heartbeat_timeout
+                    or (pid is not None and not is_process_alive(pid))):
+                connection.execute('DELETE FROM jobs WHERE name = ?', (name,))
+        created = connection.execute(
+            "INSERT OR IGNORE INTO jobs (name, status, done, total, error, updated_at, pid, heartbeat_at) "
+            "VALUES (?, 'queued', 0, 0, NULL, ?, ?, ?)", (name, now, os.getpid(), now)).rowcount == 1
+        connection.execute('COMMIT')
+    except Exception:
+        connection.execute('ROLLBACK')
+        raise
+
+    return created
+
+
+def update_job(name: str, status: str, done: int = 0, total: int = 0, error: str = None) -> None:
+    """Given a job name, its status ('queued', 'running', 'done' or 'failed'), its
+    progress and any error, this function records them (as the job of this process)."""
+
+    now = time.time()
+    get_connection().execute(
+        'INSERT OR REPLACE INTO jobs (name, status, done, total, error, updated_at, pid, heartbeat_at) '
+        'VALUES (?, ?, ?, ?, ?, ?, ?, ?)', (name, status, done, total, error, now, os.getpid(), now))
+
+
+def beat_jobs(names: list[str]) -> None:
+    """Given the names of the jobs this process is running (or has queued), this function
+    records that the process is still working on them."""
+
+    get_connection().executemany(
+        "UPDATE jobs SET heartbeat_at = ? WHERE name = ? AND pid = ? AND status IN ('queued', 'running')",
+        [(time.time(), name, os.getpid()) for name in names])
+
+
+def load_job(name: str) -> dict:
+    """Given a job name, this function returns its status, progress ('done' out of
+    'total'), error, last update time, owning process and last heartbeat as a dictionary,
+    or None if there's no such job."""
+
+    row = get_connection().execute(
+        'SELECT status, done, total, error, updated_at, pid, heartbeat_at FROM jobs WHERE name = ?',
+        (name,)).fetchone()
+    if row is None:
+        return None
+
+    return dict(zip(['status', 'done', 'total', 'error', 'updated_at', 'pid', 'heartbeat_at'], row))
+
+
+def delete_job(name: str) -> None:
+    """Given a job name, this function forgets the job."""
+
+    get_connection().execute('DELETE FROM jobs WHERE name = ?', (name,))
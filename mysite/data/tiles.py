@@ -0,0 +1,191 @@
+'''This file contains the functions that fetch street-level crimes by fixed geographic tiles
+(rather than by each postcode's radius), so that nearby postcodes share the same API calls
+and stored data.'''
+
+import math
+import threading
+
+import numpy as np
+
+from . import session
+from .extract import APIError, POLICE_BASE_URL, street_crimes_to_columns, concat_columns
+from .fetch import fetch_many, fetch_with_retries, police_api_bucket, SharedTokenBucket, TokenBucket
+from .store import load_months, save_month, MonthsNotStored
+
+
+# Tiles are about 2.2km x 2.1km at the UK's latitudes - 4 to 9 of them cover a postcode's radius.
+TILE_LATITUDE = 0.02
+TILE_LONGITUDE = 0.03
+
+# The radius the Police API uses for a point's street-level crimes (1 mile).
+RADIUS_METRES = 1609.344
+EARTH_RADIUS_METRES = 6371008.8
+
+# The API refuses areas with over 10,000 crimes (with a 503), so busy tiles are split
+# into quarters, up to this many times - once a 503 has been retried this many times.
+MAX_TILE_SPLITS = 3
+BUSY_TILE_RETRIES = 1
+
+
+def distance_metres(coords: tuple[float, float], longitudes: np.ndarray, latitudes: np.ndarray) -> np.ndarray:
+    """Given a location - (longitude, latitude) - and arrays of longitudes and latitudes,
+    this function returns the distance (in metres) from the location to each point."""
+
+    longitude, latitude = np.radians(coords[0]), np.radians(coords[1])
+    longitudes, latitudes = np.radians(longitudes), np.radians(latitudes)
+
+    a = (np.sin((latitudes - latitude) / 2) ** 2
+         + np.cos(latitude) * np.cos(latitudes) * np.sin((longitudes - longitude) / 2) ** 2)
+
+    return 2 * EARTH_RADIUS_METRES * np.arcsin(np.sqrt(a))
+
+
+def tiles_of(longitudes: np.ndarray, latitudes: np.ndarray) -> list[tuple[float, float]]:
+    """Given arrays of longitudes and latitudes, this function returns the tile each
+    point is in, given by its south-west corner - (longitude, latitude)."""
+
+    columns = np.floor(np.asarray(longitudes) / TILE_LONGITUDE).astype(np.int64)
+    rows = np.floor(np.asarray(latitudes) / TILE_LATITUDE).astype(np.int64)
+
+    tiles, tile_indices = np.unique(np.stack([columns, rows]), axis=1, return_inverse=True)
+    tiles = [(round(j * TILE_LONGITUDE, 6), round(i * TILE_LATITUDE, 6)) for j, i in tiles.T.tolist()]
+
+    return [tiles[index] for index in tile_indices.ravel()]
+
+
+def tiles_covering(coords: tuple[float, float], radius: float = RADIUS_METRES) -> list[tuple[float, float]]:
+    """Given a location - (longitude, latitude) - and a radius in metres, this function
+    returns the tiles that overlap the circle around the location, each given by its
+    south-west corner - (longitude, latitude)."""
+
+    longitude, latitude = coords
+    latitude_radius = math.degrees(radius / EARTH_RADIUS_METRES)
+    longitude_radius = latitude_radius / math.cos(math.radians(latitude))
+
+    tiles = []
+    for i in range(math.floor((latitude - latitude_radius) / TILE_LATITUDE),
+                   math.floor((latitude + latitude_radius) / TILE_LATITUDE) + 1):
+        for j in range(math.floor((longitude - longitude_radius) / TILE_LONGITUDE),
+                       math.floor((longitude + longitude_radius) / TILE_LONGITUDE) + 1):
+            tile = (round(j * TILE_LONGITUDE, 6), round(i * TILE_LATITUDE, 6))
+
+            # The tile's nearest point to the location
+            nearest_longitude = min(max(longitude, tile[0]), tile[0] + TILE_LONGITUDE)
+            nearest_latitude = min(max(latitude, tile[1]), tile[1] + TILE_LATITUDE)
+            if distance_metres(coords, nearest_longitude, nearest_latitude) <= radius:
+                tiles.append(tile)
+
+    return tiles
+
+
+def tile_poly(tile: tuple[float, float], longitude_size: float, latitude_size: float) -> str:
+    """Given a tile's south-west corner - (longitude, latitude) - and size in degrees,
+    this function returns it in the Police API's poly format (lat,lng:lat,lng:...)."""
+
+    longitude, latitude = tile
+    corners = [(latitude, longitude), (latitude + latitude_size, longitude),
+               (latitude + latitude_size, longitude + longitude_size), (latitude, longitude + longitude_size)]
+
+    return ':'.join(f"{corner_latitude:.6f},{corner_longitude:.6f}" for corner_latitude, corner_longitude in corners)
+
+
+def get_tile_crimes_data(tile: tuple[float, float], year: int, month: int,
+                         longitude_size: float = TILE_LONGITUDE, latitude_size: float = TILE_LATITUDE) -> list[dict]:
+    """Given a tile's south-west corner - (longitude, latitude) - and size in degrees,
+    this function returns data of the street-level crimes within it, for a specific
+    year-month."""
+
+    crime_data = session.get(POLICE_BASE_URL+"/crimes-street/all-crime",
+                             params={'poly': tile_poly(tile, longitude_size, latitude_size),
+                                     'date': f"{year}-{month}"})
+
+    if crime_data.status_code != 200:
+        raise APIError(crime_data.status_code)
+
+    return crime_data.json()
+
+
+def fetch_splitting_busy_tiles(fetch_function, args: tuple, stats: dict, stats_lock: threading.Lock,
+                               bucket: TokenBucket | SharedTokenBucket = police_api_bucket,
+                               splits: int = 0) -> list[dict]:
+    """Given get_tile_crimes_data and its arguments - (tile, year, month[, longitude size,
+    latitude size]) - this function calls it with fetch_with_retries (see fetch_many's fetcher).
+    A tile that's still refused with a 503 when retried is fetched as quarters instead, each
+    with its own retries, up to MAX_TILE_SPLITS times. The quarters are fetched one at a time,
+    so a failing API gives up after a few requests rather than fetching every quarter."""
+
+    tile, year, month, *size = args
+    longitude_size, latitude_size = size or (TILE_LONGITUDE, TILE_LATITUDE)
+
+    try:
+        return fetch_with_retries(fetch_function, (tile, year, month, longitude_size, latitude_size),
+                                  stats, stats_lock, bucket, status_retries={503: BUSY_TILE_RETRIES})
+    except APIError as e:
+        if e.status_code != 503 or splits >= MAX_TILE_SPLITS:
+            raise
+
+    quarters = [(tile[0] + i * longitude_size / 2, tile[1] + j * latitude_size / 2)
+                for i in range(2) for j in range(2)]
+    data = []
+    for quarter in quarters:
+        data += fetch_splitting_busy_tiles(fetch_function,
+                                           (quarter, year, month, longitude_size / 2, latitude_size / 2),
+                                           stats, stats_lock, bucket, splits + 1)
+
+    return data
+
+
+def get_stored_tiles_data(tiles: list[tuple[float, float]], dates: list[tuple[int, int]],
+                          progress=None, fetch: bool = True) -> dict[tuple[int, int], list[dict]]:
+    """Given a list of tiles and of (year, month) pairs, this function returns the API's
+    crime data for every tile in each month, keyed by (year, month). Tile-months already
+    in the store are read from it; the rest are fetched (all at once) and stored - or, if
+    fetch is False, MonthsNotStored is raised. If given, progress(tile-months done, total
+    tile-months) is called as they're loaded."""
+
+    tiles_data = {tile: load_months('crime_tiles', tile, dates) for tile in tiles}
+    missing = [(tile, year, month) for tile in tiles for year, month in dates
+               if (year, month) not in tiles_data[tile]]
+    if missing and not fetch:
+        raise MonthsNotStored(f"{len(missing)} tile-months of crimes aren't stored.")
+
+    total = len(tiles) * len(dates)
+    stored_count = total - len(missing)
+    if progress is not None:
+        progress(stored_count, total)
+
+    fetched_data, _ = fetch_many(
+        get_tile_crimes_data, missing, fetcher=fetch_splitting_busy_tiles,
+        progress=None if progress is None else lambda done, _: progress(stored_count + done, total))
+
+    for (tile, year, month), data in zip(missing, fetched_data):
+        save_month('crime_tiles', tile, year, month, data)
+        tiles_data[tile][(year, month)] = data
+
+    return {(year, month): [crime for tile in tiles for crime in tiles_data[tile][(year, month)]]
+            for year, month in dates}
+
+
+def get_crime_columns_around(coords: tuple[float, float], dates: list[tuple[int, int]],
+                             radius: float = RADIUS_METRES, progress=None, fetch: bool = True) -> dict[str, np.ndarray]:
+    """Given a location - (longitude, latitude) - a list of (year, month) pairs and a radius
+    in metres, this function returns the crimes within the radius in those months as typed
+    column arrays (see street_crimes_to_columns), assembled from the tiles covering it.
+    Crimes on the edge of two tiles are only counted once (by id). Missing tile-months are
+    fetched unless fetch is False (see get_stored_tiles_data)."""
+
+    months_data = get_stored_tiles_data(
+        tiles_covering(coords, radius), dates, progress, fetch)
+
+    batches = []
+    for (year, month), crime_data in months_data.items():
+        columns = street_crimes_to_columns(crime_data, year, month)
+
+        _, first_indices = np.unique(columns['id'], return_index=True)
+        keep = np.sort(first_indices)
+        keep = keep[distance_metres(coords, columns['longitude'][keep],
+                                    columns['latitude'][keep]) <= radius]
+
+        batches.append({column: values[keep] for column, values in columns.items()})
+
+    return concat_columns(batches)
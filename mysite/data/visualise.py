@@ -1,5 +1,7 @@
 '''This file contains all of the functions that produce visualisations from the extracted data.'''
 
+from io import BytesIO
+
 import seaborn as sns
 import pandas as pd
 import matplotlib.pyplot as plt
@@ -29,6 +31,7 @@ def plot_bar(df: pd.core.frame.DataFrame, file_path: str) -> None:
     plt.title(
         f'Number of Crimes by {df.columns[0].title()}', fontdict=font_dict)
     plt.savefig(file_path, bbox_inches='tight')
+    plt.close()
 
 
 def plot_crimes_with_time_line_graph(df: pd.core.frame.DataFrame, file_path: str) -> None:
@@ -55,6 +58,27 @@ def plot_crimes_with_time_line_graph(df: pd.core.frame.DataFrame, file_path: str
     plt.title(
         f'Number of Crimes by {df.columns[0].title()}', fontdict=font_dict)
     plt.savefig(file_path, bbox_inches='tight')
+    plt.close()
+
+
+def plot_no_data(title: str, file_path: str) -> None:
+    """This function produces an empty chart with the inputted title, saying that there's
+    nothing to show (e.g. a postcode with no stop and searches). The function saves the
+    image to the inputted filepath."""
+
+    font_dict = {'weight': 'bold', 'size': 12,  'color': 'black'}
+
+    use('agg')
+    fig = plt.figure(facecolor='#222629')
+    ax = fig.add_subplot()
+    ax.set_facecolor('#273744')
+    ax.set_xticks([])
+    ax.set_yticks([])
+    ax.text(0.5, 0.5, 'No data for this period', ha='center', va='center',
+            fontdict=font_dict, transform=ax.transAxes)
+    plt.title(title, fontdict=font_dict)
+    plt.savefig(file_path, bbox_inches='tight')
+    plt.close()
 
 
 def object_of_search_bar_chart(df: pd.core.frame.DataFrame, file_path: str, third_var=None):
@@ -65,10 +89,17 @@ def object_of_search_bar_chart(df: pd.core.frame.DataFrame, file_path: str, thir
 
     use('agg')
 
-    if third_var is None:
+    if third_var is not None and third_var not in ["age range", "gender", "outcome"]:
+        raise ValueError(
+            "The only valid third variables are 'age range', 'gender' or 'outcome'.")
+
+    if df['count'].sum() == 0:
+        plot_no_data('Number of Stop and Searches by Object of Search', file_path)
+
+    elif third_var is None:
 
-        grouped_df = df.groupby(
-            ['object of search']).size()
+        grouped_df = counting_by_category(
+            df, ['object of search'])['object of search']
 
         font_dict = {'weight': 'bold', 'size': 12,  'color': 'black'}
         sns.set_theme(palette='deep', font='monospace')
@@ -85,11 +116,12 @@ def object_of_search_bar_chart(df: pd.core.frame.DataFrame, file_path: str, thir
                   fontdict=font_dict)
         plt.tight_layout()
         plt.savefig(file_path, bbox_inches='tight')
+        plt.close()
 
-    elif third_var in ["age range", "gender", "outcome"]:
+    else:
 
-        df = df.groupby(
-            ['object of search', third_var]).size().unstack(fill_value=0)
+        df = counting_by_category(
+            df, ['object of search', third_var])['object of search'].unstack(fill_value=0)
 
         font_dict = {'weight': 'bold', 'size': 12,  'color': 'black'}
         sns.set_theme(palette='deep', font='monospace')
@@ -107,10 +139,7 @@ def object_of_search_bar_chart(df: pd.core.frame.DataFrame, file_path: str, thir
         plt.legend(title=third_var.title())
         plt.tight_layout()
         plt.savefig(file_path, bbox_inches='tight')
-
-    else:
-        raise ValueError(
-            "The only valid third variables are 'age range', 'gender' or 'outcome'.")
+        plt.close()
 
 
 def stop_and_search_pie_chart(df: pd.core.frame.DataFrame, category: str, loc: str, file_path: str):
@@ -118,6 +147,10 @@ def stop_and_search_pie_chart(df: pd.core.frame.DataFrame, category: str, loc: s
     based on a particular category (e.g. 'age range', 'legislation', etc)."""
 
     use('agg')
+    if df['count'].sum() == 0:
+        plot_no_data(f'Stop and Searches by {category.title()}', file_path)
+        return
+
     grouped_df = counting_by_category(df, [category])
 
     font_dict = {'weight': 'bold', 'size': 12,  'color': 'black'}
@@ -129,6 +162,39 @@ def stop_and_search_pie_chart(df: pd.core.frame.DataFrame, category: str, loc: s
     plt.title(
         f'Stop and Searches by {category.title()}', fontdict=font_dict)
     plt.savefig(file_path, bbox_inches='tight')
+    plt.close()
+
+
+def stop_and_search_hour_bar_chart(df: pd.core.frame.DataFrame, file_path: str) -> None:
+    """This function produces a bar chart of the number of stop and searches by
+    hour of the day, based on the inputted dataframe of counts by hour. The
+    function saves the image to the inputted filepath."""
+
+    use('agg')
+    font_dict = {'weight': 'bold', 'size': 12,  'color': 'black'}
+    sns.set_theme(palette='deep', font='monospace')
+    fig = plt.figure(facecolor='#222629', figsize=(14, 6))
+    ax = fig.add_subplot()
+    ax.set_facecolor('#273744')
+    ax.tick_params(axis='x', colors='black')
+    ax.tick_params(axis='y', colors='black')
+    sns.barplot(x=df.index,
+                y=df[df.columns[0]], width=0.5)
+    plt.ylabel('Number of Stop and Searches', fontdict=font_dict)
+    plt.xlabel(df.columns[0].title(), fontdict=font_dict)
+    plt.title("Stop and Searches by Hour", fontdict=font_dict)
+    plt.savefig(file_path, bbox_inches='tight')
+    plt.close()
+
+
+def render_png(plot_function, *args, **kwargs) -> bytes:
+    """Given one of the plotting functions above and its arguments (apart from
+    the file path), this function returns the chart as PNG image bytes."""
+
+    buffer = BytesIO()
+    plot_function(*args, file_path=buffer, **kwargs)
+
+    return buffer.getvalue()
 
 
 '''
@@ -0,0 +1,48 @@
+'''This file contains the helper functions shared by the JSON API views.'''
+
+from datetime import datetime
+from hashlib import sha1
+import json
+
+from django.http import HttpResponse, HttpResponseNotModified
+
+
+def parse_date_range(request, default_from: str = "2022-01-01") -> tuple[datetime, datetime]:
+    """Given a request, this function returns the date range given by its 'from'
+    and 'to' query parameters (YYYY-MM-DD), defaulting to everything up to today."""
+
+    from_date = datetime.strptime(
+        request.GET.get('from', default_from), "%Y-%m-%d")
+    to_date = datetime.strptime(request.GET.get(
+        'to', datetime.today().strftime('%Y-%m-%d')), "%Y-%m-%d")
+
+    return from_date, to_date
+
+
+def etag_json_response(request, data: dict, status: int = 200) -> HttpResponse:
+    """Given a request and some data, this function returns the data as compact
+    JSON with an ETag - or an empty 304 response if the client already has it."""
+
+    body = json.dumps(data, separators=(',', ':'))
+    etag = f'"{sha1(body.encode()).hexdigest()}"'
+
+    if etag in request.headers.get('If-None-Match', ''):
+        response = HttpResponseNotModified()
+    else:
+        response = HttpResponse(
+            body, content_type='application/json', status=status)
+
+    response['ETag'] = etag
+    return response
+
+
+def parse_location(request) -> tuple[float, float]:
+    """Given a request, this function returns the location given by its 'lng' and
+    'lat' query parameters - (longitude, latitude)."""
+
+    longitude = float(request.GET['lng'])
+    latitude = float(request.GET['lat'])
+    if not (-180 <= longitude <= 180 and -90 <= latitude <= 90):
+        raise ValueError("The location must be a valid longitude and latitude.")
+
+    return longitude, latitude
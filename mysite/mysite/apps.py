@@ -0,0 +1,38 @@
+import os
+import threading
+
+from django.apps import AppConfig
+from django.conf import settings
+from django.core.signals import request_started
+
+
+_started_pid = None
+_started_lock = threading.Lock()
+
+
+def start_background_work(**kwargs) -> None:
+    """This function starts the chart render processes and the refresher of the tracked
+    postcodes in the current process, the first time it's run there. It's run as each
+    request starts, so that they're only started in processes that serve requests -
+    after any fork (e.g. gunicorn's --preload) - and not for management commands."""
+
+    global _started_pid
+    if not settings.START_BACKGROUND_WORK or _started_pid == os.getpid():
+        return
+
+    from data.render import warm_render_pool
+    from .datasets import start_refresher
+
+    with _started_lock:
+        if _started_pid != os.getpid():
+            warm_render_pool()
+            start_refresher()
+            _started_pid = os.getpid()
+
+
+class MysiteConfig(AppConfig):
+    default_auto_field = 'django.db.models.BigAutoField'
+    name = 'mysite'
+
+    def ready(self):
+        request_started.connect(start_background_work, dispatch_uid='start_background_work')
@@ -0,0 +1,98 @@
+'''This file contains the functions for the cache of rendered chart images, which are
+stored on disk under a hash of everything that determines how they look.'''
+
+from hashlib import sha256
+import json
+import os
+
+from django.conf import settings
+from django.urls import reverse
+
+from data.metrics import increment
+from data.render import render_charts
+
+
+def chart_key(dataset: str, postcode: str, from_date: str, to_date: str, chart: str,
+              third_var: str = None, version=None) -> str:
+    """Given everything that determines how a chart looks, this function returns
+    the hash that the chart's image is stored under. The version should change
+    whenever the underlying data does (e.g. the dataframe's number of rows)."""
+
+    spec = [dataset, postcode, str(from_date), str(to_date),
+            chart, third_var, str(version)]
+
+    return sha256(json.dumps(spec).encode()).hexdigest()
+
+
+def chart_path(key: str) -> str:
+    """Given a chart's hash, this function returns the path of its image file."""
+
+    return os.path.join(settings.CHART_CACHE_DIR, f"{key}.png")
+
+
+def save_chart(key: str, image: bytes) -> None:
+    """Given a chart's hash and image bytes, this function writes the image to
+    the cache (atomically, so concurrent readers never see half an image)."""
+
+    os.makedirs(settings.CHART_CACHE_DIR, exist_ok=True)
+    temp_path = f"{chart_path(key)}.{os.getpid()}.tmp"
+    with open(temp_path, 'wb') as f:
+        f.write(image)
+    os.replace(temp_path, chart_path(key))
+
+
+def evict_charts(max_bytes: int) -> None:
+    """Given a size limit in bytes, this function deletes the least recently
+    used chart images until the cache is back under 90% of the limit."""
+
+    with os.scandir(settings.CHART_CACHE_DIR) as entries:
+        charts = [(entry.stat().st_mtime, entry.stat().st_size, entry.path)
+                  for entry in entries if entry.name.endswith('.png')]
+
+    total_bytes = sum(size for _, size, _ in charts)
+    if total_bytes <= max_bytes:
+        return
+
+    for _, size, path in sorted(charts):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total_bytes -= size
+        if total_bytes <= max_bytes * 0.9:
+            break
+
+
+def get_chart_urls(dataset: str, postcode: str, from_date: str, to_date: str, charts: dict,
+                   third_vars: dict[str, str] = None, version=None) -> dict[str, str]:
+    """Given a dataset, postcode, date range and a dictionary of chart names to
+    (plot function, keyword arguments) pairs, this function returns a dictionary of
+    chart names to image urls. Charts that aren't cached yet are rendered and cached;
+    the keyword arguments can be given as a function that returns them, so that
+    they're only computed when the chart needs rendering. third_vars gives the third
+    variable of the charts that are split by one, so only they're cached by it."""
+
+    chart_urls = {}
+    missing_charts = {}
+    for chart, (plot_function, kwargs) in charts.items():
+
+        key = chart_key(dataset, postcode, from_date,
+                        to_date, chart, (third_vars or {}).get(chart), version)
+
+        try:
+            # Mark it as recently used, for eviction.
+            os.utime(chart_path(key))
+            increment('chart_cache_requests_total', {'result': 'hit'})
+        except FileNotFoundError:
+            increment('chart_cache_requests_total', {'result': 'miss'})
+            missing_charts[key] = (
+                plot_function, kwargs() if callable(kwargs) else kwargs)
+
+        chart_urls[chart] = reverse('chart', kwargs={'key': key})
+
+    if missing_charts:
+        for key, image in render_charts(missing_charts).items():
+            save_chart(key, image)
+        evict_charts(settings.CHART_CACHE_MAX_BYTES)
+
+    return chart_urls
@@ -0,0 +1,293 @@
+'''This file contains the functions that load each postcode's crime and stop & search (ss)
+data for the views, through the on-disk columnar cache (see data/columnar.py).'''
+
+import logging
+import os
+import threading
+import time
+import uuid
+
+from os import environ as ENV
+
+import pandas as pd
+
+from data.columnar import save_frame, load_frame, delete_frame
+from data.metrics import increment, note
+from data.analyse import get_crime_data_df, get_ss_data_df, get_months_df, get_published_months
+from data.cube import build_cube, CRIME_CUBE_DIMENSIONS, SS_CUBE_DIMENSIONS
+from data.schema import concat_compact, frame_nbytes
+from data.store import acquire_lock, is_locked, release_lock, track_postcode, get_tracked_postcodes
+
+
+STARTING_YEAR = 2022
+
+# How long a loader may hold a postcode's lock, and how long other callers wait for it.
+LOAD_LOCK_TIMEOUT = 60 * 5
+LOAD_WAIT_TIMEOUT = 30
+LOAD_POLL_INTERVAL = 0.25
+
+# How often the refresher checks the Police API for newly published months.
+REFRESH_INTERVAL = int(ENV.get('REFRESH_INTERVAL', 60 * 60 * 6))
+
+DATASET_LOADERS = {'crimes': get_crime_data_df,
+                   'stop_and_searches': get_ss_data_df}
+CUBE_DIMENSIONS = {'crimes': CRIME_CUBE_DIMENSIONS,
+                   'stop_and_searches': SS_CUBE_DIMENSIONS}
+
+logger = logging.getLogger(__name__)
+
+_load_locks = {}
+_load_locks_guard = threading.Lock()
+
+_refresher_pid = None
+_refresher_guard = threading.Lock()
+
+
+class LoadInProgress(Exception):
+    """Raised when another caller is still loading a postcode's data after
+    LOAD_WAIT_TIMEOUT seconds."""
+
+
+def dataset_cache_key(dataset: str, postcode: str, kind: str = 'df') -> str:
+    """Given a dataset, a normalised postcode and a kind of thing ('load' for its
+    loading lock, 'job' for its load job), this function returns the thing's name."""
+
+    return f"{dataset}_{kind}:{postcode}"
+
+
+def get_load_lock(key: str) -> threading.Lock:
+    """Given a cache key, this function returns the lock that threads in this
+    process share while loading it. It's kept until every thread that got it
+    has let it go (see forget_load_lock)."""
+
+    with _load_locks_guard:
+        entry = _load_locks.setdefault(key, [threading.Lock(), 0])
+        entry[1] += 1
+        return entry[0]
+
+
+def forget_load_lock(key: str) -> None:
+    """Given a cache key whose lock this thread got with get_load_lock, this function
+    lets it go - removing the lock once no thread in this process is using it."""
+
+    with _load_locks_guard:
+        entry = _load_locks[key]
+        entry[1] -= 1
+        if not entry[1]:
+            del _load_locks[key]
+
+
+def load_postcode_data(dataset: str, postcode: str, progress=None) -> dict:
+    """Given a dataset and a normalised postcode, this function loads the postcode's
+    dataframe (unless it's still cached), builds its count cube, caches both and
+    returns them in a dictionary keyed by kind. If given, progress(months done,
+    total months) is called as the months are loaded."""
+
+    df = get_cached_postcode_data(dataset, postcode, 'df')
+    if df is None:
+        latest_date = get_published_months()[-1]
+        df = DATASET_LOADERS[dataset](postcode, STARTING_YEAR, progress)
+        track_postcode(dataset, postcode, latest_date)
+
+    data = {'df': df, 'cube': build_cube(df, CUBE_DIMENSIONS[dataset])}
+    cache_postcode_data(dataset, postcode, data)
+    logger.info("Cached %s data for %s: %d rows, %d bytes, cube of %d rows, %d bytes",
+                dataset, postcode, len(df), frame_nbytes(df), len(data['cube']), frame_nbytes(data['cube']))
+
+    return data
+
+
+def get_postcode_data(dataset: str, postcode: str, kind: str, progress=None,
+                      columns: list[str] = None) -> pd.core.frame.DataFrame:
+    """Given a dataset ('crimes' or 'stop_and_searches'), a normalised postcode and a
+    kind of data ('df' or 'cube'), this function returns the postcode's data (or just
+    the given columns of it) - from the cache if it's there, otherwise by loading it
+    (and then caching it). Only one caller across all processes loads a postcode at a
+    time; the rest wait for its result, raising LoadInProgress if it takes longer than
+    LOAD_WAIT_TIMEOUT. If this caller loads the data, progress is passed on to
+    load_postcode_data."""
+
+    lock_name = dataset_cache_key(dataset, postcode, 'load')
+
+    data = get_cached_postcode_data(dataset, postcode, kind, columns)
+    if data is not None:
+        increment('postcode_cache_requests_total', {'dataset': dataset, 'result': 'hit'})
+        return data
+    increment('postcode_cache_requests_total', {'dataset': dataset, 'result': 'miss'})
+
+    deadline = time.monotonic() + LOAD_WAIT_TIMEOUT
+    load_lock = get_load_lock(lock_name)
+    if not load_lock.acquire(timeout=LOAD_WAIT_TIMEOUT):
+        forget_load_lock(lock_name)
+        raise LoadInProgress(f"{dataset} data for {postcode} is still loading.")
+
+    try:
+        owner = uuid.uuid4().hex
+        while True:
+            data = get_cached_postcode_data(dataset, postcode, kind, columns)
+            if data is not None:
+                return data
+
+            if acquire_lock(lock_name, owner, LOAD_LOCK_TIMEOUT):
+                try:
+                    data = get_cached_postcode_data(
+                        dataset, postcode, kind, columns)
+                    if data is None:
+                        data = load_postcode_data(
+                            dataset, postcode, progress)[kind]
+                        if columns is not None:
+                            data = data[columns]
+                    return data
+                finally:
+                    release_lock(lock_name, owner)
+
+            # Another process is loading it - wait for it to finish (or give up).
+            while is_locked(lock_name) and not is_postcode_data_cached(dataset, postcode, kind):
+                if time.monotonic() > deadline:
+                    raise LoadInProgress(
+                        f"{dataset} data for {postcode} is still loading.")
+                time.sleep(LOAD_POLL_INTERVAL)
+    finally:
+        load_lock.release()
+        forget_load_lock(lock_name)
+
+
+def get_cached_postcode_data(dataset: str, postcode: str, kind: str,
+                             columns: list[str] = None) -> pd.core.frame.DataFrame:
+    """Given a dataset, a normalised postcode, a kind of data ('df' or 'cube') and
+    optionally the columns needed, this function returns the postcode's data (memory
+    mapped, see data/columnar.py) if it's cached, or None if it isn't."""
+
+    return load_frame(dataset, postcode, kind, columns)
+
+
+def is_postcode_data_cached(dataset: str, postcode: str, kind: str = 'cube') -> bool:
+    """Given a dataset, a normalised postcode and a kind of data, this function
+    returns whether the postcode's data is cached."""
+
+    return load_frame(dataset, postcode, kind, columns=[]) is not None
+
+
+def cache_postcode_data(dataset: str, postcode: str, data: dict) -> None:
+    """Given a dataset, a normalised postcode and a dictionary of its data keyed by
+    kind, this function caches the data (replacing what was cached). The dataframe
+    is written before the cube, so a cached cube means both are cached."""
+
+    for kind in ['df', 'cube']:
+        save_frame(dataset, postcode, kind, data[kind])
+
+
+def uncache_postcode_data(dataset: str, postcode: str) -> None:
+    """Given a dataset and a normalised postcode, this function deletes its cached
+    data, so that it's rebuilt from the store next time."""
+
+    for kind in ['cube', 'df']:
+        delete_frame(dataset, postcode, kind)
+
+
+def get_postcode_df(dataset: str, postcode: str) -> pd.core.frame.DataFrame:
+    """Given a dataset and a normalised postcode, this function returns the
+    postcode's dataframe (see get_postcode_data)."""
+
+    df = get_postcode_data(dataset, postcode, 'df')
+    note(f"{dataset}_df_rows", len(df))
+
+    return df
+
+
+def get_postcode_cube(dataset: str, postcode: str, columns: list[str] = None) -> pd.core.frame.DataFrame:
+    """Given a dataset, a normalised postcode and optionally the columns needed, this
+    function returns the postcode's count cube (see get_postcode_data and data/cube.py)."""
+
+    cube = get_postcode_data(dataset, postcode, 'cube', columns=columns)
+    note(f"{dataset}_cube_rows", len(cube))
+
+    return cube
+
+
+def refresh_postcode(dataset: str, postcode: str, latest_date: tuple[int, int],
+                     published_dates: list[tuple[int, int]]) -> int:
+    """Given a tracked postcode of a dataset, the latest (year, month) its data has been
+    loaded up to and the months the Police API has published, this function fetches
+    only the newer months and merges them into the postcode's cached dataframe and cube
+    (if they're cached - if not, the next load reads every month from the store).
+    It returns the number of months added."""
+
+    new_dates = [date for date in published_dates
+                 if date > latest_date and date[0] >= STARTING_YEAR]
+    if not new_dates:
+        return 0
+
+    new_df = get_months_df(dataset, postcode, new_dates)
+
+    lock_name = dataset_cache_key(dataset, postcode, 'load')
+    owner = uuid.uuid4().hex
+    deadline = time.monotonic() + LOAD_WAIT_TIMEOUT
+    while not acquire_lock(lock_name, owner, LOAD_LOCK_TIMEOUT):
+        if time.monotonic() > deadline:
+            raise LoadInProgress(
+                f"{dataset} data for {postcode} is still loading.")
+        time.sleep(LOAD_POLL_INTERVAL)
+
+    try:
+        df = get_cached_postcode_data(dataset, postcode, 'df')
+        if df is not None:
+            cube = get_cached_postcode_data(dataset, postcode, 'cube')
+            if cube is None:
+                cube = build_cube(df, CUBE_DIMENSIONS[dataset])
+
+            cache_postcode_data(dataset, postcode, {
+                'df': concat_compact([df, new_df], dataset),
+                'cube': concat_compact([cube, build_cube(new_df, CUBE_DIMENSIONS[dataset])], dataset)})
+
+        track_postcode(dataset, postcode, new_dates[-1])
+    finally:
+        release_lock(lock_name, owner)
+
+    logger.info("Refreshed %s data for %s: %d new month(s), %d rows",
+                dataset, postcode, len(new_dates), len(new_df))
+
+    return len(new_dates)
+
+
+def refresh_postcodes() -> int:
+    """This function brings every tracked postcode up to date with the months the
+    Police API has published, and returns the number of postcode-months added."""
+
+    published_dates = get_published_months()
+    added = 0
+    for dataset, postcode, latest_date in get_tracked_postcodes():
+        try:
+            added += refresh_postcode(dataset, postcode,
+                                      latest_date, published_dates)
+        except Exception as error:
+            logger.warning("Couldn't refresh %s data for %s: %s", dataset, postcode, error)
+
+    return added
+
+
+def run_refresher() -> None:
+    """This function refreshes the tracked postcodes straight away and then every
+    REFRESH_INTERVAL seconds, so a restarted server doesn't serve stale months until
+    the first interval has passed. Each interval's refresh runs in only one process -
+    whichever takes the lock."""
+
+    owner = uuid.uuid4().hex
+    while True:
+        try:
+            if acquire_lock('refresher', owner, REFRESH_INTERVAL * 0.9):
+                refresh_postcodes()
+        except Exception as error:
+            logger.exception("Couldn't refresh the tracked postcodes: %s", error)
+        time.sleep(REFRESH_INTERVAL)
+
+
+def start_refresher() -> None:
+    """This function starts the refresher in a background thread (once per process -
+    a forked process doesn't inherit its parent's threads, so it starts its own)."""
+
+    global _refresher_pid
+    with _refresher_guard:
+        if _refresher_pid != os.getpid():
+            threading.Thread(target=run_refresher, name='refresher', daemon=True).start()
+            _refresher_pid = os.getpid()
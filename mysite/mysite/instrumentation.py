@@ -0,0 +1,66 @@
+'''This file contains the web layer of the app's instrumentation (see data/metrics.py) - the
+middleware that times each request's stages and sends them back as a Server-Timing header, the
+helper that times template rendering, and the logging filter that samples routine log records.'''
+
+import logging
+import random
+import time
+
+from django.shortcuts import render
+
+from data.metrics import increment, observe, stage, start_timings, stop_timings
+
+
+logger = logging.getLogger(__name__)
+
+
+class SamplingFilter(logging.Filter):
+    """Lets through every warning and error, but only `rate` (a fraction) of the
+    records below that - so busy servers can log routine requests cheaply."""
+
+    def __init__(self, rate: float = 1.0):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        return record.levelno >= logging.WARNING or random.random() < self.rate
+
+
+class ServerTimingMiddleware:
+    """Times each request and its stages (geocode, fetch, normalise, aggregate, render,
+    template), records them in the metrics, and sends them back in a Server-Timing
+    header (which browsers' developer tools show under the request's timing)."""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        token = start_timings()
+        start = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            timings = stop_timings(token)
+        seconds = time.perf_counter() - start
+
+        match = request.resolver_match
+        view = f"{match.func.__module__}.{match.func.__name__}" if match else 'unmatched'
+        observe('request_seconds', seconds, {'view': view})
+        increment('requests_total', {'view': view, 'status': str(response.status_code)})
+
+        response['Server-Timing'] = ', '.join(
+            [f"{name};dur={stage_seconds * 1000:.1f}" for name, stage_seconds in timings.items()]
+            + [f"total;dur={seconds * 1000:.1f}"])
+        logger.debug("%s %s %s in %.1fms (%s)", request.method, request.path, response.status_code,
+                     seconds * 1000, ', '.join(f"{name} {stage_seconds * 1000:.1f}ms"
+                                               for name, stage_seconds in timings.items()))
+
+        return response
+
+
+def render_page(request, template_name: str, context: dict = None, status: int = None):
+    """Given a request, a template and its context, this function renders the page
+    (see django.shortcuts.render), timed as the 'template' stage."""
+
+    with stage('template'):
+        return render(request, template_name, context, status=status)
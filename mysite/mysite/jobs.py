@@ -0,0 +1,210 @@
+'''This file contains the background jobs that load postcodes' data, so that the views can
+show a progress page straight away instead of waiting for the Police API.'''
+
+from concurrent.futures import ThreadPoolExecutor
+from os import environ as ENV
+import logging
+import os
+import threading
+import time
+
+from django.http import HttpResponse, HttpResponseNotFound, JsonResponse
+from django.urls import reverse
+
+from data.store import beat_jobs, create_job, update_job, load_job, delete_job
+from .datasets import (dataset_cache_key, is_postcode_data_cached, get_postcode_data, get_postcode_cube,
+                       LoadInProgress, LOAD_LOCK_TIMEOUT, LOAD_POLL_INTERVAL)
+from .instrumentation import render_page
+
+
+JOB_WORKERS = int(ENV.get('JOB_WORKERS', 2))
+
+# How often a process records that it's still working on its jobs, and how long without
+# that before another process takes a job over.
+JOB_HEARTBEAT_INTERVAL = 5
+JOB_HEARTBEAT_TIMEOUT = 30
+
+logger = logging.getLogger(__name__)
+
+_executor = None
+_executor_lock = threading.Lock()
+
+# The jobs this process has queued or is running, and the process its heartbeat runs in.
+_job_names = set()
+_job_names_lock = threading.Lock()
+_heartbeat_pid = None
+
+
+def get_job_executor() -> ThreadPoolExecutor:
+    """This function returns the process-wide pool of threads that run the load jobs."""
+
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=JOB_WORKERS, thread_name_prefix='load-job')
+
+    return _executor
+
+
+def run_heartbeat() -> None:
+    """This function records that this process is still working on its jobs (see
+    beat_jobs) every JOB_HEARTBEAT_INTERVAL seconds."""
+
+    while True:
+        with _job_names_lock:
+            names = list(_job_names)
+        try:
+            if names:
+                beat_jobs(names)
+        except Exception as error:
+            logger.warning("Couldn't record the load jobs' heartbeat: %s", error)
+        time.sleep(JOB_HEARTBEAT_INTERVAL)
+
+
+def start_heartbeat() -> None:
+    """This function starts the jobs' heartbeat in a background thread (once per process -
+    a forked process doesn't inherit its parent's threads, so it starts its own)."""
+
+    global _heartbeat_pid
+    with _job_names_lock:
+        if _heartbeat_pid != os.getpid():
+            threading.Thread(target=run_heartbeat, name='job-heartbeat', daemon=True).start()
+            _heartbeat_pid = os.getpid()
+
+
+def run_load_job(dataset: str, postcode: str) -> None:
+    """Given a dataset and a normalised postcode, this function loads the postcode's
+    data into the cache (see get_postcode_data), recording the job's progress."""
+
+    name = dataset_cache_key(dataset, postcode, 'job')
+    update_job(name, 'running')
+    total_months = [0]
+
+    def progress(done, total):
+        total_months[0] = total
+        update_job(name, 'running', done, total)
+
+    deadline = time.monotonic() + LOAD_LOCK_TIMEOUT
+    try:
+        while True:
+            try:
+                get_postcode_data(dataset, postcode, 'cube', progress)
+                break
+            except LoadInProgress:
+                # Something other than a job is loading it - wait for that instead.
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(LOAD_POLL_INTERVAL)
+    except Exception as error:
+        logger.warning("Couldn't load %s data for %s: %s", dataset, postcode, error)
+        update_job(name, 'failed', error=str(error))
+        return
+    finally:
+        with _job_names_lock:
+            _job_names.discard(name)
+
+    update_job(name, 'done', total_months[0], total_months[0])
+
+
+def start_load_job(dataset: str, postcode: str) -> dict:
+    """Given a dataset and a normalised postcode, this function starts a job loading the
+    postcode's data in the background (unless one is already queued or running, in this
+    or another process that's still alive) and returns the job's status (see
+    get_load_job_status). A failed job's status is returned once, so that the next call
+    retries it."""
+
+    name = dataset_cache_key(dataset, postcode, 'job')
+
+    job = load_job(name)
+    if job is not None and job['status'] == 'failed':
+        delete_job(name)
+        return job
+
+    if is_postcode_data_cached(dataset, postcode):
+        return {'status': 'done', 'done': 0, 'total': 0, 'error': None}
+
+    if create_job(name, LOAD_LOCK_TIMEOUT, JOB_HEARTBEAT_TIMEOUT):
+        start_heartbeat()
+        with _job_names_lock:
+            _job_names.add(name)
+        get_job_executor().submit(run_load_job, dataset, postcode)
+
+    return get_load_job_status(dataset, postcode)
+
+
+def get_load_job_status(dataset: str, postcode: str) -> dict:
+    """Given a dataset and a normalised postcode, this function returns the status of its
+    load job - 'queued', 'running', 'done', 'failed' or 'unknown' (if there's no job) -
+    with its progress (months 'done' out of 'total') and error as a dictionary."""
+
+    job = load_job(dataset_cache_key(dataset, postcode, 'job'))
+    is_cached = is_postcode_data_cached(dataset, postcode)
+
+    if job is None:
+        job = {'status': 'done' if is_cached else 'unknown',
+               'done': 0, 'total': 0, 'error': None}
+    elif job['status'] == 'done' and not is_cached:
+        job['status'] = 'unknown'
+
+    return {key: job[key] for key in ['status', 'done', 'total', 'error']}
+
+
+def loading_page(request, dataset: str, postcode: str, display_postcode: str):
+    """Given a request, a dataset, a normalised postcode and the postcode as it's shown
+    on the page, this function returns the page shown while the postcode's data loads.
+    It polls the load job's status and reloads once the data is ready."""
+
+    context = {"postcode": display_postcode,
+               "status_url": reverse('load_job_status', kwargs={'dataset': dataset, 'postcode': postcode}),
+               "page_url": request.path}
+
+    return render_page(request, "mysite/loading_page.html", context, status=202)
+
+
+def load_page_cube(request, dataset: str, postcode: str, columns: list[str] = None):
+    """Given a request for a postcode's page, a dataset, a normalised postcode (and the
+    cube columns the page uses), this function returns the postcode's cube and None if
+    its data is ready. Otherwise it starts loading the data in the background (see
+    start_load_job) and returns None and the response to send instead - the loading
+    page, or a 404 if the load failed."""
+
+    display_postcode = postcode[:-3].strip().upper() + ' ' + postcode[-3:].strip().upper()
+
+    job = start_load_job(dataset, postcode)
+    if job['status'] == 'failed':
+        logger.warning("Couldn't load %s data for %s: %s", dataset, postcode, job['error'])
+        return None, HttpResponseNotFound(f"{job['error']} Error\n\nIf it's a 429 error just try refreshing again :)))))")
+    if job['status'] != 'done':
+        return None, loading_page(request, dataset, postcode, display_postcode)
+
+    try:
+        return get_postcode_cube(dataset, postcode, columns), None
+    except LoadInProgress as e:
+        return None, HttpResponse(f"{e} Hold tight, this page will refresh automatically.",
+                                  status=202, headers={"Refresh": "5"})
+    except Exception as e:
+        logger.warning("Couldn't load %s data for %s: %s", dataset, postcode, e)
+        return None, HttpResponseNotFound(f"{e} Error\n\nIf it's a 429 error just try refreshing again :)))))")
+
+
+def load_api_cube(dataset: str, postcode: str, columns: list[str] = None):
+    """Given a dataset and a normalised postcode (and the cube columns wanted), this
+    function returns the postcode's cube and None if its data is ready. Otherwise it
+    starts loading the data in the background (see start_load_job) and returns None
+    and the JSON response to send instead - a 202 with the job's status (to poll at
+    its status url), or a 404 if the load failed."""
+
+    job = start_load_job(dataset, postcode)
+    if job['status'] == 'failed':
+        return None, JsonResponse({"error": job['error']}, status=404)
+    if job['status'] != 'done':
+        status_url = reverse('load_job_status', kwargs={'dataset': dataset, 'postcode': postcode})
+        return None, JsonResponse({**job, "status_url": status_url}, status=202, headers={"Retry-After": "5"})
+
+    try:
+        return get_postcode_cube(dataset, postcode, columns), None
+    except LoadInProgress as e:
+        return None, JsonResponse({"status": "loading", "error": str(e)}, status=202, headers={"Retry-After": "5"})
+    except Exception as e:
+        return None, JsonResponse({"error": str(e)}, status=404)
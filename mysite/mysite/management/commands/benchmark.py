@@ -0,0 +1,279 @@
+'''This file contains the benchmark command, which times the app's hot paths - normalising the
+Police API's data, building and aggregating dataframes, rendering charts and serving postcode
+pages - against recorded API responses, so that runs are reproducible and can be compared.'''
+
+from os import environ as ENV
+from pathlib import Path
+import json
+import shutil
+import tempfile
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.test import Client
+from django.test.utils import override_settings
+
+from data import session
+from data.analyse import (counting_by_category, crimes_by_street, get_crime_data_df,
+                          get_month_list, get_ss_data_df)
+from data.benchmark import compare_results, load_results, make_results, save_results, time_stage
+from data.extract import (get_available_dates, get_relevant_street_crimes_data,
+                          normalise_postcode, postcode_to_coords, street_crimes_to_columns)
+from data.fetch import fetch_many
+from data.fixtures import load_fixtures, save_fixtures, RecordingAdapter, ReplayAdapter
+from data.replay_server import StandInAPI, StandInAdapter
+from data.store import delete_months
+from data.tiles import get_stored_tiles_data, tiles_covering
+from data.visualise import (object_of_search_bar_chart, plot_bar, plot_crimes_with_time_line_graph,
+                            render_png, stop_and_search_hour_bar_chart, stop_and_search_pie_chart)
+from mysite.datasets import STARTING_YEAR, get_postcode_cube
+
+
+DEFAULT_FIXTURES_PATH = Path(settings.BASE_DIR) / 'benchmarks' / 'fixtures.json.gz'
+DATES_FIXTURE_KEY = 'GET /api/crimes-street-dates'
+
+CHARTS = ['plot_crimes_with_time_line_graph', 'plot_bar', 'stop_and_search_hour_bar_chart',
+          'object_of_search_bar_chart', 'stop_and_search_pie_chart']
+STAGES = (['get_relevant_street_crimes_data', 'street_crimes_to_columns',
+           'get_crime_data_df_cold', 'get_crime_data_df_stored', 'get_ss_data_df_cold', 'get_ss_data_df_stored',
+           'counting_by_category_date', 'counting_by_category_category', 'counting_by_category_cube',
+           'crimes_by_street', 'crimes_by_street_cube']
+          + [f"chart_{chart}" for chart in CHARTS]
+          + [f"{name}_page_{kind}" for name in ['crimes', 'ss'] for kind in ['get', 'get_cold_charts', 'post']])
+
+
+class Command(BaseCommand):
+    help = ("Times the app's hot paths against recorded Police and Postcode API responses, "
+            "optionally saving the results as JSON and comparing them with a previous run's. "
+            "Record the responses first with --record (the only time the real APIs are used) - "
+            "without any, the responses are recorded from the stand-in API (see replay_server.py).")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--fixtures',
+                            help=f"The recorded API responses (default: {DEFAULT_FIXTURES_PATH} if it's "
+                            "been recorded, or else the stand-in API's, recorded as the benchmark starts).")
+        parser.add_argument('--record', action='store_true',
+                            help="Record the API responses for --postcodes and --months, then exit.")
+        parser.add_argument('--postcodes', nargs='+', default=['NW5 1TU'],
+                            help="The postcodes to record (default: NW5 1TU). The benchmark uses the first.")
+        parser.add_argument('--months', type=int, default=6,
+                            help="How many of the latest published months to record (default: 6).")
+        parser.add_argument('--repeat', type=int, default=5,
+                            help="How many timed runs of each stage (default: 5).")
+        parser.add_argument('--stages', nargs='+',
+                            help=f"Only run these stages (default: all) - any of {', '.join(STAGES)}.")
+        parser.add_argument('--output', help="Save the results as JSON to this file.")
+        parser.add_argument('--compare', help="Compare the results with a previous run's saved results, "
+                            "failing if any stage has regressed.")
+        parser.add_argument('--threshold', type=float, default=0.1,
+                            help="The relative slowdown (by median) allowed before a stage counts as "
+                            "regressed (default: 0.1, i.e. 10%%).")
+        parser.add_argument('--stage-threshold', action='append', default=[], metavar='STAGE=THRESHOLD',
+                            help="Override the threshold for a stage (can be given more than once).")
+
+    def handle(self, *args, **options):
+        unknown_stages = sorted(set(options['stages'] or []) - set(STAGES))
+        if unknown_stages:
+            raise CommandError(f"Unknown stage(s): {', '.join(unknown_stages)}.")
+        if options['record'] and options['fixtures'] is None:
+            options['fixtures'] = str(DEFAULT_FIXTURES_PATH)
+
+        thresholds = {}
+        for stage_threshold in options['stage_threshold']:
+            stage, _, threshold = stage_threshold.partition('=')
+            try:
+                thresholds[stage] = float(threshold)
+            except ValueError:
+                raise CommandError(f"Invalid --stage-threshold {stage_threshold}, expected STAGE=THRESHOLD.")
+
+        # Everything is stored in a scratch folder, so the benchmark starts cold and the
+        # real store and caches are left alone (the store's paths are put back afterwards).
+        with tempfile.TemporaryDirectory() as folder:
+            old_paths = {name: ENV.get(name) for name in ['DATA_STORE_PATH', 'DATA_COLUMNAR_PATH']}
+            ENV['DATA_STORE_PATH'] = str(Path(folder) / 'store.sqlite3')
+            ENV['DATA_COLUMNAR_PATH'] = str(Path(folder) / 'columnar')
+
+            try:
+                with override_settings(CHART_CACHE_DIR=str(Path(folder) / 'charts'),
+                                       ALLOWED_HOSTS=['testserver'], START_BACKGROUND_WORK=False):
+                    if options['record']:
+                        return self.record(options)
+
+                    results = self.benchmark(options, self.get_fixtures(options, Path(folder)))
+            finally:
+                for name, path in old_paths.items():
+                    if path is None:
+                        ENV.pop(name, None)
+                    else:
+                        ENV[name] = path
+
+        if options['output']:
+            save_results(options['output'], results)
+            self.stdout.write(f"Saved the results to {options['output']}.")
+
+        if options['compare']:
+            try:
+                baseline = load_results(options['compare'])
+            except (OSError, json.JSONDecodeError) as error:
+                raise CommandError(f"Couldn't read {options['compare']}: {error}")
+
+            comparisons = compare_results(baseline, results, options['threshold'], thresholds)
+            self.stdout.write(f"\nCompared with {options['compare']} ({baseline['created_at']}):")
+            for comparison in comparisons:
+                line = (f"{comparison['stage']:<40} {comparison['baseline'] * 1000:>10.2f}ms -> "
+                        f"{comparison['current'] * 1000:>10.2f}ms {comparison['change']:>+8.1%}")
+                self.stdout.write(self.style.ERROR(line + " REGRESSED") if comparison['regressed'] else line)
+
+            regressions = [comparison['stage'] for comparison in comparisons if comparison['regressed']]
+            if regressions:
+                raise CommandError(f"{len(regressions)} stage(s) regressed: {', '.join(regressions)}")
+
+    def record(self, options) -> None:
+        """Given the command's options, this method records the API responses that the
+        benchmark needs into the fixtures file."""
+
+        fixtures = self.record_fixtures(options)
+
+        Path(options['fixtures']).parent.mkdir(parents=True, exist_ok=True)
+        save_fixtures(options['fixtures'], fixtures['responses'], fixtures['meta'])
+        self.stdout.write(self.style.SUCCESS(
+            f"Recorded {len(fixtures['responses'])} responses to {options['fixtures']}."))
+
+    def record_fixtures(self, options, transport=None) -> dict:
+        """Given the command's options and optionally the transport to record through (by
+        default, the real APIs), this method returns the recorded API responses that the
+        benchmark needs, as fixtures (see load_fixtures). The published months feed is trimmed
+        to the latest --months, so the app only asks for (and records) those months."""
+
+        recorder = RecordingAdapter(transport)
+        session.set_transport(recorder)
+        try:
+            dates = sorted(get_available_dates())[-options['months']:]
+            dates_data = json.loads(recorder.responses[DATES_FIXTURE_KEY]['body'])
+            recorder.responses[DATES_FIXTURE_KEY]['body'] = json.dumps(
+                [date for date in dates_data if tuple(int(part) for part in date['date'].split('-')) in dates])
+
+            postcodes = [normalise_postcode(postcode) for postcode in options['postcodes']]
+            for postcode in postcodes:
+                self.stdout.write(f"Recording {postcode}...")
+                get_crime_data_df(postcode, STARTING_YEAR)
+                get_ss_data_df(postcode, STARTING_YEAR)
+                # The original (non-tiled) crimes endpoint, for the normalisation stage
+                fetch_many(get_relevant_street_crimes_data,
+                           [(postcode_to_coords(postcode), year, month) for year, month in dates])
+        finally:
+            session.set_transport(None)
+
+        return {'responses': recorder.responses, 'meta': {'postcodes': postcodes, 'dates': dates}}
+
+    def get_fixtures(self, options, folder: Path) -> dict:
+        """Given the command's options and the benchmark's scratch folder, this method returns
+        the fixtures to benchmark against - those of --fixtures, or DEFAULT_FIXTURES_PATH, or
+        else the stand-in API's, recorded (with a store of their own) in the folder."""
+
+        if options['fixtures'] is None and not DEFAULT_FIXTURES_PATH.exists():
+            self.stdout.write(f"No fixtures at {DEFAULT_FIXTURES_PATH} - "
+                              "recording the stand-in API's responses.")
+            options['fixtures'] = 'stand-in'
+            benchmark_paths = {name: ENV[name] for name in ['DATA_STORE_PATH', 'DATA_COLUMNAR_PATH']}
+            ENV['DATA_STORE_PATH'] = str(folder / 'stand_in.sqlite3')
+            ENV['DATA_COLUMNAR_PATH'] = str(folder / 'stand_in_columnar')
+            try:
+                return self.record_fixtures(options, StandInAdapter(StandInAPI()))
+            finally:
+                ENV.update(benchmark_paths)
+
+        options['fixtures'] = options['fixtures'] or str(DEFAULT_FIXTURES_PATH)
+        try:
+            return load_fixtures(options['fixtures'])
+        except FileNotFoundError:
+            raise CommandError(f"No fixtures at {options['fixtures']} - record them with --record.")
+
+    def benchmark(self, options, fixtures: dict) -> dict:
+        """Given the command's options and fixtures, this method times each stage of the
+        benchmark against the recorded responses, and returns the results."""
+
+        session.set_transport(ReplayAdapter(fixtures['responses']))
+        postcode = fixtures['meta']['postcodes'][0]
+        stages = {}
+
+        def run(stage, function, setup=None):
+            if options['stages'] and stage not in options['stages']:
+                return
+            stages[stage] = time_stage(function, options['repeat'], setup)
+            self.stdout.write(f"{stage:<40} median {stages[stage]['median'] * 1000:>10.2f}ms, "
+                              f"min {stages[stage]['min'] * 1000:>10.2f}ms")
+
+        try:
+            coords = postcode_to_coords(postcode)
+            dates = get_month_list(STARTING_YEAR)
+
+            # Normalising the API's crime data
+            run('get_relevant_street_crimes_data',
+                lambda: [get_relevant_street_crimes_data(coords, year, month) for year, month in dates])
+            tiles_data = get_stored_tiles_data(tiles_covering(coords), dates)
+            run('street_crimes_to_columns',
+                lambda: [street_crimes_to_columns(data, year, month) for (year, month), data in tiles_data.items()])
+
+            # Building the dataframes, from the API (replayed) and from the store
+            run('get_crime_data_df_cold', lambda: get_crime_data_df(postcode, STARTING_YEAR),
+                setup=lambda: delete_months('crime_tiles'))
+            run('get_crime_data_df_stored', lambda: get_crime_data_df(postcode, STARTING_YEAR))
+            run('get_ss_data_df_cold', lambda: get_ss_data_df(postcode, STARTING_YEAR),
+                setup=lambda: delete_months('stop_and_searches'))
+            run('get_ss_data_df_stored', lambda: get_ss_data_df(postcode, STARTING_YEAR))
+
+            # Aggregating
+            crime_df = get_crime_data_df(postcode, STARTING_YEAR)
+            crime_cube = get_postcode_cube('crimes', postcode)
+            ss_cube = get_postcode_cube('stop_and_searches', postcode)
+            run('counting_by_category_date', lambda: counting_by_category(crime_df, ['date']))
+            run('counting_by_category_category', lambda: counting_by_category(crime_df, ['category']))
+            run('counting_by_category_cube', lambda: counting_by_category(crime_cube, ['category']))
+            run('crimes_by_street', lambda: crimes_by_street(crime_df))
+            run('crimes_by_street_cube', lambda: crimes_by_street(crime_cube))
+
+            # Rendering each chart (in this process)
+            charts = {
+                'plot_crimes_with_time_line_graph': (plot_crimes_with_time_line_graph,
+                                                     {'df': counting_by_category(crime_cube, ['date'])}),
+                'plot_bar': (plot_bar, {'df': counting_by_category(crime_cube, ['category'])}),
+                'stop_and_search_hour_bar_chart': (stop_and_search_hour_bar_chart,
+                                                   {'df': counting_by_category(ss_cube, ['hour'])}),
+                'object_of_search_bar_chart': (object_of_search_bar_chart,
+                                               {'df': ss_cube[['object of search', 'count']]}),
+                'stop_and_search_pie_chart': (stop_and_search_pie_chart,
+                                              {'df': ss_cube[['age range', 'count']], 'category': 'age range',
+                                               'loc': 'center right'})}
+            for chart, (plot_function, kwargs) in charts.items():
+                run(f"chart_{chart}", lambda plot_function=plot_function, kwargs=kwargs: render_png(plot_function, **kwargs))
+
+            # Serving the postcode pages, with and without their charts already cached
+            client = Client()
+            from_date = f"{dates[0][0]}-{dates[0][1]:02d}-01"
+            to_date = f"{dates[-1][0]}-{dates[-1][1]:02d}-28"
+
+            def clear_charts():
+                shutil.rmtree(settings.CHART_CACHE_DIR, ignore_errors=True)
+
+            for dataset, name in [('crimes', 'crimes'), ('stop_and_searches', 'ss')]:
+                url = f"/{dataset}/{postcode}/"
+                run(f"{name}_page_get", lambda url=url: self.check_response(client.get(url)))
+                run(f"{name}_page_get_cold_charts", lambda url=url: self.check_response(client.get(url)),
+                    setup=clear_charts)
+                run(f"{name}_page_post", lambda url=url: self.check_response(
+                    client.post(url, {'from-date': from_date, 'to-date': to_date})))
+        finally:
+            session.set_transport(None)
+
+        return make_results(stages, repeat=options['repeat'], fixtures=options['fixtures'],
+                            postcode=postcode, dates=dates,
+                            rows={'crimes': len(crime_df), 'stop_and_searches': int(ss_cube['count'].sum())})
+
+    def check_response(self, response):
+        """Given a page's response, this method raises an error unless it was served."""
+
+        if response.status_code != 200:
+            raise CommandError(f"{response.request['PATH_INFO']} returned {response.status_code}.")
+
+        return response
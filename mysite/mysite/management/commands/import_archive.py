@@ -0,0 +1,60 @@
+'''This file contains the import_archive command, which backfills the store from one of
+data.police.uk's bulk monthly CSV archives instead of the Police API.'''
+
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from data.bulk import archive_csv_files, ArchiveImporter
+from data.extract import postcodes_to_coords
+from data.store import get_tracked_postcodes
+from mysite.datasets import uncache_postcode_data
+
+
+class Command(BaseCommand):
+    help = ("Imports a data.police.uk bulk archive (a .zip, or a folder of its CSVs) into the store. "
+            "Crimes are stored by tile, so every postcode they cover can use them. Stop and searches "
+            "are stored for the tracked postcodes and any given with --postcodes. The archive "
+            "replaces what's stored for the months it covers, so import every force around an area.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="The archive, or a folder of its CSVs.")
+        parser.add_argument('--postcodes', nargs='+', default=[],
+                            help="Postcodes (or outcodes) to import stop and searches for, "
+                            "as well as the tracked ones.")
+
+    def handle(self, *args, **options):
+        try:
+            files = archive_csv_files(options['path'])
+        except (OSError, ValueError) as error:
+            raise CommandError(str(error))
+        if not files:
+            raise CommandError(f"No crime or stop and search CSVs found in {options['path']}.")
+
+        tracked_postcodes = [postcode for dataset, postcode, _ in get_tracked_postcodes()
+                             if dataset == 'stop_and_searches']
+        coords = postcodes_to_coords(tracked_postcodes + options['postcodes'])
+        for postcode, postcode_coords in coords.items():
+            if postcode_coords is None:
+                self.stderr.write(f"Skipping {postcode}: not a valid postcode.")
+        importer = ArchiveImporter(list(dict.fromkeys(
+            postcode_coords for postcode_coords in coords.values() if postcode_coords is not None)))
+
+        start = time.perf_counter()
+        rows = 0
+        written = 0
+        for i, (name, opener) in enumerate(files, start=1):
+            stats = importer.import_csv(name, opener)
+            rows += stats['rows']
+            written += stats['written']
+            self.stdout.write(f"[{i}/{len(files)}] {name}: {stats['rows']} rows, {stats['written']} stored "
+                              f"in {stats['seconds']:.1f}s ({stats['rows'] / max(stats['seconds'], 1e-6):.0f} rows/s)")
+
+        # Cached postcodes may be missing (or have replaced) the imported months.
+        for dataset, postcode, _ in get_tracked_postcodes():
+            uncache_postcode_data(dataset, postcode)
+
+        seconds = time.perf_counter() - start
+        self.stdout.write(self.style.SUCCESS(
+            f"Imported {len(files)} CSVs in {seconds:.1f}s - {rows} rows read, {written} stored "
+            f"({rows / max(seconds, 1e-6):.0f} rows/s)."))
@@ -0,0 +1,205 @@
+'''This file contains the load_test command, which drives a running instance of the app with a
+realistic mix of postcode page views and API calls, and reports their latency percentiles and
+(if it's run against the replay_server command) the calls made to the upstream APIs.'''
+
+from concurrent.futures import ThreadPoolExecutor
+import random
+import threading
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+import numpy as np
+import requests
+
+from data.extract import normalise_postcode
+
+
+# A spread of London postcodes, most popular first.
+DEFAULT_POSTCODES = ['N1C 4AX', 'EC2M 4TR', 'NW5 1TU', 'SW1A 1AA', 'E1 6AN', 'SE1 9SG', 'W1D 3QF',
+                     'N7 8DB', 'E8 1EA', 'SW9 8HE', 'NW1 2DB', 'WC2N 5DN', 'SE15 5BA', 'E14 5AB']
+
+# How often each kind of request is made.
+REQUEST_MIX = {'crimes_page': 0.35, 'ss_page': 0.25, 'crimes_page_post': 0.1, 'ss_page_post': 0.05,
+               'crime_aggregates': 0.15, 'ss_aggregates': 0.1}
+
+LOAD_POLL_INTERVAL = 0.5
+LOAD_TIMEOUT = 300
+
+
+class Command(BaseCommand):
+    help = ("Drives a running instance of the app with a mix of postcode page views (GET and POST) "
+            "and aggregates API calls, over postcodes whose popularity follows a Zipf distribution, "
+            "and reports the p50/p95/p99 latency of each kind of request.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', default='http://127.0.0.1:8000', help="The app's base url.")
+        parser.add_argument('--upstream', help="The replay_server's base url, to report the upstream "
+                            "API calls made during the test.")
+        parser.add_argument('--postcodes', nargs='+', default=DEFAULT_POSTCODES,
+                            help="The postcodes to view, most popular first (default: a spread of London's).")
+        parser.add_argument('--file', help="A file of postcodes, most popular first, one per line "
+                            "(anything after a comma, and lines starting with #, are ignored).")
+        parser.add_argument('--requests', type=int, default=200, help="How many requests to make (default: 200).")
+        parser.add_argument('--concurrency', type=int, default=8,
+                            help="How many simulated users make requests at once (default: 8).")
+        parser.add_argument('--zipf', type=float, default=1.1,
+                            help="How skewed towards the first postcodes the views are (default: 1.1).")
+        parser.add_argument('--no-follow-loads', action='store_true',
+                            help="Don't wait for postcodes that are still loading, like a browser on the "
+                            "progress page would - just record the progress page.")
+        parser.add_argument('--seed', type=int, default=0, help="Seeds the request mix (default: 0).")
+
+    def handle(self, *args, **options):
+        postcodes = list(options['postcodes'])
+        if options['file']:
+            try:
+                with open(options['file']) as file:
+                    postcodes = [line.split(',')[0].strip() for line in file
+                                 if line.strip() and not line.startswith('#')]
+            except OSError as error:
+                raise CommandError(f"Couldn't read {options['file']}: {error}")
+        postcodes = [normalise_postcode(postcode) for postcode in postcodes]
+        if not postcodes:
+            raise CommandError("No postcodes given.")
+
+        plan = self.make_plan(postcodes, options)
+        upstream_before = self.get_upstream_stats(options['upstream'])
+
+        samples = []
+        samples_lock = threading.Lock()
+        local = threading.local()
+
+        def make_request(kind, postcode, from_date, to_date):
+            if not hasattr(local, 'session'):
+                local.session = requests.Session()
+            for sample in self.request(local.session, options, kind, postcode, from_date, to_date):
+                with samples_lock:
+                    samples.append(sample)
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=max(1, options['concurrency'])) as executor:
+            list(executor.map(lambda request: make_request(*request), plan))
+        seconds = time.perf_counter() - start
+
+        self.report(samples, seconds)
+
+        upstream_after = self.get_upstream_stats(options['upstream'])
+        if upstream_after is not None:
+            calls = {endpoint: count - upstream_before['requests'].get(endpoint, 0)
+                     for endpoint, count in upstream_after['requests'].items()}
+            self.stdout.write(
+                f"Upstream: {sum(calls.values())} calls ({', '.join(f'{endpoint} {count}' for endpoint, count in calls.items() if count)}), "
+                f"{upstream_after['rate_limited'] - upstream_before['rate_limited']} rate limited, "
+                f"{upstream_after['errors_injected'] - upstream_before['errors_injected']} injected errors.")
+
+    def make_plan(self, postcodes: list[str], options) -> list[tuple]:
+        """Given the postcodes and the command's options, this method returns the requests
+        to make, as (kind, postcode, from date, to date)."""
+
+        rng = random.Random(options['seed'])
+        weights = [1 / rank ** options['zipf'] for rank in range(1, len(postcodes) + 1)]
+        this_year = time.localtime().tm_year
+
+        plan = []
+        for _ in range(options['requests']):
+            kind = rng.choices(list(REQUEST_MIX), list(REQUEST_MIX.values()))[0]
+            postcode = rng.choices(postcodes, weights)[0]
+            from_year = rng.randint(2022, this_year)
+            plan.append((kind, postcode, f"{from_year}-01-01", f"{rng.randint(from_year, this_year)}-12-31"))
+
+        return plan
+
+    def request(self, session: requests.Session, options, kind: str, postcode: str,
+                from_date: str, to_date: str) -> list[tuple[str, str, float]]:
+        """Given a user's session, the command's options and a request to make, this method
+        makes it like a browser would, and returns (kind, status, seconds) for each page
+        the user waited for. Pages are followed through their progress page if they're
+        loading, and a page is viewed before it's posted to (for its CSRF cookie)."""
+
+        url = options['url'].rstrip('/')
+        dataset = 'stop_and_searches' if kind.startswith('ss') else 'crimes'
+
+        if kind.endswith('aggregates'):
+            return [self.timed(kind, session.get, f"{url}/api/{dataset}/{postcode}/aggregates",
+                               params={'from': from_date, 'to': to_date})]
+
+        page_url = f"{url}/{dataset}/{postcode}/"
+        page_kind = kind.removesuffix('_post')
+        sample = self.timed(page_kind, session.get, page_url)
+        if sample[1] == '202' and not options['no_follow_loads']:
+            sample = self.follow_load(session, url, dataset, postcode, page_kind, page_url, sample)
+        samples = [sample]
+
+        if kind.endswith('_post') and 'csrftoken' in session.cookies:
+            samples.append(self.timed(kind, session.post, page_url,
+                                      data={'from-date': from_date, 'to-date': to_date},
+                                      headers={'X-CSRFToken': session.cookies['csrftoken'], 'Referer': page_url}))
+
+        return samples
+
+    def follow_load(self, session: requests.Session, url: str, dataset: str, postcode: str,
+                    kind: str, page_url: str, sample: tuple) -> tuple[str, str, float]:
+        """Given a user's session, and a page that's showing its progress page, this method
+        polls the load's status until it's finished and then views the page again. It
+        returns the sample for the whole wait, as a cold view of the page."""
+
+        start = time.perf_counter() - sample[2]
+        while time.perf_counter() - start < LOAD_TIMEOUT:
+            time.sleep(LOAD_POLL_INTERVAL)
+            try:
+                job_status = session.get(f"{url}/api/{dataset}/{postcode}/status",
+                                         timeout=LOAD_TIMEOUT).json()['status']
+            except (requests.RequestException, ValueError, KeyError):
+                break
+            if job_status not in ('queued', 'running'):
+                break
+
+        _, status, _ = self.timed(kind, session.get, page_url)
+
+        return f"{kind} (cold)", status, time.perf_counter() - start
+
+    def timed(self, kind: str, method, *args, **kwargs) -> tuple[str, str, float]:
+        """Given a kind of request and a session method with its arguments, this method makes
+        the request and returns (kind, status code - or 'error', seconds taken)."""
+
+        start = time.perf_counter()
+        try:
+            response = method(*args, timeout=LOAD_TIMEOUT, **kwargs)
+            status = str(response.status_code)
+        except requests.RequestException:
+            status = 'error'
+
+        return kind, status, time.perf_counter() - start
+
+    def report(self, samples: list[tuple[str, str, float]], seconds: float) -> None:
+        """Given the samples of a test and how long it took, this method writes the latency
+        percentiles and statuses of each kind of request, and of all of them (or dashes, if
+        there weren't any)."""
+
+        self.stdout.write(f"{'':<24} {'count':>6} {'p50':>9} {'p95':>9} {'p99':>9}  statuses")
+        kinds = sorted({kind for kind, _, _ in samples})
+        for kind in kinds + ['all']:
+            kind_samples = [sample for sample in samples if kind in ('all', sample[0])]
+            if not kind_samples:
+                self.stdout.write(f"{kind:<24} {0:>6} {'-':>9} {'-':>9} {'-':>9}")
+                continue
+            p50, p95, p99 = np.percentile([sample[2] for sample in kind_samples], [50, 95, 99]) * 1000
+            statuses = {}
+            for _, status, _ in kind_samples:
+                statuses[status] = statuses.get(status, 0) + 1
+            self.stdout.write(f"{kind:<24} {len(kind_samples):>6} {p50:>7.0f}ms {p95:>7.0f}ms {p99:>7.0f}ms  "
+                              f"{', '.join(f'{status}: {count}' for status, count in sorted(statuses.items()))}")
+
+        self.stdout.write(self.style.SUCCESS(
+            f"{len(samples)} requests in {seconds:.1f}s ({len(samples) / max(seconds, 1e-9):.1f}/s)."))
+
+    def get_upstream_stats(self, upstream: str) -> dict:
+        """Given the replay_server's base url (or None), this method returns its stats."""
+
+        if not upstream:
+            return None
+
+        try:
+            return requests.get(f"{upstream.rstrip('/')}/__stats", timeout=10).json()
+        except (requests.RequestException, ValueError) as error:
+            raise CommandError(f"Couldn't read the upstream stats from {upstream}: {error}")
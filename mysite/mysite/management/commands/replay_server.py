@@ -0,0 +1,65 @@
+'''This file contains the replay_server command, which runs a local stand-in for the Police and
+Postcode APIs (see data/replay_server.py) to load test the app against.'''
+
+from django.core.management.base import BaseCommand, CommandError
+
+from data.fixtures import load_fixtures
+from data.replay_server import make_server, StandInAPI
+
+
+class Command(BaseCommand):
+    help = ("Runs a local stand-in for the Police and Postcode APIs, answering with recorded responses "
+            "(see the benchmark command's --record) and/or synthetic ones. Run the app with "
+            "POLICE_BASE_URL=http://<host>:<port>/api and POSTCODE_BASE_URL=http://<host>:<port> to use it.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1')
+        parser.add_argument('--port', type=int, default=8001)
+        parser.add_argument('--fixtures', help="Recorded responses to answer with.")
+        parser.add_argument('--no-synthetic', action='store_true',
+                            help="Answer requests that weren't recorded with a 404, instead of synthetic data.")
+        parser.add_argument('--latency', type=float, default=0.0,
+                            help="Milliseconds to wait before answering each request (default: 0).")
+        parser.add_argument('--jitter', type=float, default=0.0,
+                            help="Milliseconds the latency may vary by, either way (default: 0).")
+        parser.add_argument('--rate', type=float,
+                            help="Answer with a 429 beyond this many requests per second "
+                            "(the real Police API allows 15; default: no limit).")
+        parser.add_argument('--burst', type=float,
+                            help="The burst of requests allowed over --rate (the real Police API allows 30; "
+                            "default: --rate).")
+        parser.add_argument('--error-rate', type=float, default=0.0,
+                            help="The fraction of requests to fail at random (default: 0).")
+        parser.add_argument('--error-status', type=int, default=500,
+                            help="The status code to fail requests with (default: 500).")
+        parser.add_argument('--log-requests', action='store_true', help="Log every request.")
+
+    def handle(self, *args, **options):
+        responses = {}
+        if options['fixtures']:
+            try:
+                responses = load_fixtures(options['fixtures'])['responses']
+            except OSError as error:
+                raise CommandError(f"Couldn't read {options['fixtures']}: {error}")
+        if options['no_synthetic'] and not responses:
+            raise CommandError("Nothing to answer with - give --fixtures, or allow synthetic responses.")
+
+        api = StandInAPI(responses, synthetic=not options['no_synthetic'],
+                         latency=options['latency'] / 1000, jitter=options['jitter'] / 1000,
+                         rate=options['rate'], burst=options['burst'],
+                         error_rate=options['error_rate'], error_status=options['error_status'])
+        server = make_server(api, options['host'], options['port'],
+                             log=self.stdout.write if options['log_requests'] else None)
+
+        url = f"http://{options['host']}:{options['port']}"
+        self.stdout.write(f"Serving {len(responses)} recorded responses"
+                          f"{'' if options['no_synthetic'] else ' (and synthetic ones)'} at {url}.\n"
+                          f"Run the app with POLICE_BASE_URL={url}/api POSTCODE_BASE_URL={url} - "
+                          f"its stats are at {url}/__stats.")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            self.stdout.write(f"Stats: {api.get_stats()}")
@@ -0,0 +1,106 @@
+'''This file contains the warm_postcodes command, which loads postcodes' data into the store
+and cache ahead of time, so that their first visitors don't wait for the Police API.'''
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from data.extract import normalise_postcode, postcodes_to_coords
+from data.fetch import get_fetch_totals
+from mysite.datasets import DATASET_LOADERS, get_postcode_df, is_postcode_data_cached
+
+
+class Command(BaseCommand):
+    help = ("Loads the data of the given postcodes (or outcodes) into the store and cache. "
+            "Postcodes that are already cached are skipped, so an interrupted run can be resumed "
+            "by running it again.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('postcodes', nargs='*',
+                            help="Postcodes or outcodes to warm.")
+        parser.add_argument('--file', help="A file of postcodes or outcodes, one per line "
+                            "(anything after a comma, and lines starting with #, are ignored).")
+        parser.add_argument('--datasets', nargs='+', choices=list(DATASET_LOADERS),
+                            default=list(DATASET_LOADERS), help="The datasets to warm (default: all).")
+        parser.add_argument('--jobs', type=int, default=4,
+                            help="How many postcodes to load at once (default: 4). The Police API's "
+                            "rate limit is shared between them.")
+
+    def read_postcodes(self, options) -> list[str]:
+        """Given the command's options, this method returns the normalised postcodes
+        to warm, in the order given, without duplicates."""
+
+        postcodes = list(options['postcodes'])
+        if options['file']:
+            try:
+                with open(options['file']) as file:
+                    postcodes += [line.split(',')[0] for line in file
+                                  if line.strip() and not line.startswith('#')]
+            except OSError as error:
+                raise CommandError(f"Couldn't read {options['file']}: {error}")
+
+        postcodes = [normalise_postcode(postcode.strip())
+                     for postcode in postcodes if postcode.strip()]
+
+        return list(dict.fromkeys(postcodes))
+
+    def handle(self, *args, **options):
+        postcodes = self.read_postcodes(options)
+        if not postcodes:
+            raise CommandError("No postcodes given.")
+
+        start = time.perf_counter()
+        fetch_totals = get_fetch_totals()
+
+        coords = postcodes_to_coords(postcodes)
+        for postcode in postcodes:
+            if coords[postcode] is None:
+                self.stderr.write(f"Skipping {postcode}: not a valid postcode.")
+        self.stdout.write(f"Geocoded {len(postcodes)} postcodes in "
+                          f"{time.perf_counter() - start:.1f}s.")
+
+        tasks = [(dataset, postcode) for postcode in postcodes if coords[postcode] is not None
+                 for dataset in options['datasets']]
+        cached_tasks = [(dataset, postcode) for dataset, postcode in tasks
+                        if is_postcode_data_cached(dataset, postcode)]
+        tasks = [task for task in tasks if task not in cached_tasks]
+        if cached_tasks:
+            self.stdout.write(
+                f"Skipping {len(cached_tasks)} already cached postcode datasets.")
+
+        def warm(dataset, postcode):
+            task_start = time.perf_counter()
+            df = get_postcode_df(dataset, postcode)
+            return len(df), time.perf_counter() - task_start
+
+        rows = 0
+        failures = 0
+        with ThreadPoolExecutor(max_workers=max(1, options['jobs'])) as executor:
+            futures = {executor.submit(warm, dataset, postcode): (dataset, postcode)
+                       for dataset, postcode in tasks}
+            for i, future in enumerate(as_completed(futures), start=1):
+                dataset, postcode = futures[future]
+                try:
+                    task_rows, seconds = future.result()
+                except Exception as error:
+                    failures += 1
+                    self.stderr.write(
+                        f"[{i}/{len(tasks)}] {dataset} {postcode}: failed - {error}")
+                    continue
+
+                rows += task_rows
+                self.stdout.write(
+                    f"[{i}/{len(tasks)}] {dataset} {postcode}: {task_rows} rows in {seconds:.1f}s")
+
+        seconds = time.perf_counter() - start
+        fetched = {stat: value - fetch_totals[stat]
+                   for stat, value in get_fetch_totals().items()}
+        self.stdout.write(self.style.SUCCESS(
+            f"Warmed {len(tasks) - failures} postcode datasets ({failures} failed, "
+            f"{len(cached_tasks)} already cached) in {seconds:.1f}s - "
+            f"{(len(tasks) - failures) / seconds * 60:.1f} per minute, {rows / seconds:.0f} rows/s."))
+        self.stdout.write(
+            f"Police API: {fetched['requests']} requests ({fetched['requests'] / seconds:.1f}/s), "
+            f"{fetched['retries']} retries, {fetched['rate_limited']} rate limited, "
+            f"{fetched['wait_seconds']:.1f}s waiting for the rate limiter.")
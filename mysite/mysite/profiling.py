@@ -0,0 +1,158 @@
+'''This file contains the on-demand request profiler. A staff member can add ?profile=1 (or an
+X-Profile: 1 header) to any request to run it under cProfile; the profile is saved to the capture
+folder with what the request was for, its stage timings and row counts, and listed in the admin
+(see the profiles view).'''
+
+from datetime import datetime
+from pathlib import Path
+import cProfile
+import io
+import json
+import logging
+import os
+import pstats
+import re
+import threading
+import time
+import uuid
+
+from django.conf import settings
+
+from data.metrics import get_notes, get_timings
+
+
+PROFILE_PARAMETER = 'profile'
+PROFILE_HEADER = 'X-Profile'
+
+CAPTURE_NAME_PATTERN = re.compile(r'[0-9]{8}T[0-9]{6}_[0-9a-f]{8}')
+
+logger = logging.getLogger(__name__)
+
+# Only one request can be profiled at a time (cProfile is process-wide since Python 3.12).
+_profiler_lock = threading.Lock()
+
+
+def get_capture_dir() -> Path:
+    """This function returns the folder that the profiles are saved in."""
+
+    return Path(settings.PROFILE_CAPTURE_DIR)
+
+
+def wants_profile(request) -> bool:
+    """Given a request, this function returns whether it asks to be profiled, and is
+    allowed to be (only staff members' requests are)."""
+
+    asked = request.GET.get(PROFILE_PARAMETER) == '1' or request.headers.get(PROFILE_HEADER) == '1'
+    user = getattr(request, 'user', None)
+
+    return asked and user is not None and user.is_active and user.is_staff
+
+
+def save_capture(profiler: cProfile.Profile, capture: dict) -> str:
+    """Given a finished profiler and a description of the request it profiled, this
+    function saves both to the capture folder (the profile as a .prof file, readable by
+    pstats or snakeviz) and returns the capture's name. Only the newest
+    PROFILE_MAX_CAPTURES captures are kept."""
+
+    folder = get_capture_dir()
+    folder.mkdir(parents=True, exist_ok=True)
+
+    name = f"{datetime.now():%Y%m%dT%H%M%S}_{uuid.uuid4().hex[:8]}"
+    profiler.dump_stats(folder / f"{name}.prof")
+    temp_path = folder / f"{name}.json.tmp"
+    with open(temp_path, 'w') as file:
+        json.dump({'name': name, **capture}, file)
+    os.replace(temp_path, folder / f"{name}.json")
+
+    for old_capture in sorted(folder.glob('*.json'))[:-settings.PROFILE_MAX_CAPTURES]:
+        old_capture.unlink(missing_ok=True)
+        old_capture.with_suffix('.prof').unlink(missing_ok=True)
+
+    return name
+
+
+def list_captures(limit: int = 50) -> list[dict]:
+    """Given a number of captures, this function returns the descriptions of that
+    many of the newest captures, newest first."""
+
+    captures = []
+    for path in sorted(get_capture_dir().glob('*.json'), reverse=True)[:limit]:
+        try:
+            with open(path) as file:
+                captures.append(json.load(file))
+        except (OSError, json.JSONDecodeError):
+            # Deleted (or being written) while listing
+            continue
+
+    return captures
+
+
+def capture_profile_path(name: str) -> Path:
+    """Given a capture's name, this function returns the path of its profile, or
+    None if the name isn't a capture's."""
+
+    if CAPTURE_NAME_PATTERN.fullmatch(name) is None:
+        return None
+
+    return get_capture_dir() / f"{name}.prof"
+
+
+def capture_summary(name: str, limit: int = 40) -> str:
+    """Given a capture's name, this function returns its profile's top functions by
+    cumulative time, as text."""
+
+    output = io.StringIO()
+    stats = pstats.Stats(str(capture_profile_path(name)), stream=output)
+    stats.sort_stats('cumulative').print_stats(limit)
+
+    return output.getvalue()
+
+
+class ProfilingMiddleware:
+    """Runs the requests that ask to be profiled (see wants_profile) under cProfile,
+    saving a capture of each and naming it in the response's X-Profile-Capture header.
+    It must come after the authentication middleware, and within the Server-Timing
+    middleware (whose stage timings the captures include)."""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not wants_profile(request):
+            return self.get_response(request)
+
+        if not _profiler_lock.acquire(blocking=False):
+            response = self.get_response(request)
+            response['X-Profile-Capture'] = 'busy'
+            return response
+
+        try:
+            profiler = cProfile.Profile()
+            start = time.perf_counter()
+            profiler.enable()
+            try:
+                response = self.get_response(request)
+            finally:
+                profiler.disable()
+            seconds = time.perf_counter() - start
+        finally:
+            _profiler_lock.release()
+
+        match = request.resolver_match
+        kwargs = match.kwargs if match else {}
+        app = match.func.__module__.split('.')[0] if match else None
+        capture = {'created_at': datetime.now().isoformat(timespec='seconds'),
+                   'method': request.method, 'path': request.get_full_path(),
+                   'view': f"{match.func.__module__}.{match.func.__name__}" if match else None,
+                   'dataset': kwargs.get('dataset', app if app in ('crimes', 'stop_and_searches') else None),
+                   'postcode': kwargs.get('postcode', kwargs.get('postcodes', '')).replace(" ", "").lower() or None,
+                   'status': response.status_code, 'seconds': seconds,
+                   'stages': get_timings(), 'rows': get_notes(),
+                   'user': request.user.get_username()}
+
+        try:
+            response['X-Profile-Capture'] = save_capture(profiler, capture)
+        except OSError as error:
+            logger.warning("Couldn't save the profile of %s: %s", request.path, error)
+
+        return response
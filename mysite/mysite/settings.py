@@ -15,7 +15,6 @@ import os
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
-print(BASE_DIR)
 
 
 # Quick-start development settings - unsuitable for production
@@ -39,9 +38,11 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
+    'mysite',
 ]
 
 MIDDLEWARE = [
+    'mysite.instrumentation.ServerTimingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -49,6 +50,7 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'mysite.profiling.ProfilingMiddleware',
 ]
 
 ROOT_URLCONF = 'mysite.urls'
@@ -123,7 +125,46 @@ STATIC_URL = "Static/"
 STATICFILES_DIRS = [BASE_DIR / "crimes/static",
                     BASE_DIR / "stop_and_searches/static",
                     BASE_DIR / "mysite/static"]
-print()
+
+# Rendered chart images, cached under a hash of what they show (see mysite/charts.py).
+CHART_CACHE_DIR = os.environ.get("CHART_CACHE_DIR", BASE_DIR / "chart_cache")
+CHART_CACHE_MAX_BYTES = int(os.environ.get(
+    "CHART_CACHE_MAX_BYTES", 200 * 1024 * 1024))
+
+
+# Whether processes serving requests start the chart render processes and the refresher of the
+# tracked postcodes (see mysite/apps.py) - the tests turn it off.
+START_BACKGROUND_WORK = os.environ.get("START_BACKGROUND_WORK", "1") == "1"
+
+# The addresses allowed to read /metrics (see mysite/instrumentation.py) - local ones by default.
+METRICS_ALLOWED_IPS = os.environ.get("METRICS_ALLOWED_IPS", "127.0.0.1,::1").split(",")
+
+# Where staff members' profiled requests are saved (see mysite/profiling.py), and how many are kept.
+PROFILE_CAPTURE_DIR = os.environ.get("PROFILE_CAPTURE_DIR", BASE_DIR / "profiles")
+PROFILE_MAX_CAPTURES = int(os.environ.get("PROFILE_MAX_CAPTURES", 100))
+
+# LOG_LEVEL sets how much the app logs, and LOG_SAMPLE_RATE the fraction of records
+# below warnings (e.g. each request's timings, at DEBUG) that are kept.
+LOGGING = {
+    "version": 1,
+    "disable_existing_loggers": False,
+    "filters": {
+        "sample": {
+            "()": "mysite.instrumentation.SamplingFilter",
+            "rate": float(os.environ.get("LOG_SAMPLE_RATE", 1.0)),
+        },
+    },
+    "formatters": {
+        "plain": {"format": "{asctime} {levelname} {name}: {message}", "style": "{"},
+    },
+    "handlers": {
+        "console": {"class": "logging.StreamHandler", "formatter": "plain", "filters": ["sample"]},
+    },
+    "loggers": {
+        name: {"handlers": ["console"], "level": os.environ.get("LOG_LEVEL", "INFO"), "propagate": False}
+        for name in ["data", "mysite", "crimes", "stop_and_searches"]
+    },
+}
 
 
 # Default primary key field type
@@ -0,0 +1,151 @@
+'''This file contains what the apps' tests share - a test case that runs the app offline against
+recorded responses (see data/fixtures.py) of the replay server's synthetic Police and Postcode
+APIs, with its own store, columnar cache, chart cache and profile folder.'''
+
+from contextlib import contextmanager
+from pathlib import Path
+from unittest import mock
+import json
+import os
+import tempfile
+import time
+
+from django.test import TestCase, override_settings
+
+from data import analyse, extract, session, spatial
+from data.analyse import get_crime_data_df, get_ss_data_df
+from data.extract import (POLICE_BASE_URL, get_relevant_street_crimes_data, postcode_to_coords,
+                          postcodes_to_coords)
+from data.fixtures import fixture_key, RecordingAdapter, ReplayAdapter
+from data.replay_server import StandInAPI, StandInAdapter, synthetic_dates, synthetic_postcode_coords
+from .datasets import STARTING_YEAR
+from .jobs import get_load_job_status
+
+
+# The postcodes recorded, and one whose stop and searches are all recorded as empty.
+POSTCODES = ['nw51tu', 'e16an']
+EMPTY_SS_POSTCODE = 'se19sg'
+
+# How many of the latest (synthetic) months are published.
+MONTHS = 3
+
+DATES_FIXTURE_KEY = fixture_key('GET', POLICE_BASE_URL + '/crimes-street-dates')
+
+_responses = None
+
+
+def reset_process_caches() -> None:
+    """This function forgets what this process has cached outside of the store and the
+    columnar cache - the published months, geocodes and the spatial index."""
+
+    analyse._published_months = (0.0, None)
+    extract._postcode_coords.clear()
+    spatial._crime_index = None
+    spatial._crime_batches.clear()
+
+
+@contextmanager
+def scratch_store():
+    """This context manager points the store at an empty database (and forgets this
+    process's caches) for what it wraps."""
+
+    with tempfile.TemporaryDirectory() as folder, \
+            mock.patch.dict(os.environ, {'DATA_STORE_PATH': str(Path(folder) / 'store.sqlite3')}):
+        reset_process_caches()
+        try:
+            yield
+        finally:
+            reset_process_caches()
+
+
+def record_responses() -> dict[str, dict]:
+    """This function returns the recorded responses of the synthetic APIs to everything
+    the app (and the benchmark command) asks for when it loads POSTCODES and
+    EMPTY_SS_POSTCODE over the latest MONTHS months (recording them the first time
+    it's called)."""
+
+    global _responses
+    if _responses is not None:
+        return _responses
+
+    feed = json.dumps([{'date': f"{year}-{month:02d}", 'stop-and-search': []}
+                       for year, month in synthetic_dates(MONTHS)])
+    recorder = RecordingAdapter(StandInAdapter(StandInAPI()),
+                                {DATES_FIXTURE_KEY: {'status': 200, 'body': feed}})
+    postcodes = POSTCODES + [EMPTY_SS_POSTCODE]
+
+    session.set_transport(recorder)
+    try:
+        # Geocodes are stored once looked up, so each lookup is recorded with an empty store.
+        for postcode in postcodes:
+            with scratch_store():
+                postcode_to_coords(postcode)
+        for postcode_list in [[postcode] for postcode in postcodes] + [POSTCODES, postcodes]:
+            with scratch_store():
+                postcodes_to_coords(postcode_list)
+
+        with scratch_store():
+            for postcode in postcodes:
+                get_crime_data_df(postcode, STARTING_YEAR)
+                get_ss_data_df(postcode, STARTING_YEAR)
+                # The original (non-tiled) crimes endpoint, which the benchmark times
+                for year, month in synthetic_dates(MONTHS):
+                    get_relevant_street_crimes_data(postcode_to_coords(postcode), year, month)
+    finally:
+        session.set_transport(None)
+
+    longitude, latitude = synthetic_postcode_coords(EMPTY_SS_POSTCODE)
+    for key, response in recorder.responses.items():
+        if '/stops-street?' in key and f"lat={latitude}&lng={longitude}&" in key:
+            response['body'] = '[]'
+
+    _responses = recorder.responses
+    return _responses
+
+
+class OfflineTestCase(TestCase):
+    """A test case whose tests run against replayed responses (see record_responses),
+    each with an empty store, columnar cache and chart cache of its own."""
+
+    def setUp(self):
+        folder = tempfile.TemporaryDirectory()
+        self.addCleanup(folder.cleanup)
+        self.folder = Path(folder.name)
+
+        environment = mock.patch.dict(os.environ, {'DATA_STORE_PATH': str(self.folder / 'store.sqlite3'),
+                                                   'DATA_COLUMNAR_PATH': str(self.folder / 'columnar')})
+        environment.start()
+        self.addCleanup(environment.stop)
+
+        test_settings = override_settings(CHART_CACHE_DIR=str(self.folder / 'charts'),
+                                          PROFILE_CAPTURE_DIR=str(self.folder / 'profiles'),
+                                          START_BACKGROUND_WORK=False)
+        test_settings.enable()
+        self.addCleanup(test_settings.disable)
+
+        self.responses = record_responses()
+        reset_process_caches()
+        self.addCleanup(reset_process_caches)
+        session.set_transport(ReplayAdapter(self.responses))
+        self.addCleanup(session.set_transport, None)
+
+    def wait_for_load_job(self, dataset: str, postcode: str, timeout: float = 60) -> dict:
+        """Given a dataset and a normalised postcode, this method waits for its load job
+        to finish (so it can't outlive the test's store) and returns the job's status."""
+
+        deadline = time.monotonic() + timeout
+        job = get_load_job_status(dataset, postcode)
+        while job['status'] in ['queued', 'running'] and time.monotonic() < deadline:
+            time.sleep(0.1)
+            job = get_load_job_status(dataset, postcode)
+
+        return job
+
+    def use_stand_in(self, **options) -> StandInAPI:
+        """Given a stand-in API's options (see StandInAPI), this method answers the test's
+        requests with a new stand-in (rather than the recorded responses) and returns it."""
+
+        api = StandInAPI(**options)
+        session.set_transport(StandInAdapter(api))
+
+        return api
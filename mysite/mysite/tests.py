@@ -0,0 +1,1045 @@
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import closing
+from io import StringIO
+from unittest import mock
+import csv
+import json
+import logging
+import os
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management import call_command, CommandError
+from django.test import SimpleTestCase
+
+import numpy as np
+import pandas as pd
+
+from data import analyse, bulk, extract, fetch, render, spatial
+from data.bulk import archive_csv_files, ArchiveImporter, csv_crime_id
+from data.columnar import delete_frame, load_frame, save_frame
+from data.cube import build_cube, SS_CUBE_DIMENSIONS
+from data.extract import APIError, postcode_to_coords, postcodes_to_coords
+from data.fetch import fetch_many, fetch_with_retries, SharedTokenBucket, TokenBucket
+from data.fixtures import save_fixtures
+from data.metrics import render_metrics, stage, start_timings, stop_timings
+from data.render import get_render_pool, render_charts
+from data.replay_server import SYNTHETIC_CRIMES_PER_TILE, synthetic_dates, synthetic_postcode_coords
+from data.spatial import build_crime_index, CELL_LATITUDE, CELL_LONGITUDE, get_crime_index, SpatialIndex
+from data.store import (acquire_lock, beat_jobs, create_job, get_connection, get_tracked_postcodes, load_job,
+                        load_months, load_postcode_coords, load_stored_dates, save_month, save_postcode_coords,
+                        update_job)
+from data.tiles import (distance_metres, get_crime_columns_around, get_stored_tiles_data, get_tile_crimes_data,
+                        MAX_TILE_SPLITS, RADIUS_METRES, tiles_covering, tiles_of)
+from data.visualise import plot_bar
+from . import datasets, profiling
+from .charts import chart_key, chart_path, evict_charts, get_chart_urls, save_chart
+from .datasets import (DATASET_LOADERS, dataset_cache_key, get_cached_postcode_data, get_postcode_cube,
+                       get_postcode_df, is_postcode_data_cached, LOAD_LOCK_TIMEOUT, LoadInProgress, refresh_postcodes,
+                       run_refresher, uncache_postcode_data)
+from .instrumentation import SamplingFilter
+from .jobs import JOB_HEARTBEAT_TIMEOUT, start_load_job
+from .management.commands.benchmark import STAGES
+from .profiling import CAPTURE_NAME_PATTERN, capture_profile_path, list_captures
+from .testing import DATES_FIXTURE_KEY, OfflineTestCase, POSTCODES, MONTHS, record_responses
+
+
+def failing_then(result, errors: list):
+    """Given a result and a list of errors, this function returns a fetch function that
+    raises each of the errors in turn, and then returns the result."""
+
+    errors = list(errors)
+
+    def fetch_function(*args):
+        if errors:
+            raise errors.pop(0)
+        return result
+
+    return fetch_function
+
+
+class StoreTests(OfflineTestCase):
+
+    coords = (-0.1415274, 51.5532486)
+
+    def test_months_round_trip(self):
+        data = [{'category': 'burglary', 'location': {'street': {'name': 'On or near Mill Lane'}}}]
+        save_month('stop_and_searches', self.coords, 2023, 1, data)
+        save_month('stop_and_searches', self.coords, 2023, 2, [])
+
+        self.assertEqual(load_months('stop_and_searches', self.coords, [(2023, 1), (2023, 2), (2023, 3)]),
+                         {(2023, 1): data, (2023, 2): []})
+        self.assertEqual(load_stored_dates('stop_and_searches', self.coords), {(2023, 1), (2023, 2)})
+        # Other datasets, and locations beyond postcodes.io's precision, are kept apart
+        self.assertEqual(load_months('crime_tiles', self.coords, [(2023, 1)]), {})
+        self.assertEqual(load_months('stop_and_searches', (self.coords[0] + 1e-5, self.coords[1]), [(2023, 1)]), {})
+        self.assertEqual(load_months('stop_and_searches', (self.coords[0] + 1e-8, self.coords[1]), [(2023, 1)]),
+                         {(2023, 1): data})
+
+    def test_months_are_overwritten(self):
+        save_month('stop_and_searches', self.coords, 2023, 1, [{'id': 1}])
+        save_month('stop_and_searches', self.coords, 2023, 1, [{'id': 2}])
+
+        self.assertEqual(load_months('stop_and_searches', self.coords, [(2023, 1)]), {(2023, 1): [{'id': 2}]})
+
+    def test_postcode_coords_round_trip(self):
+        save_postcode_coords({'nw51tu': self.coords})
+
+        self.assertEqual(load_postcode_coords(['nw51tu', 'e16an']), {'nw51tu': self.coords})
+
+
+class GeocodeTests(OfflineTestCase):
+
+    def test_bulk_geocode(self):
+        self.api = self.use_stand_in(responses={'GET /outcodes/zz9': {'status': 404, 'body': json.dumps(
+            {'status': 404, 'error': 'Outcode not found'})}})
+        postcodes = [f"SW{n + 10} AB" for n in range(250)]
+        save_postcode_coords({'nw51tu': (-0.1, 51.5)})
+        extract._postcode_coords['e16an'] = (-0.2, 51.6)
+
+        coords = postcodes_to_coords(postcodes + ['nw51tu', 'e16an', 'nw5', 'zz9', 'notapostcode'])
+
+        self.assertEqual(self.api.get_stats()['requests'], {'postcodes': 3, 'outcodes': 2})
+        self.assertEqual(coords['sw10ab'], synthetic_postcode_coords('sw10ab'))
+        self.assertEqual(len([postcode for postcode in coords if coords[postcode] is not None]), 253)
+        self.assertEqual((coords['nw51tu'], coords['e16an']), ((-0.1, 51.5), (-0.2, 51.6)))
+        self.assertEqual(coords['nw5'], synthetic_postcode_coords('nw5'))
+        self.assertIsNone(coords['zz9'])
+        self.assertIsNone(coords['notapostcode'])
+
+        # Geocoded postcodes are stored, so they aren't looked up again
+        extract._postcode_coords.clear()
+        coords_again = postcodes_to_coords(postcodes[:150] + ['nw5'])
+        self.assertEqual(coords_again, {postcode: coords[postcode] for postcode in coords_again})
+        self.assertEqual(len(coords_again), 151)
+        self.assertEqual(self.api.get_stats()['requests'], {'postcodes': 3, 'outcodes': 2})
+
+    def test_outcode_errors_are_raised(self):
+        self.use_stand_in(responses={'GET /outcodes/zz9': {'status': 500, 'body': json.dumps(
+            {'status': 500, 'error': 'Internal server error'})}})
+
+        with self.assertRaises(APIError) as context:
+            postcodes_to_coords(['nw51tu', 'zz9'])
+        self.assertEqual(context.exception.status_code, 500)
+
+
+class FetchTests(SimpleTestCase):
+
+    def setUp(self):
+        self.stats = {'requests': 0, 'retries': 0, 'rate_limited': 0, 'errors': 0, 'wait_seconds': 0.0}
+        self.bucket = TokenBucket(1000, 1000)
+        backoff = mock.patch.object(fetch, 'BACKOFF_BASE', 0)
+        backoff.start()
+        self.addCleanup(backoff.stop)
+
+    def fetch(self, fetch_function):
+        return fetch_with_retries(fetch_function, (), self.stats, threading.Lock(), self.bucket)
+
+    def test_retries_rate_limited_and_failed_requests(self):
+        self.assertEqual(self.fetch(failing_then('data', [APIError(429), APIError(503)])), 'data')
+        self.assertEqual(self.stats['requests'], 3)
+        self.assertEqual(self.stats['retries'], 2)
+        self.assertEqual(self.stats['rate_limited'], 1)
+        self.assertEqual(self.stats['errors'], 0)
+
+    def test_does_not_retry_client_errors(self):
+        with self.assertRaises(APIError):
+            self.fetch(failing_then('data', [APIError(404)]))
+        self.assertEqual(self.stats['requests'], 1)
+        self.assertEqual(self.stats['errors'], 1)
+
+    def test_gives_up_after_max_retries(self):
+        with self.assertRaises(APIError):
+            self.fetch(failing_then('data', [APIError(429)] * (fetch.MAX_RETRIES + 1)))
+        self.assertEqual(self.stats['requests'], fetch.MAX_RETRIES + 1)
+        self.assertEqual(self.stats['retries'], fetch.MAX_RETRIES)
+
+    def test_fetch_many_keeps_the_order(self):
+        results, stats = fetch_many(lambda number: number * 2, [(number,) for number in range(20)], self.bucket)
+
+        self.assertEqual(results, [number * 2 for number in range(20)])
+        self.assertEqual(stats['calls'], 20)
+
+    def test_token_bucket_limits_bursts(self):
+        bucket = TokenBucket(rate=0.001, capacity=2)
+
+        self.assertEqual([bucket.try_acquire() for _ in range(3)], [True, True, False])
+
+
+class SharedTokenBucketTests(OfflineTestCase):
+
+    def test_buckets_of_the_same_name_share_a_limit(self):
+        bucket = SharedTokenBucket('test', rate=0.001, capacity=2)
+        other_bucket = SharedTokenBucket('test', rate=0.001, capacity=2)
+
+        self.assertTrue(bucket.try_acquire())
+        self.assertTrue(other_bucket.try_acquire())
+        self.assertFalse(bucket.try_acquire())
+        self.assertTrue(SharedTokenBucket('other', rate=0.001, capacity=2).try_acquire())
+
+    def test_acquire_waits_for_a_token(self):
+        bucket = SharedTokenBucket('test', rate=100, capacity=1)
+
+        self.assertEqual(bucket.acquire(), 0)
+        self.assertGreater(bucket.acquire(), 0)
+
+
+class ChartCacheTests(OfflineTestCase):
+
+    def chart_urls(self, charts: list[str], **options) -> dict[str, str]:
+        return get_chart_urls('stop_and_searches', 'nw51tu', '2023-01-01', '2023-03-01',
+                              {chart: (plot_bar, {}) for chart in charts}, **options)
+
+    def test_chart_key(self):
+        key = chart_key('crimes', 'nw51tu', '2023-01-01', '2023-03-01', 'plot_bar', None, 10)
+
+        self.assertEqual(key, chart_key('crimes', 'nw51tu', '2023-01-01', '2023-03-01', 'plot_bar', None, 10))
+        for changed in [('stop_and_searches', 'nw51tu', '2023-01-01', '2023-03-01', 'plot_bar', None, 10),
+                        ('crimes', 'e16an', '2023-01-01', '2023-03-01', 'plot_bar', None, 10),
+                        ('crimes', 'nw51tu', '2023-02-01', '2023-03-01', 'plot_bar', None, 10),
+                        ('crimes', 'nw51tu', '2023-01-01', '2023-03-01', 'plot_bar', 'gender', 10),
+                        ('crimes', 'nw51tu', '2023-01-01', '2023-03-01', 'plot_bar', None, 11)]:
+            self.assertNotEqual(chart_key(*changed), key)
+
+    def test_third_variables_only_key_their_charts(self):
+        with mock.patch('mysite.charts.render_charts', side_effect=lambda charts: dict.fromkeys(charts, b'png')):
+            urls = self.chart_urls(['hours', 'objects'])
+            gender_urls = self.chart_urls(['hours', 'objects'], third_vars={'objects': 'gender'})
+
+        self.assertEqual(gender_urls['hours'], urls['hours'])
+        self.assertNotEqual(gender_urls['objects'], urls['objects'])
+
+    def test_cached_charts_are_marked_as_used(self):
+        with mock.patch('mysite.charts.render_charts', side_effect=lambda charts: dict.fromkeys(charts, b'png')):
+            key = self.chart_urls(['hours'])['hours'].rstrip('/').rsplit('/', 1)[-1].removesuffix('.png')
+        os.utime(chart_path(key), (0, 0))
+
+        with mock.patch('mysite.charts.render_charts') as render:
+            self.chart_urls(['hours'])
+
+        render.assert_not_called()
+        self.assertGreater(os.path.getmtime(chart_path(key)), time.time() - 60)
+
+    def test_evict_charts_keeps_the_most_recently_used(self):
+        for i in range(10):
+            save_chart(f"chart{i}", b'x' * 100)
+            os.utime(chart_path(f"chart{i}"), (1000 + i, 1000 + i))
+
+        evict_charts(1000)
+        self.assertEqual(len(os.listdir(settings.CHART_CACHE_DIR)), 10)
+
+        evict_charts(500)
+        # Down to 90% of the limit, oldest first
+        self.assertEqual(sorted(os.listdir(settings.CHART_CACHE_DIR)), [f"chart{i}.png" for i in range(6, 10)])
+
+
+class RenderTests(SimpleTestCase):
+
+    def setUp(self):
+        df = pd.DataFrame({'category': [3, 2]}, index=['burglary', 'drugs'])
+        self.charts = {'first': (plot_bar, {'df': df}), 'second': (plot_bar, {'df': df.iloc[:1]})}
+
+    def test_render_charts_through_the_pool(self):
+        images = render_charts(self.charts)
+
+        self.assertEqual(sorted(images), ['first', 'second'])
+        for image in images.values():
+            self.assertTrue(image.startswith(b'\x89PNG'))
+        self.assertIsNotNone(render._pool)
+        self.assertEqual(render._pool_pid, os.getpid())
+
+    def test_a_broken_pool_renders_in_this_process(self):
+        # A render process that dies breaks the pool
+        with self.assertRaises(BrokenProcessPool):
+            get_render_pool().submit(os._exit, 1).result()
+
+        with mock.patch.object(render, 'render_png', wraps=render.render_png) as render_png:
+            images = render_charts(self.charts)
+
+        self.assertEqual(render_png.call_count, 2)
+        self.assertEqual(sorted(images), ['first', 'second'])
+        # The pool is started again for the next charts
+        self.assertIsNone(render._pool)
+        self.assertTrue(all(image.startswith(b'\x89PNG') for image in render_charts(self.charts).values()))
+        self.assertIsNotNone(render._pool)
+
+
+class SingleFlightTests(OfflineTestCase):
+
+    postcode = POSTCODES[0]
+
+    def setUp(self):
+        super().setUp()
+        self.api = self.use_stand_in(responses={DATES_FIXTURE_KEY: self.responses[DATES_FIXTURE_KEY]})
+        for setting, value in [('LOAD_WAIT_TIMEOUT', 0.5), ('LOAD_POLL_INTERVAL', 0.05)]:
+            patch = mock.patch.object(datasets, setting, value)
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def test_concurrent_cold_loads_fetch_once(self):
+        barrier = threading.Barrier(5)
+        cubes = []
+
+        def load():
+            barrier.wait()
+            cubes.append(get_postcode_cube('crimes', self.postcode))
+
+        with mock.patch.object(datasets, 'LOAD_WAIT_TIMEOUT', 60):
+            threads = [threading.Thread(target=load) for _ in range(5)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual(len(cubes), 5)
+        for cube in cubes[1:]:
+            pd.testing.assert_frame_equal(cube.copy(), cubes[0].copy())
+        self.assertEqual(self.api.get_stats()['requests']['crimes-street'],
+                         len(tiles_covering(postcode_to_coords(self.postcode))) * MONTHS)
+        self.assertEqual(datasets._load_locks, {})
+
+    def test_gives_up_while_another_process_loads(self):
+        lock_name = dataset_cache_key('crimes', self.postcode, 'load')
+        acquire_lock(lock_name, 'another process', datasets.LOAD_LOCK_TIMEOUT)
+
+        with self.assertRaises(LoadInProgress):
+            get_postcode_cube('crimes', self.postcode)
+
+        self.assertEqual(self.api.get_stats()['requests'], {})
+        self.assertEqual(datasets._load_locks, {})
+
+    def test_gives_up_while_another_thread_loads(self):
+        lock_name = dataset_cache_key('crimes', self.postcode, 'load')
+        load_lock = datasets.get_load_lock(lock_name)
+        load_lock.acquire()
+        try:
+            with self.assertRaises(LoadInProgress):
+                get_postcode_cube('crimes', self.postcode)
+            self.assertIn(lock_name, datasets._load_locks)
+        finally:
+            load_lock.release()
+            datasets.forget_load_lock(lock_name)
+
+        self.assertEqual(datasets._load_locks, {})
+
+
+class RefreshTests(OfflineTestCase):
+
+    postcode = POSTCODES[0]
+
+    def setUp(self):
+        super().setUp()
+        self.dates = sorted(synthetic_dates(MONTHS))
+        self.api = self.use_stand_in(responses={DATES_FIXTURE_KEY: self.dates_feed(self.dates[:-1])})
+
+    def dates_feed(self, dates: list[tuple[int, int]]) -> dict:
+        return {'status': 200, 'body': json.dumps([{'date': f"{year}-{month:02d}", 'stop-and-search': []}
+                                                   for year, month in dates])}
+
+    def test_refresh_fetches_only_the_new_month(self):
+        for dataset in DATASET_LOADERS:
+            get_postcode_cube(dataset, self.postcode)
+        self.assertEqual({latest_date for _, _, latest_date in get_tracked_postcodes()}, {self.dates[-2]})
+
+        # The next month is published
+        self.api.responses[DATES_FIXTURE_KEY] = self.dates_feed(self.dates)
+        analyse._published_months = (0.0, None)
+        requests = self.api.get_stats()['requests']
+
+        self.assertEqual(refresh_postcodes(), len(DATASET_LOADERS))
+
+        new_requests = self.api.get_stats()['requests']
+        self.assertEqual(new_requests['crimes-street'] - requests['crimes-street'],
+                         len(tiles_covering(postcode_to_coords(self.postcode))))
+        self.assertEqual(new_requests['stops-street'] - requests['stops-street'], 1)
+        self.assertEqual(get_tracked_postcodes(), [(dataset, self.postcode, self.dates[-1])
+                                                   for dataset in sorted(DATASET_LOADERS)])
+
+        for dataset in DATASET_LOADERS:
+            refreshed = {kind: get_cached_postcode_data(dataset, self.postcode, kind) for kind in ['df', 'cube']}
+            uncache_postcode_data(dataset, self.postcode)
+            rebuilt = {'df': get_postcode_df(dataset, self.postcode), 'cube': get_postcode_cube(dataset, self.postcode)}
+
+            for kind in ['df', 'cube']:
+                columns = list(rebuilt[kind].columns)
+                self.assertEqual(refreshed[kind].dtypes.astype(str).to_dict(),
+                                 rebuilt[kind].dtypes.astype(str).to_dict())
+                pd.testing.assert_frame_equal(
+                    refreshed[kind].astype(str).sort_values(columns, ignore_index=True),
+                    rebuilt[kind].astype(str).sort_values(columns, ignore_index=True))
+            self.assertEqual(refreshed['cube']['date'].max(), pd.Timestamp(*self.dates[-1], 1))
+
+        # Nothing more is fetched once the postcodes are up to date
+        self.assertEqual(refresh_postcodes(), 0)
+        self.assertEqual(self.api.get_stats()['requests'], new_requests)
+
+    def test_refresher_runs_in_one_process_at_a_time(self):
+        class Stop(Exception):
+            pass
+
+        with mock.patch('mysite.datasets.refresh_postcodes') as refresh, \
+                mock.patch('mysite.datasets.time.sleep', side_effect=Stop):
+            for _ in range(2):
+                with self.assertRaises(Stop):
+                    run_refresher()
+
+        # The first refreshes straight away, and the second finds the interval's lock taken
+        self.assertEqual(refresh.call_count, 1)
+
+
+class WarmPostcodesTests(OfflineTestCase):
+
+    def warm(self, *args) -> tuple[str, str]:
+        stdout, stderr = StringIO(), StringIO()
+        call_command('warm_postcodes', *args, '--jobs', '2', stdout=stdout, stderr=stderr)
+
+        return stdout.getvalue(), stderr.getvalue()
+
+    def test_warm_postcodes(self):
+        api = self.use_stand_in(responses={DATES_FIXTURE_KEY: self.responses[DATES_FIXTURE_KEY]})
+        postcodes_file = self.folder / 'postcodes.csv'
+        postcodes_file.write_text("# postcode,name\nE1 6AN,Aldgate\n\nnotapostcode\nnw51tu\n")
+
+        stdout, stderr = self.warm('NW5 1TU', '--file', str(postcodes_file))
+
+        self.assertIn("Skipping notapostcode: not a valid postcode.", stderr)
+        self.assertIn("Warmed 4 postcode datasets (0 failed, 0 already cached)", stdout)
+        for dataset in DATASET_LOADERS:
+            for postcode in POSTCODES:
+                self.assertTrue(is_postcode_data_cached(dataset, postcode))
+
+        # Cached postcodes are skipped, without asking the Police API again
+        police_requests = {endpoint: count for endpoint, count in api.get_stats()['requests'].items()
+                           if endpoint not in ('postcodes', 'outcodes')}
+        stdout, _ = self.warm('--file', str(postcodes_file), 'e16an')
+
+        self.assertIn("Skipping 4 already cached postcode datasets.", stdout)
+        self.assertIn("Warmed 0 postcode datasets (0 failed, 4 already cached)", stdout)
+        self.assertEqual({endpoint: count for endpoint, count in api.get_stats()['requests'].items()
+                          if endpoint not in ('postcodes', 'outcodes')}, police_requests)
+
+    def test_no_postcodes(self):
+        with self.assertRaises(CommandError):
+            self.warm()
+        with self.assertRaises(CommandError):
+            self.warm('--file', str(self.folder / 'missing.csv'))
+
+
+class LoadJobTests(OfflineTestCase):
+
+    postcode = POSTCODES[0]
+
+    def setUp(self):
+        super().setUp()
+        self.name = dataset_cache_key('crimes', self.postcode, 'job')
+
+    def set_job(self, **columns):
+        get_connection().execute(f"UPDATE jobs SET {', '.join(f'{column} = ?' for column in columns)} WHERE name = ?",
+                                 (*columns.values(), self.name))
+
+    def dead_pid(self) -> int:
+        process = subprocess.Popen([sys.executable, '-c', ''])
+        process.wait()
+        return process.pid
+
+    def test_jobs_are_owned_by_their_process(self):
+        self.assertTrue(create_job(self.name, LOAD_LOCK_TIMEOUT, JOB_HEARTBEAT_TIMEOUT))
+
+        job = load_job(self.name)
+        self.assertEqual(job['pid'], os.getpid())
+        self.assertFalse(create_job(self.name, LOAD_LOCK_TIMEOUT, JOB_HEARTBEAT_TIMEOUT))
+
+        self.set_job(heartbeat_at=0)
+        beat_jobs([self.name])
+        self.assertGreater(load_job(self.name)['heartbeat_at'], job['updated_at'] - 1)
+
+    def test_jobs_of_a_process_that_has_gone_are_requeued(self):
+        update_job(self.name, 'running', 1, 3)
+        self.set_job(pid=self.dead_pid())
+
+        self.assertTrue(create_job(self.name, LOAD_LOCK_TIMEOUT, JOB_HEARTBEAT_TIMEOUT))
+        self.assertEqual(load_job(self.name)['status'], 'queued')
+        self.assertEqual(load_job(self.name)['pid'], os.getpid())
+
+    def test_jobs_without_a_heartbeat_are_requeued(self):
+        update_job(self.name, 'running', 1, 3)
+        self.set_job(heartbeat_at=time.time() - JOB_HEARTBEAT_TIMEOUT - 1)
+
+        self.assertTrue(create_job(self.name, LOAD_LOCK_TIMEOUT, JOB_HEARTBEAT_TIMEOUT))
+
+    def test_older_stores_get_the_new_job_columns(self):
+        path = self.folder / 'old_store.sqlite3'
+        with closing(sqlite3.connect(path)) as connection:
+            connection.execute('CREATE TABLE jobs (name TEXT PRIMARY KEY, status TEXT NOT NULL, done INTEGER NOT NULL, '
+                               'total INTEGER NOT NULL, error TEXT, updated_at REAL NOT NULL)')
+
+        with mock.patch.dict(os.environ, {'DATA_STORE_PATH': str(path)}):
+            self.assertTrue(create_job(self.name, LOAD_LOCK_TIMEOUT, JOB_HEARTBEAT_TIMEOUT))
+            self.assertEqual(load_job(self.name)['pid'], os.getpid())
+
+    def test_a_dead_job_is_taken_over(self):
+        update_job(self.name, 'queued')
+        self.set_job(pid=self.dead_pid())
+
+        self.assertIn(start_load_job('crimes', self.postcode)['status'], ['queued', 'running', 'done'])
+        self.assertEqual(self.wait_for_load_job('crimes', self.postcode)['status'], 'done')
+
+
+class TileTests(OfflineTestCase):
+
+    coords = (-0.1415274, 51.5532486)
+    year, month = synthetic_dates(1)[0]
+
+    def setUp(self):
+        super().setUp()
+        self.api = self.use_stand_in()
+        backoff = mock.patch.object(fetch, 'BACKOFF_BASE', 0)
+        backoff.start()
+        self.addCleanup(backoff.stop)
+
+    def test_tiles_cover_the_radius(self):
+        rng = np.random.default_rng(0)
+
+        # Points scattered over the radius (on both sides of the meridian) are in its tiles
+        for coords in [self.coords, (0.0, 51.5), (-0.03, 51.52)]:
+            tiles = tiles_covering(coords)
+            longitudes = coords[0] + rng.uniform(-0.03, 0.03, 10000)
+            latitudes = coords[1] + rng.uniform(-0.02, 0.02, 10000)
+            inside = distance_metres(coords, longitudes, latitudes) <= RADIUS_METRES
+            self.assertLessEqual(set(tiles_of(longitudes[inside], latitudes[inside])), set(tiles))
+            self.assertEqual(len(tiles), len(set(tiles)))
+
+        self.assertEqual(tiles_of(np.array([-0.0001, 0.0, 0.0299]), np.array([51.51, 51.51, 51.4999])),
+                         [(-0.03, 51.5), (0.0, 51.5), (0.0, 51.48)])
+
+    def test_crimes_around_are_assembled_from_tiles(self):
+        tiles = tiles_covering(self.coords)
+
+        columns = get_crime_columns_around(self.coords, [(self.year, self.month)])
+
+        self.assertEqual(len(load_months('crime_tiles', tiles[0], [(self.year, self.month)])), 1)
+        self.assertEqual(self.api.get_stats()['requests']['crimes-street'], len(tiles))
+        self.assertEqual(len(np.unique(columns['id'])), len(columns['id']))
+        self.assertTrue((distance_metres(self.coords, columns['longitude'], columns['latitude'])
+                         <= RADIUS_METRES).all())
+
+        crimes = [crime for tile in tiles
+                  for crime in get_tile_crimes_data(tile, self.year, self.month)]
+        crimes = [crime for crime in crimes if distance_metres(
+            self.coords, float(crime['location']['longitude']), float(crime['location']['latitude'])) <= RADIUS_METRES]
+        self.assertEqual(sorted(columns['id'].tolist()), sorted(crime['id'] for crime in crimes))
+
+    def test_crimes_on_two_tiles_are_counted_once(self):
+        tiles = tiles_covering(self.coords)
+        crime = get_tile_crimes_data(tiles[0], self.year, self.month)[0]
+        crime['location'].update(longitude=str(self.coords[0]), latitude=str(self.coords[1]))
+        for tile in tiles:
+            save_month('crime_tiles', tile, self.year, self.month, [crime] if tile in tiles[:2] else [])
+
+        columns = get_crime_columns_around(self.coords, [(self.year, self.month)], fetch=False)
+
+        self.assertEqual(columns['id'].tolist(), [crime['id']])
+
+    def test_busy_tiles_are_split_once_retried(self):
+        tile = tiles_covering(self.coords)[0]
+
+        with mock.patch('data.replay_server.MAX_CRIMES', SYNTHETIC_CRIMES_PER_TILE - 1):
+            data = get_stored_tiles_data([tile], [(self.year, self.month)])[(self.year, self.month)]
+
+        # The tile is retried once, then fetched as quarters
+        self.assertEqual(self.api.get_stats()['statuses'], {'503': 2, '200': 4})
+        self.assertEqual(len(data), SYNTHETIC_CRIMES_PER_TILE)
+
+    def test_rate_limited_quarters_are_retried_alone(self):
+        tile = tiles_covering(self.coords)[0]
+        answer = self.api.answer
+        rate_limited = []
+
+        def rate_limit_a_quarter(method, url, body=None):
+            # (The first request after the tile's two 503s is for its first quarter)
+            if self.api.get_stats()['statuses'].get('503') == 2 and not rate_limited:
+                rate_limited.append(url)
+                return 429, ''
+            return answer(method, url, body)
+
+        with mock.patch('data.replay_server.MAX_CRIMES', SYNTHETIC_CRIMES_PER_TILE - 1), \
+                mock.patch.object(self.api, 'answer', rate_limit_a_quarter):
+            data = get_stored_tiles_data([tile], [(self.year, self.month)])[(self.year, self.month)]
+
+        self.assertEqual(len(rate_limited), 1)
+        self.assertEqual(self.api.get_stats()['statuses'], {'503': 2, '200': 4})
+        self.assertEqual(len(data), SYNTHETIC_CRIMES_PER_TILE)
+
+    def test_failing_api_gives_up_without_fetching_every_quarter(self):
+        tile = tiles_covering(self.coords)[0]
+
+        with mock.patch('data.replay_server.MAX_CRIMES', -1), self.assertRaises(APIError):
+            get_stored_tiles_data([tile], [(self.year, self.month)])
+
+        # Each split retries its first quarter once, until the last split gives up
+        self.assertEqual(self.api.get_stats()['statuses'], {'503': 2 * (MAX_TILE_SPLITS + 1)})
+
+
+class SpatialIndexTests(SimpleTestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        # Points either side of the meridian, with some on the grid's cell boundaries
+        longitudes = np.concatenate([rng.uniform(-0.1, 0.1, 5000), np.arange(-20, 20) * CELL_LONGITUDE])
+        latitudes = np.concatenate([rng.uniform(51.45, 51.55, 5000), 51.5 + np.arange(-10, 30) * CELL_LATITUDE / 2])
+        self.columns = {'longitude': longitudes, 'latitude': latitudes,
+                        'date': np.datetime64('2023-01-01', 's') + rng.integers(0, 3, len(longitudes)) * 31 * 86400,
+                        'street': np.array([f"Street {i % 50}" for i in range(len(longitudes))], dtype=object)}
+        self.index = SpatialIndex(self.columns)
+
+    def test_query_radius_matches_a_brute_force_search(self):
+        for coords in [(0.0, 51.5), (-0.0375, 51.505), (-0.05123, 51.4871), (0.0312, 51.53)]:
+            for radius in [10, 400, 1609.344, 5000]:
+                rows, distances = self.index.query_radius(coords, radius)
+                brute = distance_metres(coords, self.columns['longitude'], self.columns['latitude'])
+
+                self.assertEqual(rows.tolist(), np.flatnonzero(brute <= radius).tolist())
+                np.testing.assert_allclose(distances, brute[rows])
+
+    def test_query_radius_filters_dates(self):
+        rows, _ = self.index.query_radius((0.0, 51.5), 2000, '2023-02-01', '2023-02-01')
+
+        self.assertTrue(len(rows))
+        self.assertTrue((self.columns['date'][rows] == np.datetime64('2023-02-01', 's')).all())
+
+    def test_nearest_streets(self):
+        streets = self.index.nearest_streets((0.0, 51.5), 3)
+
+        brute = pd.DataFrame({'street': self.columns['street'],
+                              'distance': distance_metres((0.0, 51.5), self.columns['longitude'],
+                                                          self.columns['latitude'])})
+        expected = brute.groupby('street')['distance'].min().sort_values().head(3).round(1).reset_index()
+        pd.testing.assert_frame_equal(streets, expected)
+
+
+class CrimeIndexTests(OfflineTestCase):
+
+    coords = (-0.1415274, 51.5532486)
+
+    def test_an_updated_index_matches_a_rebuilt_one(self):
+        self.use_stand_in()
+        dates = synthetic_dates(2)
+        get_stored_tiles_data(tiles_covering(self.coords), dates)
+        self.assertEqual(len(get_crime_index().tile_months), len(tiles_covering(self.coords)) * 2)
+
+        tile = tiles_covering(self.coords)[0]
+        replacement = get_tile_crimes_data(tile, *dates[0])[:10]
+        save_month('crime_tiles', tile, *dates[0], replacement)
+        updated = get_crime_index()
+
+        spatial._crime_batches.clear()
+        spatial.update_crime_batches()
+        rebuilt = build_crime_index(spatial._crime_batches)
+
+        self.assertEqual(len(updated), len(rebuilt))
+        pd.testing.assert_frame_equal(
+            updated.frame(np.arange(len(updated))).sort_values(['date', 'id'], ignore_index=True),
+            rebuilt.frame(np.arange(len(rebuilt))).sort_values(['date', 'id'], ignore_index=True))
+        month = "{}-{:02d}-01".format(*dates[0])
+        rows, _ = updated.query_radius(tile, 10 ** 6, month, month)
+        self.assertEqual(len(set(updated.columns['id'][rows]) & {crime['id'] for crime in replacement}), 10)
+
+
+class ArchiveImportTests(OfflineTestCase):
+
+    coords = (-0.1415274, 51.5532486)
+
+    def setUp(self):
+        super().setUp()
+        rng = np.random.default_rng(0)
+        self.crimes = [{'Crime ID': f"{rng.integers(16 ** 15):015x}" if i % 5 else '', 'Month': '2023-01',
+                        'Reported by': 'Metropolitan Police Service', 'Falls within': 'Metropolitan Police Service',
+                        'Longitude': f"{self.coords[0] + rng.uniform(-0.04, 0.04):.6f}",
+                        'Latitude': f"{self.coords[1] + rng.uniform(-0.025, 0.025):.6f}",
+                        'Location': f"On or near Street {i % 7}", 'LSOA code': '', 'LSOA name': '',
+                        'Crime type': 'Burglary', 'Last outcome category': '', 'Context': ''}
+                       for i in range(40)]
+        self.crimes.append(dict(self.crimes[0], **{'Crime ID': 'f' * 64, 'Longitude': '', 'Latitude': ''}))
+        self.stops = [{'Type': 'Person search', 'Date': '2023-01-05T10:00:00+00:00', 'Part of a policing operation': '',
+                       'Latitude': f"{self.coords[1] + rng.uniform(-0.02, 0.02):.6f}",
+                       'Longitude': f"{self.coords[0] + rng.uniform(-0.03, 0.03):.6f}",
+                       'Gender': 'Male', 'Age range': '18-24', 'Legislation': '', 'Object of search': 'Stolen goods',
+                       'Outcome': 'Arrest'}
+                      for _ in range(30)]
+
+        self.archive = self.folder / 'archive'
+        for name, rows in [('2023-01-metropolitan-street.csv', self.crimes[:30]),
+                           ('2023-01-city-of-london-street.csv', self.crimes[30:]),
+                           ('2023-01-metropolitan-stop-and-search.csv', self.stops)]:
+            (self.archive / '2023-01').mkdir(parents=True, exist_ok=True)
+            with open(self.archive / '2023-01' / name, 'w', newline='') as file:
+                writer = csv.DictWriter(file, list(rows[0]))
+                writer.writeheader()
+                writer.writerows(rows)
+
+        for setting, value in [('CHUNK_ROWS', 4), ('FLUSH_ROWS', 6)]:
+            patch = mock.patch.object(bulk, setting, value)
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def import_archive(self) -> ArchiveImporter:
+        importer = ArchiveImporter([self.coords])
+        for name, opener in archive_csv_files(str(self.archive)):
+            importer.import_csv(name, opener)
+
+        return importer
+
+    def test_crimes_are_stored_by_tile(self):
+        located = [crime for crime in self.crimes if crime['Longitude']]
+        longitudes = np.array([float(crime['Longitude']) for crime in located])
+        latitudes = np.array([float(crime['Latitude']) for crime in located])
+        # A month stored before the import is replaced by the archive's
+        save_month('crime_tiles', tiles_of(longitudes[:1], latitudes[:1])[0], 2023, 1, [{'id': 1}])
+
+        self.import_archive()
+
+        # The tiles written a few rows (and two forces) at a time have all their crimes
+        stored = 0
+        for tile in set(tiles_of(longitudes, latitudes)):
+            self.assertEqual(load_stored_dates('crime_tiles', tile), {(2023, 1)})
+            stored += len(load_months('crime_tiles', tile, [(2023, 1)])[(2023, 1)])
+        self.assertEqual(stored, len(located))
+
+        columns = get_crime_columns_around(self.coords, [(2023, 1)], fetch=False)
+        within = distance_metres(self.coords, longitudes, latitudes) <= RADIUS_METRES
+        self.assertEqual(len(columns['id']), within.sum())
+        self.assertEqual(set(columns['street']), {crime['Location'] for crime in np.array(located)[within]})
+
+    def test_crime_ids(self):
+        self.import_archive()
+        located = [crime for crime in self.crimes if crime['Longitude']]
+        tiles = set(tiles_of(np.array([float(crime['Longitude']) for crime in located]),
+                             np.array([float(crime['Latitude']) for crime in located])))
+        stored = [crime for tile in tiles for crime in load_months('crime_tiles', tile, [(2023, 1)])[(2023, 1)]]
+
+        for crime in stored:
+            if crime['persistent_id']:
+                self.assertEqual(crime['id'], int(crime['persistent_id'], 16))
+            else:
+                self.assertLess(crime['id'], 0)
+        self.assertEqual(len({crime['id'] for crime in stored}), len(stored))
+        self.assertEqual(sum(not crime['persistent_id'] for crime in stored), 8)
+        self.assertEqual(csv_crime_id('', 'a.csv', 2), csv_crime_id('', 'a.csv', 2))
+        self.assertNotEqual(csv_crime_id('', 'a.csv', 2), csv_crime_id('', 'b.csv', 2))
+
+    def test_stop_and_searches_are_named_by_the_nearest_street(self):
+        importer = self.import_archive()
+
+        stops = load_months('stop_and_searches', self.coords, [(2023, 1)])[(2023, 1)]
+        longitudes = np.array([float(stop['Longitude']) for stop in self.stops])
+        latitudes = np.array([float(stop['Latitude']) for stop in self.stops])
+        self.assertEqual(len(stops), (distance_metres(self.coords, longitudes, latitudes) <= RADIUS_METRES).sum())
+
+        # The stop and searches are named from the streets of their force's crimes
+        streets = importer.streets
+        self.assertEqual(len(streets), 30)
+        self.assertTrue(any(stop['location']['street']['name'] != 'On or near an unknown street' for stop in stops))
+        for stop in stops:
+            coords = (float(stop['location']['longitude']), float(stop['location']['latitude']))
+            rows, distances = streets.query_radius(coords, bulk.STREET_SEARCH_RADIUS)
+            self.assertEqual(stop['location']['street']['name'],
+                             streets.columns['street'][rows[np.argmin(distances)]] if len(rows)
+                             else 'On or near an unknown street')
+
+
+class ColumnarTests(OfflineTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.ss_df = pd.DataFrame({
+            'date': pd.to_datetime(['2023-01-01', '2023-01-01', '2023-02-01']).astype('datetime64[s]'),
+            'hour': pd.array([9, 17, 23], dtype='int8'),
+            'age range': pd.Categorical(['18-24', None, '25-34']),
+            'gender': ['Male', 'Female', 'Male'],
+            'legislation': pd.Categorical(['Misuse of Drugs Act 1971 (section 23)'] * 3),
+            'object of search': pd.Categorical(['Controlled drugs', 'Offensive weapons', 'Controlled drugs']),
+            'outcome': pd.Categorical(['A no further action disposal', 'Arrest', None])})
+
+    def test_frame_round_trip(self):
+        save_frame('stop_and_searches', 'nw51tu', 'df', self.ss_df)
+        df = load_frame('stop_and_searches', 'nw51tu', 'df')
+
+        expected = self.ss_df.assign(gender=self.ss_df['gender'].astype('category'))
+        # (Copied, as the loaded columns are memory maps rather than arrays)
+        pd.testing.assert_frame_equal(df.copy(), expected)
+        self.assertIsInstance(df['gender'].dtype, pd.CategoricalDtype)
+
+    def test_load_some_columns(self):
+        save_frame('stop_and_searches', 'nw51tu', 'df', self.ss_df)
+
+        df = load_frame('stop_and_searches', 'nw51tu', 'df', ['date', 'outcome'])
+        self.assertEqual(list(df.columns), ['date', 'outcome'])
+        self.assertEqual(df['outcome'].isna().sum(), 1)
+
+    def test_saving_replaces_the_frame(self):
+        save_frame('stop_and_searches', 'nw51tu', 'df', self.ss_df)
+        save_frame('stop_and_searches', 'nw51tu', 'df', self.ss_df.iloc[:1])
+
+        self.assertEqual(len(load_frame('stop_and_searches', 'nw51tu', 'df')), 1)
+
+        delete_frame('stop_and_searches', 'nw51tu', 'df')
+        self.assertIsNone(load_frame('stop_and_searches', 'nw51tu', 'df'))
+
+    def test_cube_round_trip(self):
+        cube = build_cube(self.ss_df, SS_CUBE_DIMENSIONS)
+        save_frame('stop_and_searches', 'nw51tu', 'cube', cube)
+
+        loaded_cube = load_frame('stop_and_searches', 'nw51tu', 'cube')
+        self.assertEqual(loaded_cube['count'].dtype, 'int32')
+        self.assertEqual(loaded_cube['count'].sum(), 3)
+
+    def test_empty_cube_round_trip(self):
+        save_frame('stop_and_searches', 'se19sg', 'cube', build_cube(pd.DataFrame(), SS_CUBE_DIMENSIONS))
+
+        cube = load_frame('stop_and_searches', 'se19sg', 'cube')
+        self.assertTrue(cube.empty)
+        self.assertEqual(list(cube.columns), SS_CUBE_DIMENSIONS + ['count'])
+        self.assertEqual(cube['count'].dtype, 'int32')
+
+    def test_other_string_columns_are_refused(self):
+        with self.assertRaises(ValueError):
+            save_frame('stop_and_searches', 'nw51tu', 'df', self.ss_df.assign(notes='none'))
+
+
+class ExportTests(OfflineTestCase):
+
+    postcodes = ','.join(POSTCODES)
+
+    def test_export_needs_the_months_stored(self):
+        response = self.client.get(f'/api/crimes/{self.postcodes}/export.csv')
+
+        self.assertEqual(response.status_code, 409)
+        months = sorted(f"{year}-{month:02d}" for year, month in synthetic_dates(MONTHS))
+        missing = response.json()['missing']
+        self.assertEqual({postcode: sorted(missing[postcode]) for postcode in missing},
+                         {postcode: months for postcode in POSTCODES})
+
+    def test_export_csv(self):
+        totals = {postcode: get_postcode_cube('crimes', postcode)['count'].sum() for postcode in POSTCODES}
+
+        response = self.client.get(f'/api/crimes/{self.postcodes}/export.csv')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('attachment', response['Content-Disposition'])
+        df = pd.read_csv(StringIO(b''.join(response.streaming_content).decode()))
+        self.assertEqual(df['postcode'].value_counts().to_dict(), totals)
+
+    def test_export_ndjson(self):
+        get_postcode_cube('stop_and_searches', POSTCODES[0])
+
+        response = self.client.get(f'/api/stop_and_searches/{POSTCODES[0]}/export.ndjson')
+
+        self.assertEqual(response.status_code, 200)
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual(len(lines), get_postcode_cube('stop_and_searches', POSTCODES[0])['count'].sum())
+        self.assertEqual(json.loads(lines[0])['postcode'], POSTCODES[0])
+
+    def test_export_size_is_capped(self):
+        with mock.patch('mysite.views.EXPORT_MAX_POSTCODE_MONTHS', MONTHS):
+            response = self.client.get(f'/api/crimes/{self.postcodes}/export.csv')
+
+        self.assertEqual(response.status_code, 400)
+
+    def test_export_rejects_bad_requests(self):
+        self.assertEqual(self.client.get(f'/api/crimes/{self.postcodes}/export.xml').status_code, 404)
+        self.assertEqual(self.client.get(f'/api/crimes/{self.postcodes}/export.csv', {'from': 'May'}).status_code, 400)
+
+
+class InstrumentationTests(OfflineTestCase):
+
+    postcode = POSTCODES[0]
+
+    def test_server_timing_header(self):
+        get_postcode_cube('crimes', self.postcode)
+
+        response = self.client.post(f'/crimes/{self.postcode}/', {'from-date': '2022-01-01', 'to-date': '2030-01-01'})
+
+        self.assertEqual(response.status_code, 200)
+        timings = dict(entry.split(';dur=') for entry in response['Server-Timing'].split(', '))
+        self.assertIn('template', timings)
+        self.assertIn('total', timings)
+        self.assertTrue(all(float(milliseconds) >= 0 for milliseconds in timings.values()))
+        self.assertLessEqual(float(timings['template']), float(timings['total']))
+
+    def test_nested_stage_is_counted_once(self):
+        token = start_timings()
+        try:
+            with stage('nested_test'):
+                with stage('nested_test'):
+                    time.sleep(0.01)
+        finally:
+            timings = stop_timings(token)
+
+        self.assertEqual(list(timings), ['nested_test'])
+        self.assertGreaterEqual(timings['nested_test'], 0.01)
+        self.assertIn('stage_seconds_count{stage="nested_test"} 1\n', render_metrics())
+
+    def test_metrics(self):
+        self.client.get('/')
+
+        response = self.client.get('/metrics')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain; version=0.0.4'))
+        text = response.content.decode()
+        self.assertIn('# TYPE requests_total counter', text)
+        self.assertIn('requests_total{status="200",view="mysite.views.home"}', text)
+        self.assertIn('# TYPE request_seconds histogram', text)
+        self.assertIn('request_seconds_bucket{view="mysite.views.home",le="+Inf"}', text)
+        self.assertIn('police_api_fetch_requests_total', text)
+
+    def test_metrics_are_only_served_to_allowed_addresses(self):
+        self.assertEqual(self.client.get('/metrics', REMOTE_ADDR='10.0.0.1').status_code, 404)
+
+        with self.settings(METRICS_ALLOWED_IPS=['10.0.0.1']):
+            self.assertEqual(self.client.get('/metrics', REMOTE_ADDR='10.0.0.1').status_code, 200)
+            self.assertEqual(self.client.get('/metrics').status_code, 404)
+
+    def test_sampling_filter(self):
+        info = logging.makeLogRecord({'levelno': logging.INFO})
+        warning = logging.makeLogRecord({'levelno': logging.WARNING})
+
+        self.assertTrue(SamplingFilter(1.0).filter(info))
+        self.assertFalse(SamplingFilter(0.0).filter(info))
+        self.assertTrue(SamplingFilter(0.0).filter(warning))
+
+        with mock.patch('mysite.instrumentation.random.random', return_value=0.3):
+            self.assertTrue(SamplingFilter(0.5).filter(info))
+            self.assertFalse(SamplingFilter(0.2).filter(info))
+
+
+class ProfilingTests(OfflineTestCase):
+
+    postcode = POSTCODES[0]
+
+    def setUp(self):
+        super().setUp()
+        self.staff = User.objects.create_user('staff', password='password', is_staff=True)
+        self.user = User.objects.create_user('user', password='password')
+
+    def profiled_get(self, path: str = '/'):
+        return self.client.get(path, {'profile': '1'})
+
+    def test_staff_requests_are_profiled(self):
+        get_postcode_cube('crimes', self.postcode)
+        self.client.force_login(self.staff)
+
+        response = self.profiled_get(f'/api/crimes/{self.postcode}/aggregates')
+
+        self.assertEqual(response.status_code, 200)
+        name = response['X-Profile-Capture']
+        self.assertTrue(CAPTURE_NAME_PATTERN.fullmatch(name))
+        [capture] = list_captures()
+        self.assertEqual(capture['name'], name)
+        self.assertEqual((capture['dataset'], capture['postcode'], capture['user']), ('crimes', self.postcode, 'staff'))
+        self.assertIn('aggregate', capture['stages'])
+        self.assertTrue(capture_profile_path(name).exists())
+
+    def test_other_requests_are_not_profiled(self):
+        self.assertNotIn('X-Profile-Capture', self.profiled_get())
+
+        self.client.force_login(self.user)
+        self.assertNotIn('X-Profile-Capture', self.profiled_get())
+        self.assertNotIn('X-Profile-Capture', self.client.get('/', headers={'X-Profile': '1'}))
+
+        self.assertEqual(list_captures(), [])
+
+    def test_only_one_request_is_profiled_at_a_time(self):
+        self.client.force_login(self.staff)
+
+        with profiling._profiler_lock:
+            response = self.profiled_get()
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['X-Profile-Capture'], 'busy')
+        self.assertEqual(list_captures(), [])
+
+    def test_only_the_newest_captures_are_kept(self):
+        self.client.force_login(self.staff)
+
+        with self.settings(PROFILE_MAX_CAPTURES=2):
+            for _ in range(3):
+                self.profiled_get()
+
+        folder = profiling.get_capture_dir()
+        self.assertEqual(len(list(folder.glob('*.json'))), 2)
+        self.assertEqual(len(list(folder.glob('*.prof'))), 2)
+
+    def test_profile_views_are_for_staff_only(self):
+        self.client.force_login(self.staff)
+        name = self.profiled_get()['X-Profile-Capture']
+        capture_url = f'/admin/profiles/{name}.prof'
+
+        response = self.client.get('/admin/profiles/')
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, name)
+
+        response = self.client.get(capture_url)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('attachment', response['Content-Disposition'])
+        self.assertIn('function calls', self.client.get(capture_url, {'summary': ''}).content.decode())
+        self.assertEqual(self.client.get('/admin/profiles/20000101T000000_00000000.prof').status_code, 404)
+
+        self.client.force_login(self.user)
+        self.assertEqual(self.client.get('/admin/profiles/').status_code, 302)
+        self.assertEqual(self.client.get(capture_url).status_code, 302)
+
+
+class BenchmarkCommandTests(OfflineTestCase):
+
+    def test_benchmark_runs_against_recorded_fixtures(self):
+        fixtures_path = self.folder / 'fixtures.json.gz'
+        output_path = self.folder / 'results.json'
+        save_fixtures(str(fixtures_path), record_responses(),
+                      {'postcodes': POSTCODES[:1], 'dates': synthetic_dates(MONTHS)})
+        store_path = os.environ['DATA_STORE_PATH']
+
+        call_command('benchmark', '--fixtures', str(fixtures_path), '--repeat', '1',
+                     '--output', str(output_path), stdout=StringIO())
+
+        with open(output_path) as file:
+            results = json.load(file)
+        for stage in ['get_crime_data_df_cold', 'crimes_page_get', 'ss_page_post']:
+            self.assertIn(stage, results['stages'])
+        self.assertGreater(results['rows']['crimes'], 0)
+
+        # The benchmark's scratch store isn't left behind
+        self.assertEqual(os.environ['DATA_STORE_PATH'], store_path)
+
+    def test_benchmark_records_the_stand_in_without_fixtures(self):
+        output_path = self.folder / 'results.json'
+
+        with mock.patch('mysite.management.commands.benchmark.DEFAULT_FIXTURES_PATH', self.folder / 'none.json.gz'):
+            call_command('benchmark', '--months', '1', '--repeat', '1', '--output', str(output_path),
+                         stdout=StringIO())
+
+        with open(output_path) as file:
+            results = json.load(file)
+        self.assertEqual(sorted(results['stages']), sorted(STAGES))
+        self.assertGreater(results['rows']['stop_and_searches'], 0)
+
+    def test_unknown_stages_are_refused(self):
+        with self.assertRaises(CommandError):
+            call_command('benchmark', '--stages', 'crimes_page_get', 'crimes_page', stdout=StringIO())
+
+
+class LoadTestCommandTests(SimpleTestCase):
+
+    def test_report_of_no_requests(self):
+        stdout = StringIO()
+
+        call_command('load_test', '--requests', '0', stdout=stdout)
+
+        lines = stdout.getvalue().splitlines()
+        self.assertEqual(lines[1].split(), ['all', '0', '-', '-', '-'])
+        self.assertTrue(lines[2].startswith("0 requests in"))
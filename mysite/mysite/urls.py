@@ -15,13 +15,31 @@ Including another URLconf
     2. Add a URL to urlpatterns:  path('blog/', include('blog.urls'))
 """
 from django.contrib import admin
-from django.urls import include, path
+from django.urls import include, path, re_path
 from . import views
+from crimes import views as crime_views
+from stop_and_searches import views as ss_views
 
 urlpatterns = [
     path("", views.home, name="home"),
     path("search", views.search_queries, name="search_queries"),
+    path("admin/profiles/", views.profiles, name="profiles"),
+    re_path(r"^admin/profiles/(?P<name>[0-9]{8}T[0-9]{6}_[0-9a-f]{8})\.prof$",
+            views.profile_capture, name="profile_capture"),
     path("admin/", admin.site.urls),
+    path("metrics", views.metrics, name="metrics"),
+    re_path(r"^charts/(?P<key>[0-9a-f]{64})\.png$", views.chart, name="chart"),
+    path("api/crimes/<str:postcode>/aggregates",
+         crime_views.aggregates, name="crime_aggregates"),
+    path("api/crimes/near", crime_views.crimes_near, name="crimes_near"),
+    path("api/crimes/nearest_streets",
+         crime_views.nearest_streets, name="nearest_streets"),
+    path("api/stop_and_searches/<str:postcode>/aggregates",
+         ss_views.aggregates, name="ss_aggregates"),
+    path("api/<str:dataset>/<str:postcodes>/export.<str:file_format>",
+         views.export, name="export"),
+    path("api/<str:dataset>/<str:postcode>/status",
+         views.load_job_status, name="load_job_status"),
     path("crimes/", include("crimes.urls")),
     path("stop_and_searches/", include("stop_and_searches.urls"))
 ]
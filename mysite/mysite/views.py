@@ -1,21 +1,32 @@
-import matplotlib.pyplot as plt
+from django.http import HttpResponse, FileResponse, Http404
+from django.http import JsonResponse, StreamingHttpResponse
 
-from django.http import HttpResponse
-from django.http import HttpResponseNotFound
-from django.http import HttpRequest
-from django.views.decorators.csrf import csrf_protect
-from django.middleware.csrf import get_token
-
-from django.core.cache import cache
+from django.conf import settings
+from django.contrib.admin.views.decorators import staff_member_required
 from django.shortcuts import render, redirect
 
-from datetime import datetime
+import logging
+
+from data.analyse import get_published_months
+from data.export import EXPORT_FORMATS, export_records, missing_export_months
+from data.extract import postcodes_to_coords
+from data.fetch import get_fetch_totals
+from data.metrics import render_metrics
+
+from .api import parse_date_range
+from .charts import chart_path
+from .datasets import DATASET_LOADERS
+from .jobs import get_load_job_status
+from .profiling import capture_profile_path, capture_summary, list_captures
 
-from crimes.views import postcode_page as crime_post_code_page
-from stop_and_searches.views import postcode_page as ss_postcode_page
+logger = logging.getLogger(__name__)
 
 # Create your views here.
 
+EXPORT_MAX_POSTCODES = 50
+# The most postcode-months an export can be for (e.g. 50 postcodes over 2 years)
+EXPORT_MAX_POSTCODE_MONTHS = 1200
+
 
 def home(request):
     context = {}
@@ -36,3 +47,124 @@ def search_queries(request):
 
         if page == "Stop and Searches":
             return redirect(f'stop_and_searches/{postcode}')
+
+
+def chart(request, key):
+    """Serves a cached chart image. Images are stored under a hash of their
+    contents' spec, so they never change and can be cached by the browser."""
+
+    try:
+        response = FileResponse(
+            open(chart_path(key), 'rb'), content_type='image/png')
+    except FileNotFoundError:
+        raise Http404("Chart not found.")
+
+    response['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return response
+
+
+def load_job_status(request, dataset, postcode):
+    """Returns the status and progress of the job loading a postcode's data as JSON."""
+
+    if dataset not in DATASET_LOADERS:
+        raise Http404("Unknown dataset.")
+
+    normal_postcode = postcode.replace(" ", "").lower()
+
+    response = JsonResponse(get_load_job_status(dataset, normal_postcode))
+    response['Cache-Control'] = 'no-store'
+    return response
+
+
+def export(request, dataset, postcodes, file_format):
+    """Streams a dataset's records for one or more (comma separated) postcodes, in the
+    date range given by the 'from' and 'to' query parameters, as CSV or NDJSON. Records
+    are read and written a postcode-month at a time, so the download starts straight
+    away and memory use doesn't grow with the size of the export. Only stored months
+    are exported; if any are missing a 409 lists them (opening the postcodes' pages
+    loads them)."""
+
+    if dataset not in DATASET_LOADERS or file_format not in EXPORT_FORMATS:
+        raise Http404("Unknown dataset or format.")
+
+    try:
+        from_date, to_date = parse_date_range(request)
+    except ValueError:
+        return JsonResponse({'error': "Dates must be given as YYYY-MM-DD."}, status=400)
+
+    postcodes = [postcode for postcode in postcodes.split(',') if postcode.strip()]
+    if not postcodes or len(postcodes) > EXPORT_MAX_POSTCODES:
+        return JsonResponse(
+            {'error': f"Between 1 and {EXPORT_MAX_POSTCODES} postcodes must be given."}, status=400)
+
+    try:
+        coords = postcodes_to_coords(postcodes)
+        dates = [(year, month) for year, month in get_published_months()
+                 if (from_date.year, from_date.month) <= (year, month) <= (to_date.year, to_date.month)]
+    except Exception as e:
+        logger.warning("Couldn't start the %s export for %s: %s", dataset, postcodes, e)
+        return JsonResponse({'error': str(e)}, status=502)
+
+    invalid_postcodes = [postcode for postcode, postcode_coords in coords.items()
+                         if postcode_coords is None]
+    if invalid_postcodes:
+        return JsonResponse(
+            {'error': f"Not valid postcodes: {', '.join(invalid_postcodes)}"}, status=404)
+
+    if len(coords) * len(dates) > EXPORT_MAX_POSTCODE_MONTHS:
+        return JsonResponse(
+            {'error': f"An export can be for at most {EXPORT_MAX_POSTCODE_MONTHS} postcode-months."}, status=400)
+
+    missing = missing_export_months(dataset, coords, dates)
+    if missing:
+        return JsonResponse(
+            {'error': "Some of the months haven't been loaded yet.",
+             'missing': {postcode: [f"{year}-{month:02d}" for year, month in missing_dates]
+                         for postcode, missing_dates in missing.items()}}, status=409)
+
+    response = StreamingHttpResponse(export_records(dataset, coords, dates, file_format),
+                                     content_type=EXPORT_FORMATS[file_format])
+    filename = f"{dataset}_{'_'.join(coords)}_{from_date:%Y-%m}_{to_date:%Y-%m}.{file_format}"
+    response['Content-Disposition'] = f'attachment; filename="{filename}"'
+    return response
+
+
+def metrics(request):
+    """Serves this process's metrics (see data/metrics.py) in the Prometheus text format,
+    to the addresses in METRICS_ALLOWED_IPS only. Each worker process keeps its own."""
+
+    if request.META.get('REMOTE_ADDR') not in settings.METRICS_ALLOWED_IPS:
+        raise Http404("Not found.")
+
+    fetch_totals = {f"police_api_fetch_{stat}_total": value
+                    for stat, value in get_fetch_totals().items()}
+    response = HttpResponse(render_metrics(fetch_totals),
+                            content_type='text/plain; version=0.0.4; charset=utf-8')
+    response['Cache-Control'] = 'no-store'
+    return response
+
+
+@staff_member_required
+def profiles(request):
+    """Lists the newest profiled requests (see mysite/profiling.py), for staff members."""
+
+    context = {"captures": list_captures(),
+               "title": "Request profiles",
+               "site_header": "Local Crime Analysis"}
+
+    return render(request, "mysite/profiles.html", context)
+
+
+@staff_member_required
+def profile_capture(request, name):
+    """Serves a profiled request's profile, as a .prof file (or, with ?summary, as its
+    top functions by cumulative time), for staff members."""
+
+    path = capture_profile_path(name)
+    if path is None or not path.exists():
+        raise Http404("Profile not found.")
+
+    if 'summary' in request.GET:
+        return HttpResponse(capture_summary(name), content_type='text/plain; charset=utf-8')
+
+    return FileResponse(open(path, 'rb'), as_attachment=True, filename=f"{name}.prof")
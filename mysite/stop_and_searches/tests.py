@@ -1,3 +1,99 @@
-from django.test import TestCase
+from mysite.datasets import get_postcode_cube
+from mysite.testing import OfflineTestCase, POSTCODES, EMPTY_SS_POSTCODE
 
-# Create your tests here.
+
+class StopAndSearchAggregatesTests(OfflineTestCase):
+
+    postcode = POSTCODES[0]
+
+    def test_aggregates(self):
+        cube = get_postcode_cube('stop_and_searches', self.postcode)
+
+        response = self.client.get(f'/api/stop_and_searches/{self.postcode}/aggregates')
+
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual(data['total'], cube['count'].sum())
+        self.assertGreater(data['total'], 0)
+        self.assertEqual(sum(data['counts']['hour'].values()), data['total'])
+        self.assertNotIn('object of search by gender', data['counts'])
+
+    def test_aggregates_by_a_third_variable(self):
+        get_postcode_cube('stop_and_searches', self.postcode)
+
+        response = self.client.get(f'/api/stop_and_searches/{self.postcode}/aggregates', {'third-var': 'gender'})
+
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual(sum(count for genders in data['counts']['object of search by gender'].values()
+                             for count in genders.values()), data['total'])
+
+        self.assertEqual(self.client.get(f'/api/stop_and_searches/{self.postcode}/aggregates',
+                                         {'third-var': 'height'}).status_code, 400)
+
+
+class StopAndSearchPageTests(OfflineTestCase):
+
+    postcode = POSTCODES[0]
+
+    def test_page_post_loads_in_the_background(self):
+        response = self.client.post(f'/stop_and_searches/{self.postcode}/',
+                                    {'from-date': '2022-01-01', 'to-date': '2030-01-01'})
+
+        self.assertEqual(response.status_code, 202)
+        self.assertTemplateUsed(response, 'mysite/loading_page.html')
+        self.assertEqual(self.wait_for_load_job('stop_and_searches', self.postcode)['status'], 'done')
+
+    def test_page_post(self):
+        get_postcode_cube('stop_and_searches', self.postcode)
+        url = f'/stop_and_searches/{self.postcode}/'
+
+        self.assertEqual(self.client.post(url, {'from-date': '2022-01-01', 'to-date': '2030-01-01'}).status_code, 200)
+        self.assertEqual(self.client.post(url, {'third-var': 'outcome', 'starting_date': '2022-01-01',
+                                                'ending_date': '2030-01-01'}).status_code, 200)
+
+        self.assertEqual(self.client.post(url, {'third-var': 'height', 'starting_date': '2022-01-01',
+                                                'ending_date': '2030-01-01'}).status_code, 400)
+        self.assertEqual(self.client.post(url, {'third-var': 'none'}).status_code, 400)
+
+
+    def test_third_variable_only_changes_its_chart(self):
+        get_postcode_cube('stop_and_searches', self.postcode)
+        url = f'/stop_and_searches/{self.postcode}/'
+        dates = {'starting_date': '2022-01-01', 'ending_date': '2030-01-01'}
+
+        chart_urls = self.client.post(url, {'third-var': 'none', **dates}).context['chart_urls']
+        gender_chart_urls = self.client.post(url, {'third-var': 'gender', **dates}).context['chart_urls']
+
+        self.assertEqual(sorted(chart_urls), ['age_pie_chart', 'bar_chart_by_hour', 'object_of_search_bar'])
+        self.assertEqual(gender_chart_urls['bar_chart_by_hour'], chart_urls['bar_chart_by_hour'])
+        self.assertEqual(gender_chart_urls['age_pie_chart'], chart_urls['age_pie_chart'])
+        self.assertNotEqual(gender_chart_urls['object_of_search_bar'], chart_urls['object_of_search_bar'])
+
+
+class EmptyPostcodeTests(OfflineTestCase):
+    """A postcode with no stop and searches at all."""
+
+    postcode = EMPTY_SS_POSTCODE
+
+    def setUp(self):
+        super().setUp()
+        self.cube = get_postcode_cube('stop_and_searches', self.postcode)
+
+    def test_cube_is_empty_and_typed(self):
+        self.assertTrue(self.cube.empty)
+        self.assertEqual(self.cube['count'].dtype, 'int32')
+
+    def test_aggregates(self):
+        response = self.client.get(f'/api/stop_and_searches/{self.postcode}/aggregates', {'third-var': 'age range'})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['total'], 0)
+
+    def test_pages(self):
+        url = f'/stop_and_searches/{self.postcode}/'
+
+        self.assertEqual(self.client.get(url).status_code, 200)
+        self.assertEqual(self.client.post(url, {'from-date': '2022-01-01', 'to-date': '2030-01-01'}).status_code, 200)
+        self.assertEqual(self.client.post(url, {'third-var': 'gender', 'starting_date': '2022-01-01',
+                                                'ending_date': '2030-01-01'}).status_code, 200)
@@ -2,24 +2,23 @@ from django.shortcuts import render
 
 # Create your views here.
 
-import matplotlib.pyplot as plt
-from matplotlib import use
-
 from django.http import HttpResponse
-from django.http import HttpResponseNotFound
+from django.http import HttpResponseBadRequest, JsonResponse
 from django.views.decorators.csrf import csrf_protect
 from django.middleware.csrf import get_token
 
-from django.core.cache import cache
-from django.shortcuts import render
-
-
-from data.analyse import get_ss_data_df, counting_by_category
-from data.visualise import plot_bar, plot_crimes_with_time_line_graph, object_of_search_bar_chart, stop_and_search_pie_chart
+from data.analyse import counting_by_category, counts_as_dict, slice_months
+from data.visualise import object_of_search_bar_chart, stop_and_search_pie_chart, stop_and_search_hour_bar_chart
+from mysite.api import parse_date_range, etag_json_response
+from mysite.charts import get_chart_urls
+from mysite.instrumentation import render_page
+from mysite.jobs import load_api_cube, load_page_cube
 
 
 from datetime import datetime
-import seaborn as sns
+import logging
+
+logger = logging.getLogger(__name__)
 
 # Create your views here.
 
@@ -32,97 +31,40 @@ def home(request):
 def postcode_page(request, postcode):
 
     normal_postcode = postcode.replace(" ", "").lower()
-    print('hello')
 
     if request.method == 'GET':
 
-        print('GET REQUEST')
-
-        ss_df_dict = cache.get('cached_ss_df_dict')
-        print(f"S&S Dict Data: {ss_df_dict}")
-        print('hellooooooo')
-
-        if (ss_df_dict is None):
-
-            print('NO CACHED DICTIONARY WITH SS DATAFRAMES')
-
-            try:
-                ss_df = get_ss_data_df(normal_postcode, 2022)
-                print('DATAFRAME CREATED')
-                ss_df_dict = {normal_postcode: ss_df}
-                cache.set('cached_ss_df_dict',
-                          ss_df_dict, timeout=60 * 10)
-            except Exception as e:
-                # Print out the error message
-                print(f"An error occurred: {e}")
-                return HttpResponseNotFound(f"{e} Error\n\nIf it's a 429 error just try refreshing again :)))))")
-
-        elif normal_postcode not in ss_df_dict.keys():
-
-            try:
-                ss_df = get_ss_data_df(normal_postcode, 2022)
-                ss_df_dict[normal_postcode] = ss_df
-                cache.set('cached_ss_df_dict',
-                          ss_df_dict, timeout=60 * 10)
-            except Exception as e:
-                # Print out the error message
-                print(f"An error occurred: {e}")
-                return HttpResponseNotFound(f"{e} Error\n\nIf it's a 429 error just try refreshing again :)))))")
-
-        print('GET METHOD')
-        print(f"postcode: {normal_postcode}")
-        print(ss_df_dict.keys())
-        print([type(value) for value in ss_df_dict.values()])
-        ss_df = ss_df_dict[normal_postcode]
-
-        # CREATING GRAPHS, TO SAVE AND THEN IMPLEMENT INTO HTML PAGE
-
-        # BAR CHART BY HOUR
-        use('agg')
-        ss_hour_df = counting_by_category(ss_df, ['hour'])
-        font_dict = {'weight': 'bold', 'size': 12,  'color': 'black'}
-        sns.set_theme(palette='deep', font='monospace')
-        fig = plt.figure(facecolor='#222629', figsize=(14, 6))
-        ax = fig.add_subplot()
-        ax.set_facecolor('#273744')
-        ax.tick_params(axis='x', colors='black')
-        ax.tick_params(axis='y', colors='black')
-        sns.barplot(x=ss_hour_df.index,
-                    y=ss_hour_df[ss_hour_df.columns[0]], width=0.5)
-        plt.ylabel('Number of Stop and Searches', fontdict=font_dict)
-        plt.xlabel(ss_hour_df.columns[0].title(), fontdict=font_dict)
-        plt.title("Stop and Searches by Hour", fontdict=font_dict)
-        plt.savefig('stop_and_searches/static/png/bar-chart-by-hour',
-                    bbox_inches='tight')
-
-        # BAR CHART BY OBJECT OF SEARCH
-        object_of_search_bar_chart(
-            ss_df, 'stop_and_searches/static/png/object-of-search-bar')
-
-        # PIE CHART BY AGE
-        stop_and_search_pie_chart(ss_df, 'age range', 'center right',
-                                  'stop_and_searches/static/png/age-pie-chart')
-
-        # PIE CHART BY LEGISLATION
-        stop_and_search_pie_chart(
-            ss_df, 'legislation', 'lower center', 'stop_and_searches/static/png/legislation-pie-chart')
+        # Load the data in the background if it isn't ready, showing a progress page meanwhile
+        ss_cube, response = load_page_cube(request, 'stop_and_searches', normal_postcode)
+        if response is not None:
+            return response
+
+        logger.debug("Stop and search page for %s", normal_postcode)
+
+        starting_date = "2022-01-01"
+        ending_date = datetime.today().strftime('%Y-%m-%d')
+
+        # BAR CHART BY HOUR, BAR CHART BY OBJECT OF SEARCH, PIE CHART BY AGE
+        chart_urls = get_chart_urls('stop_and_searches', normal_postcode, starting_date, ending_date, {
+            'bar_chart_by_hour': (stop_and_search_hour_bar_chart, lambda: {'df': counting_by_category(ss_cube, ['hour'])}),
+            'object_of_search_bar': (object_of_search_bar_chart, lambda: {'df': ss_cube[['object of search', 'count']]}),
+            'age_pie_chart': (stop_and_search_pie_chart, lambda: {'df': ss_cube[['age range', 'count']], 'category': 'age range', 'loc': 'center right'})},
+            version=ss_cube['count'].sum())
 
         # Gender Table
-        ss_gender_df = counting_by_category(ss_df, ['gender'])
-        print(ss_gender_df.columns)
+        ss_gender_df = counting_by_category(ss_cube, ['gender'])
         ss_gender_df = ss_gender_df.rename(columns={"gender": "count"})
-        print(ss_gender_df.columns)
-        print('-------------------------------')
 
         csrf_token = get_token(request)
 
         context = {"postcode": normal_postcode[:-3].strip().upper() + ' ' + normal_postcode[-3:].strip().upper(),
                    "ss_gender_df": ss_gender_df.sort_values('count', ascending=False).iterrows(),
-                   "starting_date": "2022-01-01",
-                   "ending_date": datetime.today().strftime('%Y-%m-%d'),
+                   "chart_urls": chart_urls,
+                   "starting_date": starting_date,
+                   "ending_date": ending_date,
                    'csrf_token': csrf_token}
 
-        return render(request, "stop_and_searches/ss_postcode_page.html", context)
+        return render_page(request, "stop_and_searches/ss_postcode_page.html", context)
 
     if request.method == 'POST':
 
@@ -133,73 +75,91 @@ def postcode_page(request, postcode):
         return HttpResponse(request.body)
         '''
 
-        ss_df_dict = cache.get('cached_ss_df_dict')
-        ss_df = ss_df_dict[normal_postcode]
         third_var = request.POST.get('third-var')
 
-        if third_var is None:
-
-            from_date = datetime.strptime(
-                request.POST.get('from-date'), "%Y-%m-%d")
-            to_date = datetime.strptime(
-                request.POST.get('to-date'), "%Y-%m-%d")
-            ss_df = ss_df[(ss_df.date >= from_date)
-                          & (ss_df.date <= to_date)]
-            starting_date = str(from_date.date())
-            ending_date = str(to_date.date())
+        if third_var not in [None, "none", "age range", "gender", "outcome"]:
+            return HttpResponseBadRequest("The only valid third variables are 'age range', 'gender' or 'outcome'.")
 
+        # The date form sends from-date and to-date; the third variable form sends the page's dates back
+        if third_var is None:
+            starting_date = request.POST.get('from-date', '')
+            ending_date = request.POST.get('to-date', '')
         else:
-
-            starting_date = request.POST.get('starting_date')
-            ending_date = request.POST.get('ending_date')
+            starting_date = request.POST.get('starting_date', '')
+            ending_date = request.POST.get('ending_date', '')
 
             if third_var == 'none':
                 third_var = None
 
-        #  CREATING GRAPHS, TO SAVE AND THEN IMPLEMENT INTO HTML PAGE
-
-        # CREATING GRAPHS, TO SAVE AND THEN IMPLEMENT INTO HTML PAGE
-
-        # BAR CHART BY HOUR
-        use('agg')
-        ss_hour_df = counting_by_category(ss_df, ['hour'])
-        font_dict = {'weight': 'bold', 'size': 12,  'color': 'black'}
-        sns.set_theme(palette='deep', font='monospace')
-        fig = plt.figure(facecolor='#222629', figsize=(14, 6))
-        ax = fig.add_subplot()
-        ax.set_facecolor('#273744')
-        ax.tick_params(axis='x', colors='black')
-        ax.tick_params(axis='y', colors='black')
-        sns.barplot(x=ss_hour_df.index,
-                    y=ss_hour_df[ss_hour_df.columns[0]], width=0.5)
-        plt.ylabel('Number of Stop and Searches', fontdict=font_dict)
-        plt.xlabel(ss_hour_df.columns[0].title(), fontdict=font_dict)
-        plt.title("Stop and Searches by Hour", fontdict=font_dict)
-        plt.savefig('stop_and_searches/static/png/bar-chart-by-hour',
-                    bbox_inches='tight')
-
-        # BAR CHART BY OBJECT OF SEARCH
-        object_of_search_bar_chart(
-            ss_df, 'stop_and_searches/static/png/object-of-search-bar', third_var)
-
-        # PIE CHART BY AGE
-        stop_and_search_pie_chart(ss_df, 'age range', 'center right',
-                                  'stop_and_searches/static/png/age-pie-chart')
-
-        # PIE CHART BY LEGISLATION
-        stop_and_search_pie_chart(
-            ss_df, 'legislation', 'lower center', 'stop_and_searches/static/png/legislation-pie-chart')
+        try:
+            from_date = datetime.strptime(starting_date, "%Y-%m-%d")
+            to_date = datetime.strptime(ending_date, "%Y-%m-%d")
+        except ValueError:
+            return HttpResponseBadRequest("The from and to dates must be given as YYYY-MM-DD.")
+
+        ss_cube, response = load_page_cube(request, 'stop_and_searches', normal_postcode)
+        if response is not None:
+            return response
+
+        version = ss_cube['count'].sum()
+        ss_cube = slice_months(ss_cube, from_date, to_date)
+        starting_date = str(from_date.date())
+        ending_date = str(to_date.date())
+
+        # BAR CHART BY HOUR, BAR CHART BY OBJECT OF SEARCH, PIE CHART BY AGE
+        chart_urls = get_chart_urls('stop_and_searches', normal_postcode, starting_date, ending_date, {
+            'bar_chart_by_hour': (stop_and_search_hour_bar_chart, lambda: {'df': counting_by_category(ss_cube, ['hour'])}),
+            'object_of_search_bar': (object_of_search_bar_chart, lambda: {'df': ss_cube[['object of search', 'count'] + ([third_var] if third_var else [])], 'third_var': third_var}),
+            'age_pie_chart': (stop_and_search_pie_chart, lambda: {'df': ss_cube[['age range', 'count']], 'category': 'age range', 'loc': 'center right'})},
+            third_vars={'object_of_search_bar': third_var}, version=version)
 
         # Gender Table
-        ss_gender_df = counting_by_category(ss_df, ['gender'])
-        print(ss_gender_df.columns)
+        ss_gender_df = counting_by_category(ss_cube, ['gender'])
         ss_gender_df = ss_gender_df.rename(columns={"gender": "count"})
-        print(ss_gender_df.columns)
-        print('-------------------------------')
 
         context = {"postcode": normal_postcode[:-3].strip().upper() + ' ' + normal_postcode[-3:].strip().upper(),
                    "ss_gender_df": ss_gender_df.sort_values('count', ascending=False).iterrows(),
+                   "chart_urls": chart_urls,
                    "starting_date": starting_date,
                    "ending_date": ending_date}
 
-        return render(request, "stop_and_searches/ss_postcode_page.html", context)
+        return render_page(request, "stop_and_searches/ss_postcode_page.html", context)
+
+
+def aggregates(request, postcode):
+    """Returns the counts of stop and searches around a postcode by date, hour, object
+    of search, age range, gender and legislation as JSON, for the date range given by
+    the 'from' and 'to' parameters. The 'third-var' parameter (age range, gender or
+    outcome) adds counts by object of search and that variable. If the postcode's data
+    isn't ready it's loaded in the background, with a 202 meanwhile."""
+
+    normal_postcode = postcode.replace(" ", "").lower()
+    third_var = request.GET.get('third-var')
+
+    if third_var not in [None, "age range", "gender", "outcome"]:
+        return JsonResponse({"error": "The only valid third variables are 'age range', 'gender' or 'outcome'."},
+                            status=400)
+
+    try:
+        from_date, to_date = parse_date_range(request)
+    except ValueError as e:
+        return JsonResponse({"error": str(e)}, status=400)
+
+    ss_cube, response = load_api_cube('stop_and_searches', normal_postcode)
+    if response is not None:
+        return response
+
+    ss_cube = slice_months(ss_cube, from_date, to_date)
+
+    data = {"postcode": normal_postcode,
+            "from": str(from_date.date()),
+            "to": str(to_date.date()),
+            "total": int(ss_cube['count'].sum()),
+            "counts": {category: counts_as_dict(ss_cube, [category])
+                       for category in ['date', 'hour', 'object of search', 'age range', 'gender', 'legislation']}}
+
+    if third_var is not None:
+        data["counts"][f"object of search by {third_var}"] = counts_as_dict(
+            ss_cube, ['object of search', third_var])
+
+    return etag_json_response(request, data)